@@ -0,0 +1,135 @@
+import re
+import time
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+import numpy as np
+
+
+def normalize_question(question: str) -> str:
+    """Case/whitespace/punctuation-insensitive form used as the cache key."""
+    q = unicodedata.normalize("NFKC", question or "").lower()
+    q = re.sub(r"\s+", " ", q).strip()
+    return q.rstrip(" ?!.")
+
+
+class AnswerCache:
+    """
+    Two-level answer cache, per mode:
+    - exact: LRU on the normalized question
+    - semantic: cosine similarity over embeddings of recently answered questions
+    Entries expire after `ttl` seconds; everything is dropped when `version_fn()` changes
+    (i.e. the document collection was re-ingested).
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 3600,
+        semantic_entries: int = 512,
+        threshold: float = 0.95,
+        embed_fn: Optional[Callable[[str], List[float]]] = None,
+        version_fn: Optional[Callable[[], object]] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.semantic_entries = semantic_entries
+        self.threshold = threshold
+        self.embed_fn = embed_fn
+        self.version_fn = version_fn
+        self._lock = threading.Lock()
+        self._exact = OrderedDict()  # (mode, normalized) -> (expires_at, value)
+        self._semantic = {}          # mode -> OrderedDict(normalized -> unit vector)
+        self._version = version_fn() if version_fn else None
+        self.hits = {"exact": 0, "semantic": 0}
+        self.misses = 0
+
+    def _check_version(self):
+        if self.version_fn is None:
+            return
+        version = self.version_fn()
+        if version != self._version:
+            if self._exact:
+                logging.info("Document collection changed, clearing answer cache")
+            self._exact.clear()
+            self._semantic.clear()
+            self._version = version
+
+    def _embed(self, normalized: str) -> Optional[np.ndarray]:
+        if self.embed_fn is None or self.semantic_entries <= 0:
+            return None
+        try:
+            vec = np.asarray(self.embed_fn(normalized), dtype=np.float32)
+        except Exception as e:
+            logging.warning(f"Semantic cache embedding failed: {e}")
+            return None
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else None
+
+    def _live(self, key):
+        item = self._exact.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._exact[key]
+            return None
+        self._exact.move_to_end(key)
+        return value
+
+    def get(self, question: str, mode: str = "general"):
+        normalized = normalize_question(question)
+        with self._lock:
+            self._check_version()
+            value = self._live((mode, normalized))
+            if value is not None:
+                self.hits["exact"] += 1
+                return value
+            recent = self._semantic.get(mode)
+            if not recent:
+                self.misses += 1
+                return None
+            keys = list(recent.keys())
+            matrix = np.stack(list(recent.values()))
+
+        # Embedding runs outside the lock; it is the expensive part of a lookup
+        vec = self._embed(normalized)
+        if vec is None:
+            self.misses += 1
+            return None
+        sims = matrix @ vec
+        best = int(np.argmax(sims))
+        if sims[best] >= self.threshold:
+            with self._lock:
+                value = self._live((mode, keys[best]))
+            if value is not None:
+                self.hits["semantic"] += 1
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, question: str, value, mode: str = "general"):
+        normalized = normalize_question(question)
+        vec = self._embed(normalized)
+        with self._lock:
+            self._check_version()
+            key = (mode, normalized)
+            self._exact[key] = (time.monotonic() + self.ttl, value)
+            self._exact.move_to_end(key)
+            while len(self._exact) > self.max_entries:
+                (old_mode, old_q), _ = self._exact.popitem(last=False)
+                self._semantic.get(old_mode, {}).pop(old_q, None)
+            if vec is not None:
+                recent = self._semantic.setdefault(mode, OrderedDict())
+                recent[normalized] = vec
+                recent.move_to_end(normalized)
+                while len(recent) > self.semantic_entries:
+                    recent.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._exact.clear()
+            self._semantic.clear()
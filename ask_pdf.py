@@ -1,22 +1,33 @@
+import json
 import logging
 import os
-import pickle
+import threading
+import urllib.request
+from collections import OrderedDict
+from typing import Any, List, Tuple
 from dotenv import load_dotenv
 
-from langchain_community.embeddings import HuggingFaceEmbeddings
+import chromadb
 from langchain_community.vectorstores import Chroma
 from langchain.prompts import PromptTemplate
 from langchain.chains import RetrievalQA
 
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
 
-# Re-ranking (optional, kept as-is)
-from sentence_transformers import CrossEncoder
+from bm25_index import BM25Index, needs_upgrade
+from chunk_store import QUANT_FILES, VECTOR_QUANT
+from hybrid_retriever import HybridRetriever, current_options
+from rag_metrics import count_cache, timed_stage
+from context_packing import CONTEXT_TOKEN_BUDGET, pack_context
+from embedding_cache import CachedEmbeddings
+from model_loader import EMBEDDING_MODEL, load_embeddings, load_cross_encoder, preload
 
 logging.basicConfig(level=logging.INFO)
 
 # ---------- LLM provider selection (LOCAL by default) ----------
+# LLM_PROVIDER=ollama | openai | stub (deterministic offline stand-in, see stub_llm.py)
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "ollama").strip().lower()
 
 _openai_available = False
@@ -39,29 +50,119 @@ except Exception:
         _chatollama = None
 
 
-# -------- Embeddings cache --------
-def load_or_initialize_embeddings():
-    if os.path.exists("academic_embeddings.pkl"):
-        logging.info("Loading cached embeddings...")
-        with open("academic_embeddings.pkl", "rb") as f:
-            embeddings = pickle.load(f)
-        return embeddings
-    logging.info("Initializing new academic embeddings...")
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    with open("academic_embeddings.pkl", "wb") as f:
-        pickle.dump(embeddings, f)
-    return embeddings
+# -------- Models (pinned locally, loaded once per process) --------
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+def get_embeddings():
+    """Query-side embedding model, loaded on first use from the pinned model directory."""
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            if os.path.exists("academic_embeddings.pkl"):
+                logging.warning("academic_embeddings.pkl is no longer used and can be deleted.")
+            _embeddings = load_embeddings()
+    return _embeddings
+
+
+def warm_start():
+    """Load the embedding model and (if reranking) the cross-encoder in parallel."""
+    loaders = {"embeddings": get_embeddings}
+    if RERANK_ENABLED:
+        loaders["cross_encoder"] = get_cross_encoder
+    return preload(loaders)
+
+
+# -------- Cross-encoder re-ranking --------
+# RERANK_ENABLED=1|0      rerank in the API path (over-retrieve, then keep the best)
+# RERANK_CANDIDATES=12    candidates fetched per retriever before reranking
+# RERANK_TOP_K=4          chunks kept for the prompt
+# RERANK_MAX_LENGTH=256   max (query + chunk) tokens fed to the cross-encoder
+# RERANK_BATCH_SIZE=32    pairs per forward pass
+# RERANK_CACHE_SIZE=4096  cached (query, chunk id) scores
+RERANK_ENABLED = bool(int(os.getenv("RERANK_ENABLED", "1")))
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "12"))
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "4"))
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", "256"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "32"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "4096"))
+
+_cross_encoder = None
+_cross_encoder_lock = threading.Lock()
+
+def get_cross_encoder():
+    """Load the cross-encoder on first use (the API may never need it)."""
+    global _cross_encoder
+    with _cross_encoder_lock:
+        if _cross_encoder is None:
+            logging.info("Loading cross-encoder for re-ranking...")
+            _cross_encoder = load_cross_encoder(max_length=RERANK_MAX_LENGTH)
+    return _cross_encoder
+
+
+def chunk_key(doc: Document) -> str:
+    """Chroma id of a chunk, rebuilt from the metadata chromadbpdf.py writes."""
+    meta = doc.metadata or {}
+    return f"{meta.get('document_id')}-p{meta.get('page_number')}-c{meta.get('chunk_id')}"
+
+
+_score_cache = OrderedDict()
+_score_cache_lock = threading.Lock()
+
+def clear_score_cache():
+    with _score_cache_lock:
+        _score_cache.clear()
+
+def rerank_scores(query: str, docs: List[Document]) -> List[float]:
+    """Cross-encoder scores for docs; uncached pairs are scored in one batched predict."""
+    return pair_scores([(query, d) for d in docs])
+
+def pair_scores(pairs: List[Tuple[str, Document]]) -> List[float]:
+    """Cross-encoder scores for (query, doc) pairs, possibly spanning many queries."""
+    keys = [(query, chunk_key(d)) for query, d in pairs]
+    scores = [None] * len(pairs)
+    with _score_cache_lock:
+        for i, key in enumerate(keys):
+            if key in _score_cache:
+                _score_cache.move_to_end(key)
+                scores[i] = _score_cache[key]
+    todo = [i for i, sc in enumerate(scores) if sc is None]
+    count_cache("rerank", hits=len(pairs) - len(todo), misses=len(todo))
+    if todo:
+        inputs = [[pairs[i][0], pairs[i][1].page_content] for i in todo]
+        predicted = get_cross_encoder().predict(inputs, batch_size=RERANK_BATCH_SIZE)
+        with _score_cache_lock:
+            for i, sc in zip(todo, predicted):
+                scores[i] = float(sc)
+                _score_cache[keys[i]] = scores[i]
+            while len(_score_cache) > RERANK_CACHE_SIZE:
+                _score_cache.popitem(last=False)
+    return scores
+
+def rerank(query, docs, scores=None):
+    if not docs:
+        return []
+    scores = rerank_scores(query, docs) if scores is None else scores
+    order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)
+    return [
+        Document(page_content=docs[i].page_content, metadata={**docs[i].metadata, "rerank_score": scores[i]})
+        for i in order
+    ]
 
 
-# -------- Optional cross-encoder re-ranking --------
-cross_encoder = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")
+class RerankingRetriever(BaseRetriever):
+    """Pipeline stage: over-retrieve from `base`, rerank with the cross-encoder, keep top_k."""
 
-def rerank(query, docs):
-    if not docs:
-        return []
-    pairs = [[query, d.page_content] for d in docs]
-    scores = cross_encoder.predict(pairs)
-    return [doc for _, doc in sorted(zip(scores, docs), reverse=True)]
+    base: Any
+    top_k: int = RERANK_TOP_K
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        candidates = self.base.invoke(query, config={"callbacks": run_manager.get_child()})
+        top_k = int(current_options().get("top_k") or self.top_k)
+        with timed_stage("rerank"):
+            return rerank(query, candidates)[:top_k]
 
 
 # -------- LLM factory --------
@@ -71,6 +172,11 @@ def _make_llm(model_type: str = "general"):
     """
     load_dotenv(override=True)
 
+    if LLM_PROVIDER == "stub":
+        from stub_llm import StubChatModel
+        logging.info("Using the stub LLM (deterministic, offline)")
+        return StubChatModel()
+
     if LLM_PROVIDER == "openai":
         if not _openai_available:
             raise RuntimeError("LLM_PROVIDER=openai but langchain-openai is not installed.")
@@ -102,23 +208,113 @@ def _make_llm(model_type: str = "general"):
     )
 
 
-# -------- RAG init (lightweight) --------
-def initialize_rag_system(model_type: str = "general"):
+def ping_llm(model_type: str = "general", timeout: float = 2.0):
     """
-    Build a lightweight QA chain with a simple hybrid retriever.
-    Pass model_type="math" to bind the math model.
+    Lightweight reachability check of the LLM backend (no generation).
+    Returns (ok, detail). For Ollama it also checks the model is pulled.
     """
-    load_dotenv(override=True)
+    if LLM_PROVIDER == "stub":
+        return True, "stub"
+    if LLM_PROVIDER == "openai":
+        base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+        request = urllib.request.Request(
+            f"{base_url}/models", headers={"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY', '')}"}
+        )
+        model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+    else:
+        base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434").rstrip("/")
+        request = urllib.request.Request(f"{base_url}/api/tags")
+        if model_type == "math":
+            model = os.getenv("OLLAMA_MODEL_MATH", "qwen-4b-math")
+        else:
+            model = os.getenv("OLLAMA_MODEL", "llama3.1:8b")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            body = json.loads(response.read() or b"{}")
+    except Exception as e:
+        return False, f"{LLM_PROVIDER} unreachable at {base_url}: {e}"
+    if LLM_PROVIDER != "openai":
+        names = {m.get("name") for m in body.get("models", [])}
+        if model not in names and f"{model}:latest" not in names:
+            return False, f"Ollama model {model} is not pulled"
+    return True, f"{LLM_PROVIDER}:{model}"
+
+
+# -------- Stage timing --------
+class TimedRetriever(BaseRetriever):
+    """Records the wrapped retriever's latency as a named stage."""
+
+    inner: Any
+    stage: str
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        with timed_stage(self.stage):
+            return self.inner.invoke(query, config={"callbacks": run_manager.get_child()})
+
 
-    embeddings = load_or_initialize_embeddings()
+# -------- Retrieval engine (shared by every mode) --------
+class RetrievalEngine:
+    """
+    Everything retrieval needs, built once per process: embeddings, the Chroma
+    store, the BM25 index and the hybrid retriever. LLM/prompt bindings per
+    mode are layered on top by build_qa_chain.
+    """
+
+    def __init__(self, embeddings, vector_db, index, hybrid, retriever):
+        self.embeddings = embeddings
+        self.vector_db = vector_db
+        self.index = index
+        self.hybrid = hybrid
+        self.retriever = retriever
+
+    @property
+    def cross_encoder(self):
+        return get_cross_encoder()
+
+    def retrieve_many(self, queries: List[str]) -> List[List[Document]]:
+        """
+        Same results as retriever.invoke(q) for each query, computed as a batch:
+        one encoder call, one Chroma query and one Chroma fetch for all queries,
+        and one cross-encoder pass for all (query, candidate) pairs.
+        """
+        fused = self.hybrid.retrieve_batch(queries)
+        if not RERANK_ENABLED:
+            return fused
+        top_k = int(current_options().get("top_k") or RERANK_TOP_K)
+        with timed_stage("rerank"):
+            pairs = [(q, doc) for q, docs in zip(queries, fused) for doc in docs]
+            scores = pair_scores(pairs)
+            out, start = [], 0
+            for q, docs in zip(queries, fused):
+                out.append(rerank(q, docs, scores[start:start + len(docs)])[:top_k])
+                start += len(docs)
+            return out
+
+
+def build_retrieval_engine():
+    """Open Chroma and build the hybrid retriever. Returns None if there is nothing to search."""
+    load_dotenv(override=True)
 
     persist_directory = "./academic_db"
     if not os.path.exists(persist_directory):
         logging.error("Academic database not found! Run chromadbpdf.py first.")
         return None
 
+    # Repeated query embeddings are served from the same cache ingestion fills
+    embeddings = CachedEmbeddings(get_embeddings(), persist_directory, model_name=EMBEDDING_MODEL)
+
+    # Open the collection only if ingestion created it: Chroma() alone would create a
+    # missing one with default HNSW settings (l2, default M/ef), which ingestion then keeps
+    client = chromadb.PersistentClient(path=persist_directory)
+    try:
+        client.get_collection("academic_docs")
+    except Exception:
+        logging.error("No documents found in ChromaDB!")
+        return None
     vector_db = Chroma(
-        persist_directory=persist_directory,
+        client=client,
         embedding_function=embeddings,
         collection_name="academic_docs",
     )
@@ -134,28 +330,40 @@ def initialize_rag_system(model_type: str = "general"):
 
     logging.info(f"Found {coll_count} documents in ChromaDB")
 
-    # Load documents once to build a BM25 retriever
-    logging.info("Loading documents for BM25 keyword search...")
-    all_docs = vector_db.similarity_search("placeholder", k=coll_count)
-    if not all_docs:
-        logging.error("Could not load any documents for BM25; check your Chroma collection.")
+    # Memory-mapped BM25 index (opens in milliseconds, shared via the page cache). Only
+    # ingestion writes it, under the ingestion lock: building or upgrading it is left to
+    # the next run, which the API queues at startup (python chromadbpdf.py otherwise)
+    index = BM25Index.open(persist_directory)
+    if index is None or not len(index):
+        logging.error("BM25 index is missing or empty; run ingestion to build it from ChromaDB.")
         return None
-
-    # Sparse (keyword) and dense retrievers (keep k small)
-    bm25 = BM25Retriever.from_documents(all_docs)
-    bm25.k = 3
-    dense = vector_db.as_retriever(search_kwargs={"k": 3})
-
-    retriever = EnsembleRetriever(
-        retrievers=[bm25, dense],
-        weights=[0.5, 0.5],
+    if needs_upgrade(persist_directory):
+        logging.warning("BM25 index predates the chunk store or lacks the DENSE_QUANT copy; "
+                        "the next ingestion run upgrades it (until then texts come from ChromaDB)")
+    logging.info(f"Opened BM25 index with {len(index)} chunks")
+
+    # Sparse (keyword) and dense search fused in one retriever (keep k small unless reranking follows)
+    k = RERANK_CANDIDATES if RERANK_ENABLED else 3
+    hybrid = HybridRetriever(
+        index=index,
+        vector_db=vector_db,
+        embeddings=embeddings,
+        k=k,
+        limit=RERANK_CANDIDATES if RERANK_ENABLED else None,
     )
+    scan = f"{VECTOR_QUANT if VECTOR_QUANT in QUANT_FILES else 'float'} scan of the chunk store vectors"
+    logging.info(f"Dense search: {f'exact ({scan})' if hybrid.exact_dense() else 'HNSW (Chroma)'}")
+    retriever = hybrid
+    if RERANK_ENABLED:
+        retriever = RerankingRetriever(base=hybrid, top_k=RERANK_TOP_K)
+    retriever = TimedRetriever(inner=retriever, stage="retrieval")
+
+    logging.info("Retrieval engine initialized")
+    return RetrievalEngine(embeddings, vector_db, index, hybrid, retriever)
 
-    # LLM
-    llm = _make_llm(model_type=model_type)
 
-    # Student-friendly prompt
-    prompt_template = """
+# Student-friendly prompt
+PROMPT_TEMPLATE = """
 You are a helpful academic assistant for university students. Use ONLY the provided academic documents to answer questions.
 
 Guidelines:
@@ -174,20 +382,54 @@ Student's question:
 
 Helpful answer:
 """
-    PROMPT = PromptTemplate(template=prompt_template, input_variables=["context", "question"])
+PROMPT = PromptTemplate(template=PROMPT_TEMPLATE, input_variables=["context", "question"])
+
+
+class PackedRetrievalQA(RetrievalQA):
+    """RetrievalQA whose "stuff" context is de-duplicated, merged and fit to a token budget."""
+
+    token_budget: int = CONTEXT_TOKEN_BUDGET["general"]
+
+    def pack(self, docs: List[Document]) -> List[Document]:
+        with timed_stage("context_packing"):
+            return pack_context(docs, self.token_budget)
+
+    def _get_docs(self, question: str, *, run_manager) -> List[Document]:
+        return self.pack(super()._get_docs(question, run_manager=run_manager))
+
+    async def _aget_docs(self, question: str, *, run_manager) -> List[Document]:
+        return self.pack(await super()._aget_docs(question, run_manager=run_manager))
 
-    qa_chain = RetrievalQA.from_chain_type(
+
+def build_qa_chain(engine: RetrievalEngine, model_type: str = "general"):
+    """Bind an LLM (and the prompt) to the shared retriever."""
+    llm = _make_llm(model_type=model_type)
+
+    qa_chain = PackedRetrievalQA.from_chain_type(
         llm=llm,
         chain_type="stuff",
-        retriever=retriever,
+        retriever=engine.retriever,
         chain_type_kwargs={"prompt": PROMPT},
         return_source_documents=True,
+        token_budget=CONTEXT_TOKEN_BUDGET.get(model_type, CONTEXT_TOKEN_BUDGET["general"]),
     )
 
-    logging.info("Academic Study Assistant RAG System initialized")
+    logging.info(f"Academic Study Assistant RAG chain ready (model_type={model_type})")
     return qa_chain
 
 
+# -------- RAG init (lightweight) --------
+def initialize_rag_system(model_type: str = "general"):
+    """
+    Build a lightweight QA chain with a simple hybrid retriever.
+    Pass model_type="math" to bind the math model.
+    """
+    engine = build_retrieval_engine()
+    if engine is None:
+        return None
+    return build_qa_chain(engine, model_type=model_type)
+
+
 # -------- (optional) CLI loop --------
 def ask_questions(qa_chain):
     logging.info("🎓 Academic Study Assistant Ready!")
@@ -200,10 +442,10 @@ def ask_questions(qa_chain):
             break
         try:
             result = qa_chain.invoke({"query": question})
-            reranked = rerank(question, result.get("source_documents", []))
             logging.info("\nAnswer:\n" + result.get("result", ""))
             logging.info("\n📖 Sources:")
-            for i, doc in enumerate(reranked[:3], 1):
+            # Already ranked (and trimmed) by the retriever: shown in the order the chain used
+            for i, doc in enumerate(result.get("source_documents", [])[:3], 1):
                 src = doc.metadata.get("source", "Unknown")
                 page = doc.metadata.get("page_number", "?")
                 ctype = doc.metadata.get("content_type", "document")
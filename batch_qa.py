@@ -0,0 +1,86 @@
+# Offline batch answering: pre-generate answers for FAQ lists and question banks.
+#
+#   python batch_qa.py questions.jsonl -o answers.jsonl [--mode math] [--in-flight 8]
+#
+# Input is JSONL (one object per line with an id and the question text; see --id-field
+# and --field) or plain text (one question per line). Answers are written as JSONL in
+# completion order, flushed line by line, so a long run can be followed with `tail -f`.
+# --resume skips ids already present in the output file.
+
+import sys
+import json
+import time
+import logging
+import argparse
+
+from rag_pipeline import iter_batch_answers, BATCH_MAX_IN_FLIGHT
+
+
+def read_questions(path, field="question", id_field="id"):
+    """Yield (id, question) from a JSONL or plain-text file; blank lines are skipped."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                obj = json.loads(line)
+                question = (obj.get(field) or "").strip()
+                item_id = obj.get(id_field, line_no)
+            else:
+                question, item_id = line, line_no
+            if question:
+                yield item_id, question
+            else:
+                logging.warning(f"Line {line_no}: no '{field}' field, skipped")
+
+
+def answered_ids(path):
+    ids = set()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    ids.add(json.loads(line)["id"])
+                except (ValueError, KeyError):
+                    pass
+    except FileNotFoundError:
+        pass
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a file of questions with the RAG pipeline")
+    parser.add_argument("input", help="JSONL or text file of questions")
+    parser.add_argument("-o", "--output", help="JSONL output file (default: stdout)")
+    parser.add_argument("--mode", choices=["general", "math"], default="general")
+    parser.add_argument("--field", default="question", help="JSON field holding the question")
+    parser.add_argument("--id-field", default="id", help="JSON field holding the question id")
+    parser.add_argument("--in-flight", type=int, default=BATCH_MAX_IN_FLIGHT, help="concurrent LLM calls")
+    parser.add_argument("--resume", action="store_true", help="skip ids already in the output file")
+    args = parser.parse_args()
+
+    items = read_questions(args.input, args.field, args.id_field)
+    if args.resume and args.output:
+        done = answered_ids(args.output)
+        items = (item for item in items if item[0] not in done)
+        logging.info(f"Resuming: {len(done)} answers already in {args.output}")
+
+    out = open(args.output, "a" if args.resume else "w", encoding="utf-8") if args.output else sys.stdout
+    start, count, errors = time.perf_counter(), 0, 0
+    try:
+        for result in iter_batch_answers(items, mode=args.mode, max_in_flight=args.in_flight):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            count += 1
+            errors += result["answer"].startswith("Error:")
+            if count % 10 == 0:
+                logging.info(f"{count} answers ({count / (time.perf_counter() - start):.2f}/s)")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    logging.info(f"Done: {count} answers, {errors} errors in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
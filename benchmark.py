@@ -0,0 +1,326 @@
+# End-to-end benchmark of the RAG stack.
+#
+#   python benchmark.py [--corpus university_documents] [--queries 40]
+#                       [--concurrency 1,4,16] [--requests 64]
+#                       [--output bench.json] [--compare previous.json]
+#
+# Stages:
+#   ingestion   page extraction (pages/s, OCR pages/s) and a full chromadbpdf ingest
+#               (pages/s, chunks/s) into a scratch academic_db with a cold embedding cache
+#   retrieval   per-stage latency (bm25, dense, fusion, rerank, total) for single queries,
+#               plus the batched path (retrieve_many)
+#   dense       exact matmul vs HNSW dense search: latency of each, and HNSW recall@k
+#               against the exact results (--recall-k)
+#   e2e         /api/ask p50/p95/p99 and throughput at each concurrency level, in-process
+#               over ASGI (no network), answer cache disabled
+#
+# The LLM is the deterministic stub (LLM_PROVIDER=stub, see stub_llm.py) unless
+# LLM_PROVIDER is set explicitly, so runs are offline and comparable across commits.
+# Queries are sampled (fixed seed) from the ingested chunks, so any corpus works. Every
+# timed section gets its own queries and starts with the query-embedding LRU and the
+# rerank score cache cleared, so no number comes from another section's warm caches.
+
+import os
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+REPO_DIR = Path(__file__).resolve().parent
+
+# Must be set before the project modules read their configuration
+os.environ.setdefault("LLM_PROVIDER", "stub")
+os.environ.setdefault("MODEL_DIR", str(REPO_DIR / "models"))
+os.environ["ANSWER_CACHE_ENABLED"] = "0"
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    arr = np.asarray(values, dtype=np.float64)
+    return {
+        "n": int(arr.size),
+        "mean": round(float(arr.mean()), 2),
+        "p50": round(float(np.percentile(arr, 50)), 2),
+        "p95": round(float(np.percentile(arr, 95)), 2),
+        "p99": round(float(np.percentile(arr, 99)), 2),
+        "max": round(float(arr.max()), 2),
+    }
+
+
+def run_info():
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+        except OSError:
+            return ""
+
+    return {
+        "commit": git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            key: os.getenv(key)
+            for key in (
+                "LLM_PROVIDER", "STUB_LLM_TTFT_MS", "STUB_LLM_TOKEN_MS", "STUB_LLM_TOKENS",
+                "MODEL_BACKEND", "RERANK_ENABLED", "INGEST_WORKERS", "EMBED_BATCH_SIZE",
+                "DENSE_SEARCH", "DENSE_DTYPE", "HNSW_M", "HNSW_EF_SEARCH",
+            )
+            if os.getenv(key) is not None
+        },
+    }
+
+
+# -------- Ingestion --------
+def bench_ingestion(pdf_dir):
+    from chromadbpdf import iter_extracted_pages, process_all_pdfs
+    from model_loader import load_embeddings
+
+    paths = sorted(str(p) for p in Path(pdf_dir).iterdir() if p.suffix.lower() == ".pdf")
+    start = time.perf_counter()
+    pages = ocr_pages = 0
+    for _, _, _, ocr_used in iter_extracted_pages(paths):
+        pages += 1
+        ocr_pages += bool(ocr_used)
+    extract_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    embeddings = load_embeddings()
+    model_load_s = time.perf_counter() - start
+
+    progress = {}
+    start = time.perf_counter()
+    process_all_pdfs(progress=lambda **fields: progress.update(fields), embedding_model=embeddings)
+    ingest_s = time.perf_counter() - start
+
+    return {
+        "files": len(paths),
+        "extraction": {
+            "pages": pages,
+            "ocr_pages": ocr_pages,
+            "seconds": round(extract_s, 3),
+            "pages_per_s": round(pages / extract_s, 2) if extract_s else None,
+            "ocr_pages_per_s": round(ocr_pages / extract_s, 2) if ocr_pages and extract_s else None,
+        },
+        "ingest": {
+            "model_load_s": round(model_load_s, 3),
+            "seconds": round(ingest_s, 3),
+            "pages": progress.get("pages_done", 0),
+            "chunks": progress.get("chunks_stored", 0),
+            "pages_per_s": round(progress.get("pages_done", 0) / ingest_s, 2) if ingest_s else None,
+            "chunks_per_s": round(progress.get("chunks_stored", 0) / ingest_s, 2) if ingest_s else None,
+        },
+    }
+
+
+def sample_queries(engine, count, seed=13):
+    """Deterministic, distinct pseudo-questions: the opening words of randomly chosen chunks
+    (repeats only once the corpus runs out of distinct openings)."""
+    texts = [t for t in engine.vector_db._collection.get(include=["documents"])["documents"] if t and t.strip()]
+    openings = sorted({" ".join(t.split()[:10]) for t in texts})
+    rng = random.Random(seed)
+    rng.shuffle(openings)
+    if openings and len(openings) < count:
+        logging.warning(f"Only {len(openings)} distinct queries for {count}; some repeat (caches are still cleared)")
+    return [openings[i % len(openings)] for i in range(count)] if openings else []
+
+
+def cold_caches(engine):
+    """Clear the per-query caches a timed section could otherwise hit (the answer cache is off)."""
+    from ask_pdf import clear_score_cache
+
+    engine.embeddings.clear_queries()
+    clear_score_cache()
+
+
+# -------- Retrieval --------
+def bench_retrieval(engine, queries, batch_queries, warmup=3):
+    """Single-query stages on `queries`, the batched path on the disjoint `batch_queries`."""
+    from rag_metrics import collect_timings
+
+    for query in queries[:warmup]:
+        engine.retriever.invoke(query)
+    queries = queries[warmup:]
+    cold_caches(engine)
+    stages = {}
+    for query in queries:
+        with collect_timings() as timings:
+            engine.retriever.invoke(query)
+        for stage, ms in timings.items():
+            stages.setdefault(stage, []).append(ms)
+
+    cold_caches(engine)
+    start = time.perf_counter()
+    engine.retrieve_many(batch_queries)
+    batch_ms = (time.perf_counter() - start) * 1000.0
+    return {
+        "queries": len(queries),
+        "stages_ms": {stage: percentiles(values) for stage, values in sorted(stages.items())},
+        "batched_queries": len(batch_queries),
+        "batched_ms_per_query": round(batch_ms / len(batch_queries), 2) if batch_queries else None,
+    }
+
+
+# -------- Dense search: exact vs HNSW --------
+def bench_dense(engine, queries, k=10):
+    """Latency of both dense paths, and recall@k of HNSW taking the exact results as truth."""
+    index, collection = engine.index, engine.vector_db._collection
+    if not index.has_vectors():
+        return {"skipped": "the chunk store has no vectors"}
+    vectors = engine.embeddings.embed_queries(queries)
+    exact_ms, hnsw_ms, recall = [], [], []
+    for vector in vectors:
+        start = time.perf_counter()
+        exact = index.nearest([vector], k=k)[0]
+        exact_ms.append((time.perf_counter() - start) * 1000.0)
+        start = time.perf_counter()
+        approx = collection.query(query_embeddings=[vector], n_results=k, include=[])["ids"][0]
+        hnsw_ms.append((time.perf_counter() - start) * 1000.0)
+        if exact:
+            recall.append(len(set(exact) & set(approx)) / len(exact))
+
+    start = time.perf_counter()
+    index.nearest(vectors, k=k)
+    batch_ms = (time.perf_counter() - start) * 1000.0
+    return {
+        "k": k,
+        "chunks": len(index),
+        "exact_ms": percentiles(exact_ms),
+        "exact_batched_ms_per_query": round(batch_ms / len(vectors), 3) if vectors else None,
+        "hnsw_ms": percentiles(hnsw_ms),
+        "hnsw_recall_at_k": round(float(np.mean(recall)), 4) if recall else None,
+        "hnsw_min_recall": round(float(np.min(recall)), 4) if recall else None,
+    }
+
+
+# -------- End-to-end under load --------
+async def _load(app, queries, concurrency, total):
+    """`total` requests over `queries` (distinct when there are enough)."""
+    import httpx
+
+    latencies, statuses = [], {}
+    sem = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300.0) as client:
+        async def one(i):
+            async with sem:
+                start = time.perf_counter()
+                response = await client.post("/api/ask", json={"question": queries[i % len(queries)]})
+                latencies.append((time.perf_counter() - start) * 1000.0)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        wall = time.perf_counter() - start
+    return {
+        "requests": total,
+        "latency_ms": percentiles(latencies),
+        "throughput_rps": round(total / wall, 2) if wall else None,
+        "status_codes": {str(code): n for code, n in sorted(statuses.items())},
+    }
+
+
+def bench_e2e(engine, queries, levels, total):
+    """One slice of `total` queries per level, run after clearing the caches."""
+    from rag_api import app
+
+    async def run_levels():
+        # One event loop for all levels: the pipeline's limiters bind to the loop they first run in
+        results = {}
+        for i, c in enumerate(levels):
+            cold_caches(engine)
+            results[f"concurrency_{c}"] = await _load(app, queries[i * total:(i + 1) * total] or queries, c, total)
+        return results
+
+    return asyncio.run(run_levels())
+
+
+# -------- Comparison --------
+def flatten(data, prefix=""):
+    out = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            out.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[name] = value
+    return out
+
+
+def compare(previous, current):
+    old, new = flatten(previous), flatten(current)
+    print(f"{'metric':60} {'before':>12} {'after':>12} {'change':>8}")
+    for name in sorted(set(old) & set(new)):
+        if name.startswith("run.") or not old[name]:
+            continue
+        change = (new[name] - old[name]) / abs(old[name]) * 100.0
+        print(f"{name:60} {old[name]:>12} {new[name]:>12} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingestion, retrieval and /api/ask")
+    parser.add_argument("--corpus", default=str(REPO_DIR / "university_documents"), help="PDF fixture directory")
+    parser.add_argument("--queries", type=int, default=40, help="queries per retrieval section (single, batched, dense)")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated /api/ask concurrency levels")
+    parser.add_argument("--requests", type=int, default=64, help="/api/ask requests (distinct queries) per concurrency level")
+    parser.add_argument("--recall-k", type=int, default=10, help="k for the dense recall@k comparison")
+    parser.add_argument("--output", help="write the JSON results here (default: stdout)")
+    parser.add_argument("--compare", help="previous results JSON to diff against")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+
+    corpus = Path(args.corpus).resolve()
+    output = Path(args.output).resolve() if args.output else None
+    previous = Path(args.compare).resolve() if args.compare else None
+    workdir = Path(tempfile.mkdtemp(prefix="rag-bench-"))
+    os.symlink(corpus, workdir / "university_documents")
+    os.chdir(workdir)  # the pipeline uses ./university_documents and ./academic_db
+    logging.info(f"Benchmarking {corpus} in {workdir}")
+
+    results = {"run": run_info()}
+    try:
+        results["ingestion"] = bench_ingestion("university_documents")
+
+        import rag_pipeline
+        if rag_pipeline.engine is None:
+            raise SystemExit("Nothing was ingested; cannot benchmark retrieval")
+        engine = rag_pipeline.engine
+        levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+        # Disjoint query sets: warm-up + single queries, batched, dense, then one per e2e level
+        warmup, n = 3, args.queries
+        pool = sample_queries(engine, warmup + 3 * n + len(levels) * args.requests)
+        single, batched, dense = pool[:warmup + n], pool[warmup + n:warmup + 2 * n], pool[warmup + 2 * n:warmup + 3 * n]
+        results["retrieval"] = bench_retrieval(engine, single, batched, warmup=warmup)
+        results["dense"] = bench_dense(engine, dense, k=args.recall_k)
+        results["e2e"] = bench_e2e(engine, pool[warmup + 3 * n:], levels, args.requests)
+    finally:
+        os.chdir(REPO_DIR)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(results, indent=2)
+    if output:
+        output.write_text(text + "\n", encoding="utf-8")
+        logging.info(f"Results written to {output}")
+    else:
+        print(text)
+    if previous:
+        with open(previous, "r", encoding="utf-8") as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
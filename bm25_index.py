@@ -0,0 +1,516 @@
+import os
+import re
+import json
+import shutil
+import logging
+import contextlib
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from chunk_store import QUANT_FILES, RESCORE_FACTOR, VECTOR_QUANT, ChunkColumns, range_rows, write_columns
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process ingestion only
+    fcntl = None
+
+# On-disk BM25 inverted index and chunk store, written by chromadbpdf.py and
+# memory-mapped by the API.
+#
+# Layout (inside academic_db/bm25/):
+#   segments.json          live segment names + per-segment deleted rows (tombstones)
+#   seg_000001/terms.npy         sorted vocabulary (fixed-width unicode)
+#   seg_000001/term_offsets.npy  int64, postings of terms[i] are [offsets[i], offsets[i+1])
+#   seg_000001/post_rows.npy     int32 row ids, ascending within each term
+#   seg_000001/post_tf.npy       uint16 term frequencies
+#   seg_000001/doc_len.npy       int32 tokens per row
+#   seg_000001/chunk_ids.npy     fixed-width bytes, Chroma chunk id per row
+#   seg_000001/texts.bin, ...    chunk texts and metadata per row (see chunk_store.py)
+#
+# Segments are immutable: ingestion appends a segment per batch and tombstones rows of
+# deleted/replaced chunks; compaction merges everything into one segment.
+# All arrays are opened with mmap, so workers share them through the page cache.
+
+BM25_DIRNAME = "bm25"
+STATE_NAME = "segments.json"
+MAX_SEGMENTS = int(os.getenv("BM25_MAX_SEGMENTS", "8"))
+DENSE_BLOCK_ROWS = 16384  # rows per matmul block in nearest()
+BM25_K1 = float(os.getenv("BM25_K1", "1.5"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall((text or "").lower())
+
+
+def bm25_path(persist_directory: str) -> Path:
+    return Path(persist_directory) / BM25_DIRNAME
+
+
+class _Segment:
+    def __init__(self, path: Path, deleted_rows: Iterable[int] = ()):
+        self.name = path.name
+        load = lambda n: np.load(path / f"{n}.npy", mmap_mode="r")
+        self.terms = load("terms")
+        self.term_offsets = load("term_offsets")
+        self.post_rows = load("post_rows")
+        self.post_tf = load("post_tf")
+        self.doc_len = load("doc_len")
+        self.chunk_ids = load("chunk_ids")
+        self.columns = ChunkColumns.open(path, self.chunk_ids)
+        self.alive = np.ones(len(self.doc_len), dtype=bool)
+        deleted = np.fromiter(deleted_rows, dtype=np.int64)
+        if deleted.size:
+            self.alive[deleted] = False
+
+    @property
+    def live_docs(self) -> int:
+        return int(self.alive.sum())
+
+    @property
+    def live_len(self) -> int:
+        return int(self.doc_len[self.alive].sum())
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        i = int(np.searchsorted(self.terms, term))
+        if i >= len(self.terms) or self.terms[i] != term:
+            return _EMPTY_ROWS, _EMPTY_TF
+        start, end = int(self.term_offsets[i]), int(self.term_offsets[i + 1])
+        return self.post_rows[start:end], self.post_tf[start:end]
+
+
+_EMPTY_ROWS = np.zeros(0, dtype=np.int32)
+_EMPTY_TF = np.zeros(0, dtype=np.uint16)
+
+
+def _restrict(rows: np.ndarray, tf: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """The postings (ascending rows) that fall inside the [start, end) ranges; binary search per range."""
+    idx = range_rows(np.searchsorted(rows, starts), np.searchsorted(rows, ends))
+    if not len(idx):
+        return _EMPTY_ROWS, _EMPTY_TF
+    return rows[idx], tf[idx]
+
+
+def _write_segment(path: Path, vocab: np.ndarray, p_term: np.ndarray, p_row: np.ndarray,
+                   p_tf: np.ndarray, doc_len: np.ndarray, chunk_ids: np.ndarray,
+                   texts: Optional[List[str]] = None, metadatas: Optional[List[Dict]] = None,
+                   vectors=None) -> None:
+    """Write postings given as (term index into vocab, row, tf) triples, plus the chunk
+    store columns when the rows' texts and metadatas are given."""
+    order = np.lexsort((p_row, p_term))
+    p_term, p_row, p_tf = p_term[order], p_row[order], p_tf[order]
+    counts = np.bincount(p_term, minlength=len(vocab))
+    keep = counts > 0
+    vocab, counts = vocab[keep], counts[keep]
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    tmp = path.with_name(path.name + ".tmp")
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir(parents=True)
+    np.save(tmp / "terms.npy", vocab.astype(f"<U{max(1, vocab.dtype.itemsize // 4)}"))
+    np.save(tmp / "term_offsets.npy", offsets)
+    np.save(tmp / "post_rows.npy", p_row.astype(np.int32))
+    np.save(tmp / "post_tf.npy", np.minimum(p_tf, np.iinfo(np.uint16).max).astype(np.uint16))
+    np.save(tmp / "doc_len.npy", doc_len.astype(np.int32))
+    np.save(tmp / "chunk_ids.npy", chunk_ids)
+    if metadatas is not None:
+        write_columns(tmp, chunk_ids, texts, metadatas, vectors)
+    os.replace(tmp, path)
+
+
+class BM25Index:
+    """Segmented, memory-mapped BM25 index. Readers call refresh(); ingestion calls add/delete."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.segments: List[_Segment] = []
+        self.num_docs = 0
+        self.avgdl = 0.0
+        self._state_mtime = None
+        self.refresh(force=True)
+
+    @classmethod
+    def open(cls, persist_directory: str) -> Optional["BM25Index"]:
+        path = bm25_path(persist_directory)
+        if not (path / STATE_NAME).exists():
+            return None
+        return cls(path)
+
+    @classmethod
+    def create(cls, persist_directory: str) -> "BM25Index":
+        path = bm25_path(persist_directory)
+        path.mkdir(parents=True, exist_ok=True)
+        if not (path / STATE_NAME).exists():
+            _save_state(path, {"version": 1, "next_segment": 1, "segments": [], "deleted": {}})
+        return cls(path)
+
+    # ---------- reading ----------
+    def refresh(self, force: bool = False) -> bool:
+        """Re-open segments if ingestion changed the index. Returns True if reloaded."""
+        state_file = self.path / STATE_NAME
+        try:
+            mtime = state_file.stat().st_mtime_ns
+        except OSError:
+            return False
+        if not force and mtime == self._state_mtime:
+            return False
+        state = _load_state(self.path)
+        self.segments = [
+            _Segment(self.path / name, state["deleted"].get(name, ()))
+            for name in state["segments"]
+        ]
+        self._state_mtime = mtime
+        self.num_docs = sum(s.live_docs for s in self.segments)
+        total_len = sum(s.live_len for s in self.segments)
+        self.avgdl = total_len / self.num_docs if self.num_docs else 0.0
+        return True
+
+    def __len__(self):
+        return self.num_docs
+
+    def search(self, query: str, k: int = 3, clauses=None, pages=None) -> List[Tuple[str, float]]:
+        """
+        Top-k (chunk_id, score) by Okapi BM25.
+        clauses / pages restrict the search to matching chunks (see chunk_store.row_ranges
+        and page_mask): postings are cut to the matching documents' row ranges, so the work
+        scales with the filtered subset. IDF and length statistics stay corpus-wide.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.num_docs:
+            return []
+
+        segments = self.segments  # snapshot: refresh() may swap the list concurrently
+        postings = [[seg.postings(t) for t in terms] for seg in segments]
+        df = np.array([sum(len(p[i][0]) for p in postings) for i in range(len(terms))], dtype=np.float64)
+        idf = np.log(1.0 + (self.num_docs - df + 0.5) / (df + 0.5))
+        filtered = bool(clauses) or (pages is not None and pages != (None, None))
+
+        hits = []  # (score, segment index, row)
+        for si, seg in enumerate(segments):
+            ranges = None
+            if filtered:
+                if seg.columns is None:
+                    continue  # no metadata to filter on (re-added by open_or_build)
+                ranges = seg.columns.row_ranges(clauses or ())
+                if not len(ranges[0]):
+                    continue
+            rows_parts, contrib_parts = [], []
+            for ti, (rows, tf) in enumerate(postings[si]):
+                if ranges is not None:
+                    rows, tf = _restrict(rows, tf, *ranges)
+                    if pages is not None and len(rows):
+                        keep = seg.columns.page_mask(rows, *pages)
+                        rows, tf = rows[keep], tf[keep]
+                if not len(rows):
+                    continue
+                tf = tf.astype(np.float32)
+                dl = seg.doc_len[rows]
+                norm = BM25_K1 * (1.0 - BM25_B + BM25_B * dl / self.avgdl)
+                rows_parts.append(rows)
+                contrib_parts.append(idf[ti] * tf * (BM25_K1 + 1.0) / (tf + norm))
+            if not rows_parts:
+                continue
+            # Accumulate only over rows that contain a query term
+            cand, inverse = np.unique(np.concatenate(rows_parts), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(contrib_parts))
+            live = seg.alive[cand]
+            cand, scores = cand[live], scores[live]
+            if len(cand) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                cand, scores = cand[top], scores[top]
+            hits.extend((float(sc), si, int(r)) for sc, r in zip(scores, cand))
+
+        hits.sort(key=lambda h: h[0], reverse=True)
+        return [
+            (segments[si].chunk_ids[row].decode("utf-8"), score)
+            for score, si, row in hits[:k]
+        ]
+
+    def has_vectors(self) -> bool:
+        """True when every live chunk has a stored vector, i.e. nearest() sees the whole corpus."""
+        return all(seg.columns is not None and seg.columns.vectors is not None
+                   for seg in self.segments if seg.live_docs)
+
+    def nearest(self, vectors, k: int = 3, clauses=None, pages=None) -> List[List[str]]:
+        """
+        Exact dense search: top-k chunk ids by cosine similarity for each query vector,
+        by blocked matmul over the stored (memory-mapped) vectors. clauses / pages
+        filter as in search(); only the matching rows are read. Segments with a
+        quantized copy (DENSE_QUANT) are scanned through it, and their best
+        DENSE_RESCORE * k rows rescored against the full-precision vectors.
+        """
+        queries = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        filtered = bool(clauses) or (pages is not None and pages != (None, None))
+        segments = self.segments
+        best = [[] for _ in range(len(queries))]  # per query: (score, segment index, row)
+        for si, seg in enumerate(segments):
+            columns = seg.columns
+            if columns is None or columns.vectors is None or not seg.live_docs:
+                continue
+            if filtered:
+                rows = range_rows(*columns.row_ranges(clauses or ()))
+                if pages is not None and len(rows):
+                    rows = rows[columns.page_mask(rows, *pages)]
+                rows = rows[seg.alive[rows]]
+            elif seg.live_docs < len(seg.alive):
+                rows = np.flatnonzero(seg.alive)
+            else:
+                rows = None  # every row: contiguous blocks, no gather
+            coarse = columns.quant is not None
+            keep = k * RESCORE_FACTOR if coarse else k
+            found = [[] for _ in range(len(queries))]
+            total = len(seg.alive) if rows is None else len(rows)
+            for start in range(0, total, DENSE_BLOCK_ROWS):
+                end = min(start + DENSE_BLOCK_ROWS, total)
+                block_rows = np.arange(start, end) if rows is None else rows[start:end]
+                scores = columns.scores(slice(start, end) if rows is None else block_rows, queries, coarse)
+                if len(block_rows) > keep:
+                    idx = np.argpartition(-scores, keep - 1, axis=0)[:keep]  # per query, unordered
+                else:
+                    idx = np.repeat(np.arange(len(block_rows))[:, None], len(queries), axis=1)
+                for qi in range(len(queries)):
+                    found[qi].extend(zip(scores[idx[:, qi], qi].tolist(), block_rows[idx[:, qi]].tolist()))
+            for qi, hits in enumerate(found):
+                hits.sort(key=lambda h: h[0], reverse=True)
+                hits = hits[:keep]
+                if coarse and hits:
+                    # Rescore the survivors at full precision (reads only their rows)
+                    cand = np.array(sorted(row for _, row in hits), dtype=np.int64)
+                    exact = columns.scores(cand, queries[qi:qi + 1])[:, 0]
+                    hits = list(zip(exact.tolist(), cand.tolist()))
+                best[qi].extend((score, si, row) for score, row in hits)
+        results = []
+        for hits in best:
+            hits.sort(key=lambda h: h[0], reverse=True)
+            results.append([segments[si].chunk_ids[row].decode("utf-8") for _, si, row in hits[:k]])
+        return results
+
+    def chunks(self, chunk_ids: List[str]) -> Dict[str, Tuple[str, Dict]]:
+        """{chunk_id: (text, metadata)} from the chunk store, for the live chunks it holds.
+        Ids in segments written without the store are left out (callers fall back to Chroma)."""
+        found: Dict[str, Tuple[str, Dict]] = {}
+        if not chunk_ids:
+            return found
+        wanted = np.array([c.encode("utf-8") for c in chunk_ids])
+        for seg in reversed(self.segments):  # a re-ingested chunk lives in the newest segment
+            if seg.columns is None:
+                continue
+            positions, rows = seg.columns.find(wanted)
+            for pos, row in zip(positions, rows):
+                cid = chunk_ids[pos]
+                if cid not in found and seg.alive[row]:
+                    found[cid] = (seg.columns.text(row), seg.columns.metadata(row))
+        return found
+
+    # ---------- writing (single writer: ingestion) ----------
+    def add(self, chunk_ids: List[str], texts: List[str], metadatas: Optional[List[Dict]] = None,
+            vectors=None) -> None:
+        """Index a batch of chunks as a new segment (stored in the chunk store too if metadatas are
+        given, with their embeddings for exact dense search if vectors are)."""
+        if not chunk_ids:
+            return
+        if metadatas is not None:
+            # Keep each document's rows together so filters resolve to a few row ranges
+            first_seen: Dict[str, int] = {}
+            doc_of = [first_seen.setdefault(str(m.get("document_id", m.get("source"))), i) for i, m in enumerate(metadatas)]
+            order = sorted(range(len(chunk_ids)), key=lambda i: doc_of[i])
+            chunk_ids = [chunk_ids[i] for i in order]
+            texts = [texts[i] for i in order]
+            metadatas = [metadatas[i] for i in order]
+            if vectors is not None:
+                vectors = [vectors[i] for i in order]
+        vocab_ids: Dict[str, int] = {}
+        p_term, p_row, p_tf, doc_len = [], [], [], []
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_len.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                p_term.append(vocab_ids.setdefault(term, len(vocab_ids)))
+                p_row.append(row)
+                p_tf.append(tf)
+
+        # Re-number terms so term indices follow sorted vocabulary order
+        vocab = np.array(list(vocab_ids) or [""])
+        order = np.argsort(vocab)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        with self._writer() as state:
+            name = f"seg_{state['next_segment']:06d}"
+            _write_segment(
+                self.path / name,
+                vocab[order],
+                rank[np.asarray(p_term, dtype=np.int64)],
+                np.asarray(p_row, dtype=np.int64),
+                np.asarray(p_tf, dtype=np.int64),
+                np.asarray(doc_len, dtype=np.int32),
+                np.array([c.encode("utf-8") for c in chunk_ids]),
+                texts=texts if metadatas is not None else None,
+                metadatas=metadatas,
+                vectors=vectors if metadatas is not None else None,
+            )
+            state["next_segment"] += 1
+            state["segments"].append(name)
+        self.maybe_compact()
+
+    def delete(self, chunk_ids: List[str]) -> int:
+        """Tombstone the live rows holding these chunk ids. Returns the number of rows deleted."""
+        if not chunk_ids:
+            return 0
+        wanted = np.array([c.encode("utf-8") for c in chunk_ids])
+        removed = 0
+        with self._writer() as state:
+            for seg in self.segments:
+                rows = np.nonzero(np.isin(seg.chunk_ids, wanted) & seg.alive)[0]
+                if rows.size:
+                    dead = state["deleted"].setdefault(seg.name, [])
+                    dead.extend(int(r) for r in rows)
+                    removed += int(rows.size)
+        return removed
+
+    def maybe_compact(self) -> bool:
+        dead = sum(len(s.alive) - s.live_docs for s in self.segments)
+        total = sum(len(s.alive) for s in self.segments)
+        if len(self.segments) <= MAX_SEGMENTS and dead <= 0.2 * max(total, 1):
+            return False
+        self.compact()
+        return True
+
+    def compact(self) -> None:
+        """Merge all segments into one, dropping tombstoned rows."""
+        with self._writer() as state:
+            segments = self.segments
+            if not segments:
+                return
+            vocab = np.unique(np.concatenate([np.asarray(s.terms) for s in segments]))
+            p_term, p_row, p_tf, doc_len, chunk_ids = [], [], [], [], []
+            # The store survives compaction only if every segment has it (older ones fall back to Chroma)
+            keep_store = all(seg.columns is not None for seg in segments if seg.live_docs)
+            texts, metadatas = ([], []) if keep_store else (None, None)
+            keep_vectors = keep_store and all(seg.columns.vectors is not None for seg in segments if seg.live_docs)
+            vectors = [] if keep_vectors else None
+            row_base = 0
+            for seg in segments:
+                new_row = np.cumsum(seg.alive) - 1 + row_base
+                term_idx = np.searchsorted(vocab, np.asarray(seg.terms))
+                seg_terms = np.repeat(term_idx, np.diff(seg.term_offsets))
+                rows = np.asarray(seg.post_rows)
+                keep = seg.alive[rows]
+                p_term.append(seg_terms[keep])
+                p_row.append(new_row[rows[keep]])
+                p_tf.append(np.asarray(seg.post_tf)[keep])
+                doc_len.append(np.asarray(seg.doc_len)[seg.alive])
+                chunk_ids.append(np.asarray(seg.chunk_ids)[seg.alive])
+                if keep_store and seg.live_docs:
+                    for text, meta in seg.columns.iter_rows(np.nonzero(seg.alive)[0]):
+                        texts.append(text)
+                        metadatas.append(meta)
+                    if keep_vectors:
+                        vectors.append(np.asarray(seg.columns.vectors)[seg.alive])
+                row_base += seg.live_docs
+            name = f"seg_{state['next_segment']:06d}"
+            _write_segment(
+                self.path / name, vocab,
+                np.concatenate(p_term), np.concatenate(p_row), np.concatenate(p_tf),
+                np.concatenate(doc_len), np.concatenate(chunk_ids),
+                texts=texts, metadatas=metadatas,
+                vectors=np.concatenate(vectors) if vectors else None,
+            )
+            old = list(state["segments"])
+            state["next_segment"] += 1
+            state["segments"] = [name]
+            state["deleted"] = {}
+        # Readers that still map the old files keep working; unlinked data is freed on close
+        for old_name in old:
+            shutil.rmtree(self.path / old_name, ignore_errors=True)
+        logging.info(f"Compacted BM25 index: {len(old)} segment(s) -> 1 ({self.num_docs} chunks)")
+
+    @contextlib.contextmanager
+    def _writer(self):
+        """Exclusive lock + fresh state; the state is saved and segments reloaded on exit."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / ".lock", "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.refresh(force=True)
+                state = _load_state(self.path)
+                yield state
+                _save_state(self.path, state)
+                self.refresh(force=True)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _load_state(path: Path) -> Dict:
+    with open(path / STATE_NAME, "r", encoding="utf-8") as f:
+        state = json.load(f)
+    state.setdefault("deleted", {})
+    return state
+
+
+def _save_state(path: Path, state: Dict) -> None:
+    tmp = path / (STATE_NAME + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, path / STATE_NAME)
+
+
+def open_or_build(persist_directory: str, collection) -> BM25Index:
+    """
+    Open the index for ingestion, which holds ingest_lock: build it once from the Chroma
+    collection if this database predates it, and bring older segments up to date
+    (chunk store and vectors, the DENSE_QUANT copy). Readers use BM25Index.open().
+    """
+    index = BM25Index.open(persist_directory)
+    if index is not None:
+        _backfill_store(index, collection)
+        if VECTOR_QUANT in QUANT_FILES and any(
+            seg.live_docs and seg.columns.quant is None for seg in index.segments
+        ):
+            logging.info(f"Writing the {VECTOR_QUANT} vector copy (one-time compaction)...")
+            index.compact()  # rewrites every segment, quantized copy included
+        return index
+    logging.info("No BM25 index on disk yet, building it once from ChromaDB...")
+    index = BM25Index.create(persist_directory)
+    data = collection.get(include=["documents", "metadatas", "embeddings"])
+    index.add(data["ids"], data["documents"], [m or {} for m in data["metadatas"]], data["embeddings"])
+    return index
+
+
+def needs_upgrade(persist_directory: str) -> bool:
+    """True when the next ingestion run has work in open_or_build(): no index yet, segments
+    written before the chunk store kept vectors, or a DENSE_QUANT copy still missing."""
+    index = BM25Index.open(persist_directory)
+    if index is None:
+        return True
+    for seg in index.segments:
+        if not seg.live_docs:
+            continue
+        if seg.columns is None or seg.columns.vectors is None:
+            return True
+        if VECTOR_QUANT in QUANT_FILES and seg.columns.quant is None:
+            return True
+    return False
+
+
+def _backfill_store(index: BM25Index, collection) -> None:
+    """Re-add the live rows of segments written before the chunk store (or before it kept
+    vectors), with their texts, metadata and embeddings."""
+    old = [seg for seg in index.segments
+           if seg.live_docs and (seg.columns is None or seg.columns.vectors is None)]
+    if not old:
+        return
+    ids = [cid.decode("utf-8") for seg in old for cid in np.asarray(seg.chunk_ids)[seg.alive]]
+    logging.info(f"Adding {len(ids)} chunks to the chunk store (one-time upgrade)...")
+    data = collection.get(ids=ids, include=["documents", "metadatas", "embeddings"])
+    index.delete(ids)
+    index.add(data["ids"], data["documents"], [m or {} for m in data["metadatas"]], data["embeddings"])
@@ -1,162 +1,132 @@
 import os
-import io
-import re
+import sys
+import json
 import uuid
+import signal
 import logging
-import concurrent.futures
+import subprocess
+from collections import deque
 from datetime import datetime
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import Iterator, List, Tuple, Optional
 
-import fitz  # PyMuPDF
-from PIL import Image
 import torch
 
 from dotenv import load_dotenv
 load_dotenv(override=True)
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
 
+from ingest_manifest import plan_ingestion, load_manifest, save_manifest, file_entry, ingest_lock
+from bm25_index import needs_upgrade, open_or_build
+from embedding_cache import CachedEmbeddings
+from model_loader import EMBEDDING_MODEL, load_embeddings
+import pdf_extract
+from pdf_extract import iter_pages
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
-# ---------------- Local OCR config ----------------
-# Choose OCR engine via env:
-#   OCR_BACKEND=tesseract|paddle (default: tesseract)
-#   OCR_DPI=220 (render DPI for scanned pages)
-#   OCR_LANG=eng (Tesseract languages, e.g., "eng+deu")
-#   PADDLE_LANG=en (PaddleOCR language code)
-#   PADDLE_USE_ANGLE=1|0 (angle classification)
-OCR_BACKEND = os.getenv("OCR_BACKEND", "tesseract").strip().lower()
-OCR_DPI = int(os.getenv("OCR_DPI", "220"))
-OCR_LANG = os.getenv("OCR_LANG", "eng")
-PADDLE_LANG = os.getenv("PADDLE_LANG", "en")
-PADDLE_USE_ANGLE = bool(int(os.getenv("PADDLE_USE_ANGLE", "1")))
-
-# Try import OCR backends
-_has_pytesseract = False
-_has_paddle = False
-try:
-    import pytesseract
-    _has_pytesseract = True
-except Exception:
-    logging.info("pytesseract not available — install it for Tesseract OCR.")
-
-try:
-    from paddleocr import PaddleOCR
-    _has_paddle = True
-except Exception:
-    if OCR_BACKEND == "paddle":
-        logging.info("PaddleOCR not available — `pip install paddleocr paddlepaddle` for Paddle OCR.")
-
-# ---------------- Helpers ----------------
-def normalize_ws(text: str) -> str:
-    text = re.sub(r"[ \t\u00A0]+", " ", text)
-    text = re.sub(r"\n{3,}", "\n\n", text)
-    return text.strip()
-
-def render_page_png(page: fitz.Page, dpi: int = OCR_DPI) -> bytes:
-    zoom = dpi / 72.0
-    mat = fitz.Matrix(zoom, zoom)
-    pix = page.get_pixmap(matrix=mat, alpha=False)
-    return pix.tobytes("png")
-
-# ---------------- OCR backends ----------------
-_paddle_ocr: Optional["PaddleOCR"] = None
-
-def _ensure_paddle():
-    global _paddle_ocr
-    if _paddle_ocr is None and _has_paddle:
-        logging.info(f"Initializing PaddleOCR(lang={PADDLE_LANG}, angle_cls={PADDLE_USE_ANGLE})")
-        _paddle_ocr = PaddleOCR(use_angle_cls=PADDLE_USE_ANGLE, lang=PADDLE_LANG, show_log=False)
-    return _paddle_ocr
-
-def ocr_with_tesseract(img_bytes: bytes) -> str:
-    if not _has_pytesseract:
-        return ""
-    try:
-        img = Image.open(io.BytesIO(img_bytes))
-        txt = pytesseract.image_to_string(img, lang=OCR_LANG)
-        return normalize_ws(txt or "")
-    except Exception as e:
-        logging.warning(f"Tesseract OCR failed: {e}")
-        return ""
+# OCR backend / DPI / language settings: see pdf_extract.py
+#   INGEST_WORKERS=<n> (processes extracting/OCRing pages, 1 = in-process; default the CPU
+#                      count for `python chromadbpdf.py`, a quarter of it inside the API,
+#                      which keeps answering questions meanwhile)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0")) or os.cpu_count() or 1
+API_INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0")) or max(1, (os.cpu_count() or 1) // 4)
+
+# ---------------- Embedding / storage config ----------------
+#   EMBED_BATCH_SIZE=64 (chunks embedded and upserted per batch)
+#   EMBED_THREADS=<n> (torch intra-op threads for `python chromadbpdf.py`; default torch's
+#                      choice. Not applied inside the API, where the setting is process-wide)
+#   INGEST_CHECKPOINT_CHUNKS=2000 (chunks per BM25 segment / manifest checkpoint)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0"))
+CHECKPOINT_CHUNKS = int(os.getenv("INGEST_CHECKPOINT_CHUNKS", "2000"))
+
+# HNSW index of the Chroma collection. Applied when the collection is created: an
+# existing academic_db keeps its settings until it is deleted and re-ingested.
+#   HNSW_SPACE=cosine, HNSW_M=16 (graph degree), HNSW_EF_CONSTRUCTION=100,
+#   HNSW_EF_SEARCH=64 (candidate list at query time: higher = better recall, slower)
+HNSW_METADATA = {
+    "hnsw:space": os.getenv("HNSW_SPACE", "cosine"),
+    "hnsw:M": int(os.getenv("HNSW_M", "16")),
+    "hnsw:construction_ef": int(os.getenv("HNSW_EF_CONSTRUCTION", "100")),
+    "hnsw:search_ef": int(os.getenv("HNSW_EF_SEARCH", "64")),
+}
 
-def ocr_with_paddle(img_bytes: bytes) -> str:
-    if not _has_paddle:
-        return ""
-    try:
-        import numpy as np
-        ocr_engine = _ensure_paddle()
-        if ocr_engine is None:
-            return ""
-        img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-        arr = np.array(img)
-        result = ocr_engine.ocr(arr, cls=PADDLE_USE_ANGLE)
-        lines = []
-        if result:
-            for page in result:
-                if not page:
-                    continue
-                for line in page:
-                    if len(line) >= 2 and line[1]:
-                        lines.append(line[1][0])
-        return normalize_ws("\n".join(lines))
-    except Exception as e:
-        logging.warning(f"PaddleOCR failed: {e}")
-        return ""
+# ---------------- Extraction ----------------
+def iter_extracted_pages(pdf_paths: List[str], workers: int = None) -> Iterator[Tuple[str, int, str, bool]]:
+    """
+    Extract pages of many PDFs (pdf_extract.py). Yields (pdf_path, page_number, text, ocr_used)
+    in document/page order. With workers > 1 the page pool runs in a pdf_extract.py helper
+    process, whose workers import only that module (not this one, nor the API).
+    """
+    workers = workers or INGEST_WORKERS
+    if workers <= 1:
+        yield from iter_pages(pdf_paths, workers=1)
+        return
 
-def ocr_png_locally(img_bytes: bytes) -> str:
-    """Try requested backend first, then fall back to the other if available."""
-    if OCR_BACKEND == "paddle":
-        text = ocr_with_paddle(img_bytes)
-        if text:
-            return text
-        return ocr_with_tesseract(img_bytes)
-    else:
-        text = ocr_with_tesseract(img_bytes)
+    read_fd, write_fd = os.pipe()  # results; the helper's stdout/stderr stay the log
+    helper = subprocess.Popen([sys.executable, pdf_extract.__file__], stdin=subprocess.PIPE,
+                              pass_fds=(write_fd,), encoding="utf-8", start_new_session=True)
+    os.close(write_fd)
+    try:
+        json.dump({"paths": list(pdf_paths), "workers": workers, "fd": write_fd}, helper.stdin)
+        helper.stdin.close()
+        with os.fdopen(read_fd, "r", encoding="utf-8") as results:
+            for line in results:
+                path, page_num, text, ocr_used = json.loads(line)
+                yield path, page_num, text, ocr_used
+        if helper.wait() != 0:
+            raise RuntimeError(f"Page extraction helper exited with status {helper.returncode}")
+    finally:
+        if helper.poll() is None:
+            os.killpg(helper.pid, signal.SIGKILL)  # its pool processes too
+            helper.wait()
+
+
+def iter_extracted_files(pdf_dir: str, pdf_files: List[str], workers: int = None) -> Iterator[Tuple[str, List[Tuple[int, str]]]]:
+    """Group the ordered page stream back into (pdf_file, [(page_number, text)]) per file."""
+    paths = [os.path.join(pdf_dir, f) for f in pdf_files]
+    pages_by_path = {path: [] for path in paths}
+    pending = iter(paths)
+    next_path = next(pending, None)
+    for path, page_num, text, _ in iter_extracted_pages(paths, workers=workers):
+        # Pages arrive in file order: every file before `path` is complete
+        while next_path is not None and next_path != path:
+            yield os.path.basename(next_path), pages_by_path.pop(next_path)
+            next_path = next(pending, None)
         if text:
-            return text
-        return ocr_with_paddle(img_bytes)
+            pages_by_path[path].append((page_num, text))
+    while next_path is not None:
+        yield os.path.basename(next_path), pages_by_path.pop(next_path)
+        next_path = next(pending, None)
 
-# ---------------- Extraction ----------------
 def extract_text_from_pdf(pdf_path: str) -> List[Tuple[int, str]]:
     """
-    Extract text from a PDF, page by page.
-    - Uses PyMuPDF text first.
-    - Falls back to LOCAL OCR if the page text is empty/very short (scanned).
+    Extract text from a PDF, page by page (in this process).
+    Returns [(page_number, text)] for pages with any text.
     """
     try:
-        doc = fitz.open(pdf_path)
-        text_pages = []
-        for page_num, page in enumerate(doc, start=1):
-            text = (page.get_text("text") or "").strip()
-
-            # If likely scanned / low text, try OCR
-            if len(text) < 25:
-                try:
-                    img_bytes = render_page_png(page, dpi=OCR_DPI)
-                    ocr_text = ocr_png_locally(img_bytes)
-                    if len(ocr_text) > len(text):
-                        text = ocr_text
-                except Exception as e:
-                    logging.warning(f"OCR fallback failed for page {page_num} in {pdf_path}: {e}")
-
-            if text.strip():
-                text_pages.append((page_num, text.strip()))
-        doc.close()
-        return text_pages
+        return [
+            (page_num, text)
+            for _, page_num, text, _ in iter_extracted_pages([pdf_path], workers=1)
+            if text
+        ]
     except Exception as e:
         logging.error(f"Error extracting text from {pdf_path}: {e}")
         return []
 
-def process_pdf(pdf_file: str, pdf_dir: str, text_splitter: RecursiveCharacterTextSplitter):
+def process_pdf(pdf_file: str, pdf_dir: str, text_splitter: RecursiveCharacterTextSplitter,
+                pages: Optional[List[Tuple[int, str]]] = None, course: Optional[str] = None):
     """
     Extract and split PDF text into chunks. Adds richer metadata and stable IDs.
+    Pass already-extracted [(page_number, text)] as `pages` to skip extraction.
+    course: stored as the chunks' `subject` (what the API's course filter matches); "General" if None.
     """
     full_path = os.path.join(pdf_dir, pdf_file)
-    pages = extract_text_from_pdf(full_path)
+    if pages is None:
+        pages = extract_text_from_pdf(full_path)
 
     # stable per-file document_id based on file path URI
     try:
@@ -180,7 +150,7 @@ def process_pdf(pdf_file: str, pdf_dir: str, text_splitter: RecursiveCharacterTe
                 "chunk_id": i,
                 "document_id": document_id,
                 "document_type": "Academic Document",
-                "subject": "General",
+                "subject": course or "General",
                 "upload_date": upload_date,
                 "content_type": (
                     "lecture_notes" if "lecture" in pdf_file.lower()
@@ -193,7 +163,21 @@ def process_pdf(pdf_file: str, pdf_dir: str, text_splitter: RecursiveCharacterTe
 
     return chunks, metadata_list, ids, document_id
 
-def process_all_pdfs():
+def process_all_pdfs(progress=None, embedding_model=None, only=None, courses=None, workers=None):
+    """
+    Bring academic_db in line with university_documents. Returns a summary dict
+    (files processed/removed, chunks stored), or None if there was nothing to read.
+    progress: optional callable receiving keyword updates (files_total, files_done,
+              pages_done, chunks_stored, files_removed) as the run advances.
+    embedding_model: an already-loaded Embeddings model to reuse (the API passes its own).
+    only: file names to ingest (e.g. an upload); other new, changed or deleted files
+          are left for the next full run.
+    courses: {file name: course} for new uploads; a re-ingested file keeps the course
+             its manifest entry recorded.
+    workers: page extraction processes (default INGEST_WORKERS).
+    """
+    report = progress or (lambda **fields: None)
+
     # Config
     pdf_dir = "university_documents"
     persist_directory = "./academic_db"
@@ -207,16 +191,31 @@ def process_all_pdfs():
     if not pdf_files:
         logging.error("No PDF files found!")
         return
-    logging.info(f"Found {len(pdf_files)} PDF files to process.")
+    logging.info(f"Found {len(pdf_files)} PDF files.")
+
+    # Only new/changed files are embedded; deleted files have their chunks removed
+    to_process, to_remove, manifest = plan_ingestion(pdf_dir, persist_directory, only=only)
+    if not to_process and not to_remove:
+        # Persist refreshed mtimes (touched but identical files) so they aren't re-hashed
+        # on every start; only when something changed, as a rewrite clears the answer cache
+        if manifest != load_manifest(persist_directory):
+            save_manifest(persist_directory, manifest)
+        if not needs_upgrade(persist_directory):
+            logging.info("Ingestion manifest is up to date. Nothing to embed.")
+            return {"files_processed": 0, "files_removed": 0, "chunks_stored": 0}
+        logging.info("Nothing to embed, but the BM25 index / chunk store needs an upgrade.")
+    logging.info(f"{len(to_process)} new/changed and {len(to_remove)} deleted PDF(s) since last ingestion.")
+    report(files_total=len(to_process), files_removed=len(to_remove))
 
     # Device
     device = "cuda" if torch.cuda.is_available() else "cpu"
     logging.info(f"Using device: {device}")
 
-    # Embeddings (local)
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2",
-        model_kwargs={"device": device},
+    # Embeddings (local), behind the content-hash cache: unchanged chunks are never re-encoded
+    embeddings = CachedEmbeddings(
+        embedding_model or load_embeddings(device=device, batch_size=EMBED_BATCH_SIZE),
+        persist_directory,
+        model_name=EMBEDDING_MODEL,
     )
     logging.info("Academic embedding model loaded successfully.")
 
@@ -232,37 +231,96 @@ def process_all_pdfs():
         persist_directory=persist_directory,
         embedding_function=embeddings,
         collection_name=collection_name,
+        collection_metadata=HNSW_METADATA,
     )
 
-    # Collect all chunks
-    all_chunks, all_metadatas, all_ids = [], [], []
-
-    def _work(pdf):
-        return process_pdf(pdf, pdf_dir, text_splitter)
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results = executor.map(_work, pdf_files)
-        for pdf_file, (chunks, metadatas, ids, document_id) in zip(pdf_files, results):
-            if not chunks:
-                logging.warning(f"Skipping empty PDF (no extractable text): {pdf_file}")
-                continue
-            all_chunks.extend(chunks)
-            all_metadatas.extend(metadatas)
-            all_ids.extend(ids)
+    # Drop chunks of deleted and replaced files before re-adding
+    stale_ids = []
+    for pdf_file in to_remove + to_process:
+        entry = manifest["files"].get(pdf_file)
+        if entry:
+            stale_ids.extend(entry.get("chunk_ids", []))
+    bm25 = open_or_build(persist_directory, vector_db._collection)  # callers hold ingest_lock
+    if stale_ids:
+        logging.info(f"Removing {len(stale_ids)} stale chunks from ChromaDB and the BM25 index...")
+        vector_db.delete(ids=stale_ids)
+        bm25.delete(stale_ids)
+    for pdf_file in to_remove:
+        manifest["files"].pop(pdf_file, None)
+
+    # Stream chunks -> fixed-size embedding batches -> upsert each batch right away.
+    # A file is checkpointed (BM25 segment + manifest entry) once all its chunks are
+    # stored, so an interrupted run resumes at the first unfinished file.
+    state = {"embedded": 0, "queued": 0, "files": 0, "pages": 0}
+    batch_ids, batch_texts, batch_metas = [], [], []
+    waiting = deque()  # (pdf_file, entry, ids, texts, metas, last_seq) not fully upserted yet
+    done_ids, done_texts, done_metas, done_entries = [], [], [], {}
+    vectors_by_id = {}  # stored vectors of chunks not checkpointed yet (for the chunk store)
+
+    def checkpoint():
+        if done_ids:
+            bm25.delete(done_ids)  # idempotent if a previous run died after its BM25 write
+            vectors = [vectors_by_id.pop(cid) for cid in done_ids]
+            bm25.add(done_ids, done_texts, done_metas, vectors)  # postings + chunk store
+        manifest["files"].update(done_entries)
+        save_manifest(persist_directory, manifest)
+        done_ids.clear(); done_texts.clear(); done_metas.clear(); done_entries.clear()
+
+    def upsert_batch():
+        if batch_ids:
+            vectors = embeddings.embed_documents(batch_texts)
+            vector_db._collection.upsert(ids=batch_ids, embeddings=vectors, documents=batch_texts, metadatas=batch_metas)
+            vectors_by_id.update(zip(batch_ids, vectors))
+            state["embedded"] += len(batch_ids)
+            logging.info(f"Embedded and stored {state['embedded']}/{state['queued']} chunks so far")
+            report(chunks_stored=state["embedded"])
+            batch_ids.clear(); batch_texts.clear(); batch_metas.clear()
+        release_done()
+
+    def release_done():
+        while waiting and waiting[0][-1] <= state["embedded"]:
+            pdf_file, entry, ids, texts, metas, _ = waiting.popleft()
+            done_entries[pdf_file] = entry
+            done_ids.extend(ids)
+            done_texts.extend(texts)
+            done_metas.extend(metas)
+        if len(done_ids) >= CHECKPOINT_CHUNKS:
+            checkpoint()
+
+    previous_courses = {name: entry.get("course") for name, entry in manifest["files"].items()}
+    for pdf_file, pages in iter_extracted_files(pdf_dir, to_process, workers=workers):
+        course = (courses or {}).get(pdf_file) or previous_courses.get(pdf_file)
+        chunks, metadatas, ids, document_id = process_pdf(pdf_file, pdf_dir, text_splitter, pages=pages, course=course)
+        # Recorded even when empty so unreadable scans aren't retried on every start
+        entry = file_entry(os.path.join(pdf_dir, pdf_file), document_id, ids, course=course)
+        if not chunks:
+            logging.warning(f"Skipping empty PDF (no extractable text): {pdf_file}")
+        else:
             logging.info(f"Prepared {len(chunks)} chunks from {pdf_file} (document_id={document_id}).")
-
-    if not all_chunks:
-        logging.info("No chunks to add. Exiting.")
-        return
-
-    logging.info(f"Adding {len(all_chunks)} chunks to ChromaDB (this embeds; may take a while)...")
-    vector_db.add_texts(texts=all_chunks, metadatas=all_metadatas, ids=all_ids)
+        state["queued"] += len(chunks)
+        waiting.append((pdf_file, entry, ids, chunks, metadatas, state["queued"]))
+        for chunk, meta, cid in zip(chunks, metadatas, ids):
+            batch_ids.append(cid); batch_texts.append(chunk); batch_metas.append(meta)
+            if len(batch_ids) >= EMBED_BATCH_SIZE:
+                upsert_batch()
+        release_done()  # files whose chunks are all stored (or that had none)
+        state["files"] += 1
+        state["pages"] += len(pages)
+        report(files_done=state["files"], pages_done=state["pages"])
+
+    upsert_batch()
+    checkpoint()
+    logging.info(f"Embedding cache: {embeddings.hits} chunks reused, {embeddings.misses} newly encoded.")
 
     try:
         collection_size = vector_db._collection.count()
     except Exception:
         collection_size = "unknown"
     logging.info(f"Finished processing. Total chunks in ChromaDB: {collection_size}")
+    return {"files_processed": state["files"], "files_removed": len(to_remove), "chunks_stored": state["embedded"]}
 
 if __name__ == "__main__":
-    process_all_pdfs()
\ No newline at end of file
+    if EMBED_THREADS:
+        torch.set_num_threads(EMBED_THREADS)
+    with ingest_lock("./academic_db"):
+        process_all_pdfs()
\ No newline at end of file
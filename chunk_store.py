@@ -0,0 +1,235 @@
+import os
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Columnar chunk store: the texts and metadata of the chunks in one BM25 segment.
+# bm25_index.py writes these files next to the postings, so rows, tombstones and
+# compaction are shared with the index. Per segment directory:
+#   texts.bin          UTF-8 chunk texts, back to back
+#   text_offsets.npy   int64, the text of row i is texts.bin[offsets[i]:offsets[i+1]]
+#   page.npy           int32 page_number per row (-1: absent)
+#   chunk_no.npy       int32 chunk_id (chunk number within its page) per row (-1: absent)
+#   doc_idx.npy        int32, row -> entry of documents.json
+#   documents.json     all other metadata fields, stored once per distinct document
+#   id_order.npy       int32 argsort of the segment's chunk ids, for lookups by id
+#   vectors.npy        unit-length embeddings per row, for exact dense search (optional)
+#   vectors_int8.npy   int8 copy of vectors.npy + vector_scale.npy (float32 per row), or
+#   vectors_bits.npy   1-bit (sign) copy, packed 8 dimensions per byte (DENSE_QUANT)
+# Everything but documents.json is memory-mapped; metadata dicts and Documents are
+# built only for the rows a query returns.
+#
+# Rows of one document are written next to each other, so a metadata filter resolves
+# to a few [start, end) row ranges (row_ranges) that search can restrict postings to.
+
+#   DENSE_QUANT=none|int8|binary  also write a quantized copy (4x / 32x smaller than float32)
+#                                 and scan it instead; the best candidates are rescored
+#                                 against vectors.npy, so only the small copy needs to stay
+#                                 in RAM. Read at ingestion (write) and at open (search).
+#   DENSE_DTYPE=float32|float16   storage type of vectors.npy (float16 halves its size;
+#                                 search converts blocks to float32 for the matmul). Default
+#                                 float16 with DENSE_QUANT, where it is only read to rescore.
+#   DENSE_RESCORE=<n>             candidates rescored per result (default 4 int8, 32 binary)
+ROW_FIELDS = {"page_number": "page.npy", "chunk_id": "chunk_no.npy"}
+QUANT_FILES = {"int8": ("vectors_int8.npy", "vector_scale.npy"), "binary": ("vectors_bits.npy",)}
+VECTOR_QUANT = os.getenv("DENSE_QUANT", "none").strip().lower()
+VECTOR_DTYPE = np.dtype(os.getenv("DENSE_DTYPE") or ("float16" if VECTOR_QUANT in QUANT_FILES else "float32"))
+DEFAULT_RESCORE = {"int8": 4, "binary": 32}
+RESCORE_FACTOR = int(os.getenv("DENSE_RESCORE", "0")) or DEFAULT_RESCORE.get(VECTOR_QUANT, 1)
+
+_INT8_STEP = 1024  # int8 rows widened per matmul, into a float32 buffer that stays in cache
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def quantize(matrix: np.ndarray, mode: str) -> Tuple[np.ndarray, ...]:
+    """Quantized copy of unit-length float vectors: (int8 codes, per-row scale) or (sign bits,)."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if mode == "int8":
+        scale = np.maximum(np.abs(matrix).max(axis=1), 1e-12) / 127.0
+        codes = np.rint(matrix / scale[:, None]).astype(np.int8)
+        return codes, scale.astype(np.float32)
+    if mode == "binary":
+        return (np.packbits(matrix > 0, axis=1),)
+    raise ValueError(f"Unknown DENSE_QUANT mode: {mode}")
+
+
+def _hamming(bits: np.ndarray, query_bits: np.ndarray) -> np.ndarray:
+    """Differing bits between each row of `bits` and one packed query."""
+    diff = np.bitwise_xor(bits, query_bits)
+    counts = np.bitwise_count(diff) if hasattr(np, "bitwise_count") else _POPCOUNT[diff]
+    return counts.sum(axis=1, dtype=np.int32)
+
+
+def quantized_scores(parts: Sequence[np.ndarray], mode: str, queries: np.ndarray) -> np.ndarray:
+    """(rows, queries) similarity estimate from quantize() output for some rows:
+    approximate cosine for int8, minus the Hamming distance of the signs for binary."""
+    if mode == "int8":
+        # NumPy has no int8 GEMM: widen a cache-sized slice at a time into one reused buffer
+        # (no float32 copy of the whole block) and let BLAS do the float32 matmul
+        codes, scale = parts
+        queries = np.asarray(queries, dtype=np.float32)
+        out = np.empty((len(codes), len(queries)), dtype=np.float32)
+        buf = np.empty((min(_INT8_STEP, len(codes)), codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(codes), _INT8_STEP):
+            part = codes[start:start + _INT8_STEP]
+            np.copyto(buf[:len(part)], part)
+            np.matmul(buf[:len(part)], queries.T, out=out[start:start + len(part)])
+        out *= np.asarray(scale)[:, None]
+        return out
+    packed = np.packbits(queries > 0, axis=1)
+    return -np.stack([_hamming(parts[0], q) for q in packed], axis=1).astype(np.float32)
+
+
+def write_columns(path: Path, chunk_ids: np.ndarray, texts: Sequence[str], metadatas: Sequence[Dict],
+                  vectors=None) -> None:
+    """Write the store for rows aligned with chunk_ids (fixed-width bytes) into a segment directory."""
+    encoded = [(t or "").encode("utf-8") for t in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    with open(path / "texts.bin", "wb") as f:
+        for b in encoded:
+            f.write(b)
+    np.save(path / "text_offsets.npy", offsets)
+
+    documents, doc_index, doc_idx = [], {}, np.zeros(len(metadatas), dtype=np.int32)
+    for name, filename in ROW_FIELDS.items():
+        column = [m.get(name) for m in metadatas]
+        np.save(path / filename, np.array([v if isinstance(v, int) else -1 for v in column], dtype=np.int32))
+    for row, meta in enumerate(metadatas):
+        shared = {k: v for k, v in meta.items() if k not in ROW_FIELDS}
+        key = json.dumps(shared, sort_keys=True)
+        if key not in doc_index:
+            doc_index[key] = len(documents)
+            documents.append(shared)
+        doc_idx[row] = doc_index[key]
+    np.save(path / "doc_idx.npy", doc_idx)
+    with open(path / "documents.json", "w", encoding="utf-8") as f:
+        json.dump(documents, f)
+    np.save(path / "id_order.npy", np.argsort(chunk_ids, kind="stable").astype(np.int32))
+    if vectors is not None and len(vectors) == len(texts):
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        np.save(path / "vectors.npy", matrix.astype(VECTOR_DTYPE))
+        if VECTOR_QUANT in QUANT_FILES:
+            for filename, array in zip(QUANT_FILES[VECTOR_QUANT], quantize(matrix, VECTOR_QUANT)):
+                np.save(path / filename, array)
+
+
+def range_rows(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Every index of the [start, end) ranges, concatenated (no Python loop)."""
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if not total:
+        return np.zeros(0, dtype=np.int64)
+    return np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(total)
+
+
+class ChunkColumns:
+    """Read side of one segment's store."""
+
+    def __init__(self, path: Path, chunk_ids: np.ndarray):
+        self.chunk_ids = chunk_ids
+        size = (path / "texts.bin").stat().st_size
+        self.texts = np.memmap(path / "texts.bin", dtype=np.uint8, mode="r") if size else np.zeros(0, np.uint8)
+        load = lambda n: np.load(path / n, mmap_mode="r")
+        self.text_offsets = load("text_offsets.npy")
+        self.rows = {name: load(filename) for name, filename in ROW_FIELDS.items()}
+        self.doc_idx = load("doc_idx.npy")
+        self.id_order = load("id_order.npy")
+        self.vectors = load("vectors.npy") if (path / "vectors.npy").exists() else None
+        # Quantized copy, when ingestion wrote one for the configured mode
+        files = QUANT_FILES.get(VECTOR_QUANT, ())
+        self.quant = VECTOR_QUANT if files and all((path / n).exists() for n in files) else None
+        self.quantized = tuple(load(n) for n in files) if self.quant else ()
+        with open(path / "documents.json", "r", encoding="utf-8") as f:
+            self.documents: List[Dict] = json.load(f)
+        self._fields: Dict[str, np.ndarray] = {}
+        self._runs: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+
+    @classmethod
+    def open(cls, path: Path, chunk_ids: np.ndarray) -> Optional["ChunkColumns"]:
+        """None for segments written before the store existed."""
+        if not (path / "documents.json").exists():
+            return None
+        return cls(path, chunk_ids)
+
+    def find(self, wanted: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(positions in wanted, rows) of the ids present in this segment; wanted is bytes."""
+        if not len(self.chunk_ids) or not len(wanted):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        width = self.chunk_ids.dtype.itemsize
+        fits = np.nonzero(np.char.str_len(wanted) <= width)[0]  # longer ids can't be here
+        probe = wanted[fits].astype(self.chunk_ids.dtype)
+        at = np.searchsorted(self.chunk_ids, probe, sorter=self.id_order)
+        at = np.minimum(at, len(self.id_order) - 1)
+        rows = np.asarray(self.id_order[at], dtype=np.int64)
+        hit = self.chunk_ids[rows] == probe
+        return fits[hit], rows[hit]
+
+    def text(self, row: int) -> str:
+        start, end = int(self.text_offsets[row]), int(self.text_offsets[row + 1])
+        return self.texts[start:end].tobytes().decode("utf-8")
+
+    def metadata(self, row: int) -> Dict:
+        meta = dict(self.documents[int(self.doc_idx[row])])
+        for name, column in self.rows.items():
+            value = int(column[row])
+            if value >= 0:
+                meta[name] = value
+        return meta
+
+    def _field(self, name: str) -> np.ndarray:
+        """Per-document values of one metadata field, as strings ("" when absent)."""
+        if name not in self._fields:
+            self._fields[name] = np.array([str(d.get(name, "")) for d in self.documents], dtype=object)
+        return self._fields[name]
+
+    def _doc_runs(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(start, end, document) of each run of consecutive rows from the same document."""
+        if self._runs is None:
+            doc_idx = np.asarray(self.doc_idx)
+            starts = np.flatnonzero(np.diff(doc_idx)) + 1
+            starts = np.concatenate([[0], starts]) if len(doc_idx) else starts
+            ends = np.append(starts[1:], len(doc_idx))
+            self._runs = (starts.astype(np.int64), ends.astype(np.int64), doc_idx[starts])
+        return self._runs
+
+    def row_ranges(self, clauses: Sequence[Tuple[Sequence[str], Sequence[str]]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        [start, end) row ranges of the documents matching every clause, ascending.
+        A clause (fields, values) holds when any of the fields has one of the values.
+        """
+        ok = np.ones(len(self.documents), dtype=bool)
+        for fields, values in clauses:
+            hit = np.zeros(len(self.documents), dtype=bool)
+            for name in fields:
+                hit |= np.isin(self._field(name), list(values))
+            ok &= hit
+        starts, ends, run_doc = self._doc_runs()
+        keep = ok[run_doc]
+        return starts[keep], ends[keep]
+
+    def page_mask(self, rows: np.ndarray, first: Optional[int], last: Optional[int]) -> np.ndarray:
+        """Which rows have a page_number within [first, last] (None: open end)."""
+        pages = np.asarray(self.rows["page_number"][rows])
+        mask = pages >= (first if first is not None else 0)
+        if last is not None:
+            mask &= pages <= last
+        return mask
+
+    def scores(self, block, queries: np.ndarray, coarse: bool = False) -> np.ndarray:
+        """
+        (rows, queries) similarity of a block of rows (slice or row array) to unit-length
+        queries: cosine from vectors.npy, or with coarse=True an estimate from the
+        quantized copy (int8: approximate cosine; binary: minus the Hamming distance).
+        """
+        if coarse and self.quant:
+            return quantized_scores([np.asarray(part[block]) for part in self.quantized], self.quant, queries)
+        return np.asarray(self.vectors[block], dtype=np.float32) @ queries.T
+
+    def iter_rows(self, rows: np.ndarray):
+        """(text, metadata) for each row, e.g. to carry live rows into a compacted segment."""
+        for row in rows:
+            yield self.text(int(row)), self.metadata(int(row))
@@ -0,0 +1,99 @@
+import os
+from typing import Dict, List, Tuple
+
+from langchain_core.documents import Document
+
+# Context budget for the "stuff" prompt, per model:
+#   CONTEXT_TOKEN_BUDGET=1500        general model
+#   CONTEXT_TOKEN_BUDGET_MATH=1000   math model
+#   CONTEXT_CHARS_PER_TOKEN=4        token estimate (no tokenizer dependency)
+CONTEXT_TOKEN_BUDGET = {
+    "general": int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500")),
+    "math": int(os.getenv("CONTEXT_TOKEN_BUDGET_MATH", "1000")),
+}
+CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "4"))
+MIN_PASSAGE_TOKENS = 64  # don't bother truncating a passage to less than this
+
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def _score(doc: Document) -> float:
+    meta = doc.metadata or {}
+    for key in ("rerank_score", "fused_score", "bm25_score"):
+        if meta.get(key) is not None:
+            return float(meta[key])
+    return 0.0
+
+
+def stitch(left: str, right: str, max_overlap: int = 400) -> str:
+    """Join two consecutive chunks, dropping the text they share (splitter overlap)."""
+    limit = min(len(left), len(right), max_overlap)
+    for size in range(limit, 0, -1):
+        if left.endswith(right[:size]):
+            return left + right[size:]
+    return left + "\n" + right
+
+
+def _merge_group(docs: List[Tuple[int, Document]]) -> List[Tuple[int, Document]]:
+    """Merge runs of adjacent chunks (same document and page) into single passages."""
+    docs = sorted(docs, key=lambda item: item[1].metadata.get("chunk_id", 0))
+    merged: List[Tuple[int, Document]] = []
+    last_chunk = None
+    for rank, doc in docs:
+        chunk_no = doc.metadata.get("chunk_id")
+        if merged and chunk_no is not None and last_chunk is not None and chunk_no == last_chunk + 1:
+            prev_rank, prev = merged[-1]
+            meta = dict(prev.metadata)
+            meta["merged_chunks"] = meta.get("merged_chunks", 1) + 1
+            for key in ("rerank_score", "fused_score", "bm25_score"):
+                if doc.metadata.get(key) is not None:
+                    meta[key] = max(meta.get(key, float("-inf")), doc.metadata[key])
+            merged[-1] = (min(prev_rank, rank), Document(page_content=stitch(prev.page_content, doc.page_content), metadata=meta))
+        else:
+            merged.append((rank, doc))
+        last_chunk = chunk_no
+    return merged
+
+
+def pack_context(docs: List[Document], budget_tokens: int) -> List[Document]:
+    """
+    Turn retriever output into the passages that go into the prompt:
+    1. drop exact duplicates and chunks contained in another retrieved chunk
+    2. merge adjacent chunks of the same document/page (removing splitter overlap)
+    3. order passages by score (rerank > fused > bm25), retrieval rank as tie-break
+    4. keep passages until the token budget is spent (truncating the last one)
+    """
+    seen, unique = set(), []
+    for rank, doc in enumerate(docs):
+        text = doc.page_content.strip()
+        if text in seen:
+            continue
+        seen.add(text)
+        unique.append((rank, doc))
+    texts = [d.page_content for _, d in unique]
+    unique = [
+        (rank, doc) for i, (rank, doc) in enumerate(unique)
+        if not any(j != i and doc.page_content in other for j, other in enumerate(texts))
+    ]
+
+    groups: Dict[Tuple, List[Tuple[int, Document]]] = {}
+    for rank, doc in unique:
+        meta = doc.metadata or {}
+        groups.setdefault((meta.get("document_id"), meta.get("page_number")), []).append((rank, doc))
+    passages = [p for group in groups.values() for p in _merge_group(group)]
+    passages.sort(key=lambda item: (-_score(item[1]), item[0]))
+
+    packed, remaining = [], budget_tokens
+    for _, doc in passages:
+        cost = estimate_tokens(doc.page_content)
+        if cost <= remaining:
+            packed.append(doc)
+            remaining -= cost
+            continue
+        if remaining >= MIN_PASSAGE_TOKENS:
+            cut = int(remaining * CHARS_PER_TOKEN)
+            packed.append(Document(page_content=doc.page_content[:cut].rstrip() + " ...", metadata=doc.metadata))
+        break
+    return packed
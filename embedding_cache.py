@@ -0,0 +1,271 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+import contextlib
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from rag_metrics import count_cache, timed_stage
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process writers only
+    fcntl = None
+
+# Persistent embedding cache keyed by (model name, sha256 of normalized text).
+#
+# Layout (inside academic_db/embedding_cache/<model>/):
+#   meta.json     {"model": ..., "dim": ...}
+#   vectors.f32   float32 rows, append-only
+#   keys.bin      32-byte sha256 digests, append-only, row i <-> vector row i
+#
+# Vectors are written before their key, so a torn append is simply ignored on open.
+# Lookups binary-search sorted key prefixes; keys and vectors are memory-mapped. Rows
+# appended by other processes are picked up incrementally (a dict of the new keys),
+# and folded into the sorted prefixes once that tail grows past an eighth of them.
+# Only document chunks are stored; query vectors stay in an in-memory LRU.
+
+CACHE_DIRNAME = "embedding_cache"
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "1024"))
+_KEY_BYTES = 32
+_MIN_TAIL = 4096  # tail rows kept in the dict before re-sorting (at least)
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(model_name: str, text: str) -> bytes:
+    return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).digest()
+
+
+class EmbeddingStore:
+    """Append-only float32 embedding store for one model."""
+
+    def __init__(self, root: str, model_name: str):
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+        self.path = Path(root) / CACHE_DIRNAME / slug
+        self.model_name = model_name
+        self.dim: Optional[int] = None
+        self._lock = threading.Lock()
+        self._pending = {}  # digests appended by this process, not mapped yet
+        self._tail = {}     # digest -> row of rows mapped since the last sort
+        self._keys_size = -1
+        self._load()
+
+    def _load(self):
+        meta = self.path / "meta.json"
+        if meta.exists():
+            with open(meta, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+        keys_file, vec_file = self.path / "keys.bin", self.path / "vectors.f32"
+        if self.dim is None or not keys_file.exists() or not vec_file.exists():
+            rows = 0
+        else:
+            rows = min(keys_file.stat().st_size // _KEY_BYTES, vec_file.stat().st_size // (4 * self.dim))
+        self._keys_size = keys_file.stat().st_size if keys_file.exists() else 0
+        if rows:
+            self._keys = np.memmap(keys_file, dtype=np.uint8, mode="r", shape=(rows, _KEY_BYTES))
+            self._vectors = np.memmap(vec_file, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        else:
+            self._keys = np.zeros((0, _KEY_BYTES), dtype=np.uint8)
+            self._vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+        # Sorted 8-byte key prefixes for binary search; full digests are compared on hit
+        prefixes = np.ascontiguousarray(self._keys[:, :8]).view(">u8").ravel()
+        self._order = np.argsort(prefixes, kind="stable")
+        self._sorted_prefixes = prefixes[self._order]
+        self._pending = {}
+        self._tail = {}
+
+    def __len__(self):
+        return len(self._keys) + len(self._pending)
+
+    def _refresh_if_grown(self):
+        try:
+            size = (self.path / "keys.bin").stat().st_size
+        except OSError:
+            return
+        if size == self._keys_size:
+            return
+        if size < self._keys_size or self.dim is None or not len(self._keys):
+            self._load()  # truncated, or nothing mapped yet
+            return
+        keys_file, vec_file = self.path / "keys.bin", self.path / "vectors.f32"
+        rows = min(size // _KEY_BYTES, vec_file.stat().st_size // (4 * self.dim))
+        start = len(self._keys)
+        self._keys_size = rows * _KEY_BYTES  # a torn key tail is looked at again next time
+        if rows <= start:
+            return
+        # Map the grown files and index only the new rows
+        self._keys = np.memmap(keys_file, dtype=np.uint8, mode="r", shape=(rows, _KEY_BYTES))
+        self._vectors = np.memmap(vec_file, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        for row in range(start, rows):
+            key = self._keys[row].tobytes()
+            self._tail[key] = row
+            self._pending.pop(key, None)
+        if len(self._tail) > max(_MIN_TAIL, len(self._sorted_prefixes) // 8):
+            prefixes = np.ascontiguousarray(self._keys[:, :8]).view(">u8").ravel()
+            self._order = np.argsort(prefixes, kind="stable")
+            self._sorted_prefixes = prefixes[self._order]
+            self._tail = {}
+
+    def get_many(self, keys: List[bytes]) -> List[Optional[np.ndarray]]:
+        with self._lock:
+            out = self._lookup(keys)
+            if any(v is None for v in out):
+                # Another process (ingestion, another worker) may have appended since we opened
+                self._refresh_if_grown()
+                out = [v if v is not None else self._lookup([k])[0] for k, v in zip(keys, out)]
+            return out
+
+    def _lookup(self, keys: List[bytes]) -> List[Optional[np.ndarray]]:
+        out = []
+        for key in keys:
+            vec = self._pending.get(key)
+            row = self._tail.get(key)
+            if vec is None and row is not None:
+                vec = np.asarray(self._vectors[row])
+            if vec is None and len(self._keys):
+                prefix = np.frombuffer(key[:8], dtype=">u8")[0]
+                lo = int(np.searchsorted(self._sorted_prefixes, prefix, side="left"))
+                hi = int(np.searchsorted(self._sorted_prefixes, prefix, side="right"))
+                for j in range(lo, hi):
+                    row = int(self._order[j])
+                    if self._keys[row].tobytes() == key:
+                        vec = np.asarray(self._vectors[row])
+                        break
+            out.append(vec)
+        return out
+
+    def put_many(self, keys: List[bytes], vectors: List[List[float]]) -> None:
+        if not keys:
+            return
+        arr = np.asarray(vectors, dtype=np.float32)
+        with self._lock, self._file_lock():
+            if self.dim is None:
+                self.dim = int(arr.shape[1])
+                with open(self.path / "meta.json", "w", encoding="utf-8") as f:
+                    json.dump({"model": self.model_name, "dim": self.dim}, f)
+            if arr.shape[1] != self.dim:
+                logging.warning(f"Embedding cache dim mismatch ({arr.shape[1]} != {self.dim}); not caching")
+                return
+            self._truncate_torn_rows()
+            with open(self.path / "vectors.f32", "ab") as f:
+                f.write(arr.tobytes())
+            with open(self.path / "keys.bin", "ab") as f:
+                f.write(b"".join(keys))
+            for key, vec in zip(keys, arr):
+                self._pending[key] = vec
+
+    def _truncate_torn_rows(self):
+        """Drop a partially written tail (crash mid-append) so new rows stay aligned."""
+        keys_file, vec_file = self.path / "keys.bin", self.path / "vectors.f32"
+        if not keys_file.exists() or not vec_file.exists():
+            for f in (keys_file, vec_file):
+                open(f, "ab").close()
+        rows = min(keys_file.stat().st_size // _KEY_BYTES, vec_file.stat().st_size // (4 * self.dim))
+        for f, row_bytes in ((keys_file, _KEY_BYTES), (vec_file, 4 * self.dim)):
+            if f.stat().st_size != rows * row_bytes:
+                os.truncate(f, rows * row_bytes)
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / ".lock", "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings model with the persistent store: texts whose normalized
+    content was embedded before (by this model) are never re-encoded. Queries only
+    go through a small in-memory LRU, so user questions never grow the store.
+    embed_queries() batches queries through embed_documents of the wrapped model,
+    which matches embed_query for the sentence-transformers models used here.
+    """
+
+    def __init__(self, inner: Embeddings, persist_directory: str, model_name: str = None):
+        self.inner = inner
+        self.model_name = model_name or getattr(inner, "model_name", type(inner).__name__)
+        self.store = EmbeddingStore(persist_directory, self.model_name)
+        self._queries = OrderedDict()
+        self._queries_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [cache_key(self.model_name, t) for t in texts]
+        found = self.store.get_many(keys)
+        todo = [i for i, vec in enumerate(found) if vec is None]
+        self.hits += len(texts) - len(todo)
+        self.misses += len(todo)
+        count_cache("embedding", hits=len(texts) - len(todo), misses=len(todo))
+        if todo:
+            fresh = self.inner.embed_documents([texts[i] for i in todo])
+            self.store.put_many([keys[i] for i in todo], fresh)
+            for i, vec in zip(todo, fresh):
+                found[i] = vec
+        return [np.asarray(v, dtype=np.float32).tolist() for v in found]
+
+    def embed_query(self, text: str) -> List[float]:
+        with timed_stage("query_embedding"):
+            return self._embed_query(text)
+
+    def _embed_query(self, text: str) -> List[float]:
+        key = cache_key(self.model_name, text)
+        with self._queries_lock:
+            if key in self._queries:
+                self._queries.move_to_end(key)
+                self.hits += 1
+                count_cache("embedding", hits=1)
+                return self._queries[key]
+        self.misses += 1
+        count_cache("embedding", misses=1)
+        vec = np.asarray(self.inner.embed_query(text), dtype=np.float32).tolist()
+        self._remember_queries([key], [vec])
+        return vec
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Batched embed_query: one encoder call for the queries not in the LRU."""
+        keys = [cache_key(self.model_name, t) for t in texts]
+        with self._queries_lock:
+            found = [self._queries.get(key) for key in keys]
+        todo = [i for i, vec in enumerate(found) if vec is None]
+        self.hits += len(texts) - len(todo)
+        self.misses += len(todo)
+        count_cache("embedding", hits=len(texts) - len(todo), misses=len(todo))
+        if todo:
+            fresh = [np.asarray(v, dtype=np.float32).tolist()
+                     for v in self.inner.embed_documents([texts[i] for i in todo])]
+            for i, vec in zip(todo, fresh):
+                found[i] = vec
+            self._remember_queries([keys[i] for i in todo], fresh)
+        return found
+
+    def clear_queries(self):
+        """Forget the query LRU (e.g. before a cold-cache measurement)."""
+        with self._queries_lock:
+            self._queries.clear()
+
+    def _remember_queries(self, keys: List[bytes], vectors: List[List[float]]):
+        with self._queries_lock:
+            for key, vec in zip(keys, vectors):
+                self._queries[key] = vec
+                self._queries.move_to_end(key)
+            while len(self._queries) > QUERY_CACHE_SIZE:
+                self._queries.popitem(last=False)
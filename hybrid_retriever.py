@@ -0,0 +1,228 @@
+import os
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from rag_metrics import timed_stage
+
+# Hybrid (BM25 + dense) retrieval with weighted reciprocal rank fusion.
+#
+# Both searches return chunk ids only; they run concurrently (BM25 on a small
+# thread pool, dense in the calling thread), ranks are fused with NumPy, and
+# Documents are built for the winners only, from the chunk store (chunk_store.py).
+#
+#   HYBRID_WEIGHTS=0.5,0.5   default (sparse, dense) fusion weights
+#   HYBRID_RRF_C=60          RRF constant: weight / (c + rank)
+#   HYBRID_THREADS=8         threads for the sparse side
+#
+# Dense side: Chroma's HNSW index, or an exact cosine matmul over the vectors kept in
+# the chunk store (BM25Index.nearest), which is both exact and faster on small corpora
+# (with DENSE_QUANT, a scan of the int8/binary copy plus full-precision rescoring).
+#   DENSE_SEARCH=auto|exact|hnsw   auto: exact while the corpus has <= DENSE_EXACT_MAX chunks
+#   DENSE_EXACT_MAX=100000         the same with DENSE_QUANT: the quantized copies save memory,
+#                                  but per row the scan costs about as much as float32
+DEFAULT_WEIGHTS = tuple(float(w) for w in os.getenv("HYBRID_WEIGHTS", "0.5,0.5").split(","))
+RRF_C = float(os.getenv("HYBRID_RRF_C", "60"))
+DENSE_SEARCH = os.getenv("DENSE_SEARCH", "auto").strip().lower()
+DENSE_EXACT_MAX = int(os.getenv("DENSE_EXACT_MAX", "100000"))
+
+_sparse_pool = ThreadPoolExecutor(max_workers=int(os.getenv("HYBRID_THREADS", "8")), thread_name_prefix="sparse")
+
+# Metadata filters (retrieval_options(filters={...})), pushed into both searches: a Chroma
+# `where` for the dense side and document row ranges of the chunk store for BM25.
+#   course        -> subject (the `course` given with /api/upload; "General" otherwise)
+#   document      -> document_id or source (PDF file name)
+#   content_type  -> content_type
+#   page_from / page_to -> inclusive page_number range
+# Values are a string or a list of strings (any of them matches); fields are ANDed.
+FILTER_FIELDS = {
+    "course": ("subject",),
+    "document": ("document_id", "source"),
+    "content_type": ("content_type",),
+}
+PAGE_FILTERS = ("page_from", "page_to")
+
+# Per-request overrides (top_k, k, weights, filters), set by the API around a pipeline call
+_options: contextvars.ContextVar = contextvars.ContextVar("retrieval_options", default=None)
+
+
+@contextlib.contextmanager
+def retrieval_options(**options):
+    """Override retrieval settings for the calls made inside this block (None values are ignored)."""
+    token = _options.set({key: value for key, value in options.items() if value is not None})
+    try:
+        yield
+    finally:
+        _options.reset(token)
+
+
+def current_options() -> Dict[str, Any]:
+    return _options.get() or {}
+
+
+def filter_clauses(filters: Optional[Dict[str, Any]]) -> Tuple[List[Tuple[Tuple[str, ...], List[str]]], Optional[Tuple]]:
+    """(clauses, pages) for BM25Index.search: one (metadata fields, values) clause per filter."""
+    if not filters:
+        return [], None
+    clauses = [(FILTER_FIELDS[name], list(values)) for name, values in filters.items() if name in FILTER_FIELDS]
+    pages = None
+    if any(filters.get(name) is not None for name in PAGE_FILTERS):
+        pages = (filters.get("page_from"), filters.get("page_to"))
+    return clauses, pages
+
+
+def chroma_where(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """The same filters as a Chroma `where` clause (None: unfiltered)."""
+    clauses, pages = filter_clauses(filters)
+    conditions = []
+    for fields, values in clauses:
+        per_field = [{name: {"$in": values}} for name in fields]
+        conditions.append(per_field[0] if len(per_field) == 1 else {"$or": per_field})
+    if pages is not None:
+        first, last = pages
+        if first is not None:
+            conditions.append({"page_number": {"$gte": first}})
+        if last is not None:
+            conditions.append({"page_number": {"$lte": last}})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def rrf_fuse(
+    ranked_lists: Sequence[Sequence[str]], weights: Sequence[float], c: float = RRF_C, limit: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Weighted reciprocal rank fusion over ranked chunk-id lists.
+    Returns (ids, scores) sorted by fused score (ties: earlier first appearance).
+    """
+    lengths = [len(ids) for ids in ranked_lists]
+    if not sum(lengths):
+        return np.array([], dtype=object), np.array([], dtype=np.float64)
+    all_ids = np.concatenate([np.asarray(ids, dtype=object) for ids in ranked_lists if len(ids)])
+    contrib = np.concatenate([
+        weight / (c + np.arange(1, n + 1, dtype=np.float64)) for n, weight in zip(lengths, weights) if n
+    ])
+    unique, first, inverse = np.unique(all_ids.astype(str), return_index=True, return_inverse=True)
+    scores = np.zeros(len(unique), dtype=np.float64)
+    np.add.at(scores, inverse, contrib)
+    order = np.lexsort((first, -scores))
+    if limit is not None:
+        order = order[:limit]
+    return all_ids[first[order]], scores[order]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    BM25 + dense retrieval fused with RRF. Sets metadata bm25_score and fused_score.
+    k: candidates per side; limit: fused results returned (None = all candidates).
+    Overridable per request through retrieval_options(top_k=..., k=..., weights=..., filters=...).
+    """
+
+    index: Any
+    vector_db: Any
+    embeddings: Any
+    k: int = 3
+    limit: Optional[int] = None
+    weights: Tuple[float, float] = DEFAULT_WEIGHTS
+
+    def settings(self) -> Tuple[int, Tuple[float, float], Optional[int], Optional[Dict[str, Any]]]:
+        """(k, weights, limit, filters) for this request: top_k raises k and, when fusion
+        is the last stage (limit=None), also caps the output."""
+        options = current_options()
+        top_k = int(options.get("top_k") or 0)
+        k = int(options.get("k") or max(self.k, top_k))
+        weights = tuple(options.get("weights") or self.weights)
+        if self.limit is None:
+            limit = top_k or None
+        else:
+            limit = max(self.limit, top_k)
+        return k, weights, limit, options.get("filters")
+
+    def _sparse(self, query: str, k: int, filters=None) -> List[Tuple[str, float]]:
+        with timed_stage("bm25"):
+            self.index.refresh()  # picks up new segments after ingestion (one stat call)
+            clauses, pages = filter_clauses(filters)
+            return self.index.search(query, k=k, clauses=clauses, pages=pages)
+
+    def exact_dense(self) -> bool:
+        """Whether dense search uses the exact matmul path (needs vectors for every chunk)."""
+        if DENSE_SEARCH == "hnsw" or not self.index.has_vectors():
+            return False
+        return DENSE_SEARCH == "exact" or len(self.index) <= DENSE_EXACT_MAX
+
+    def _dense(self, vectors: List[List[float]], k: int, filters=None) -> List[List[str]]:
+        if self.exact_dense():
+            clauses, pages = filter_clauses(filters)
+            return self.index.nearest(vectors, k=k, clauses=clauses, pages=pages)
+        found = self.vector_db._collection.query(
+            query_embeddings=vectors, n_results=k, where=chroma_where(filters), include=[]
+        )
+        return found["ids"]
+
+    def _materialize(self, fused, sparse_hits) -> List[List[Document]]:
+        """Documents for every query's winners, read from the memory-mapped chunk store
+        (one Chroma call for any it doesn't hold yet, e.g. mid-ingestion)."""
+        with timed_stage("fetch"):
+            wanted = list(dict.fromkeys(str(cid) for ids, _ in fused for cid in ids))
+            by_id = self.index.chunks(wanted)
+            missing = [cid for cid in wanted if cid not in by_id]
+            if missing:
+                data = self.vector_db._collection.get(ids=missing, include=["documents", "metadatas"])
+                by_id.update({cid: (text, meta or {}) for cid, text, meta in zip(data["ids"], data["documents"], data["metadatas"])})
+            results = []
+            for (ids, scores), hits in zip(fused, sparse_hits):
+                bm25 = dict(hits)
+                docs = []
+                for cid, score in zip(ids, scores):
+                    if cid not in by_id:  # deleted by a concurrent ingestion
+                        continue
+                    text, meta = by_id[cid]
+                    meta = {**meta, "fused_score": float(score)}
+                    if cid in bm25:
+                        meta["bm25_score"] = bm25[cid]
+                    docs.append(Document(page_content=text, metadata=meta))
+                results.append(docs)
+            return results
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        k, weights, limit, filters = self.settings()
+        # Sparse search on the pool (in a copy of this context so its timings are recorded)
+        sparse = _sparse_pool.submit(contextvars.copy_context().run, self._sparse, query, k, filters)
+        with timed_stage("dense"):
+            vector = self.embeddings.embed_query(query)  # records "query_embedding" itself
+            dense_ids = self._dense([vector], k, filters)[0]
+        hits = sparse.result()
+        with timed_stage("fusion"):
+            fused = rrf_fuse([[cid for cid, _ in hits], dense_ids], weights, limit=limit)
+        return self._materialize([fused], [hits])[0]
+
+    def retrieve_batch(self, queries: List[str]) -> List[List[Document]]:
+        """Same as invoke() per query, with one encoder call and one Chroma query for the batch."""
+        if not queries:
+            return []
+        k, weights, limit, filters = self.settings()
+        sparse = _sparse_pool.submit(
+            contextvars.copy_context().run, lambda: [self._sparse(q, k, filters) for q in queries]
+        )
+        with timed_stage("dense"):
+            with timed_stage("query_embedding"):
+                # Query vectors are not persisted (CachedEmbeddings keeps them in an LRU)
+                embed = getattr(self.embeddings, "embed_queries", self.embeddings.embed_documents)
+                vectors = embed(queries)
+            dense_ids = self._dense(vectors, k, filters)
+        sparse_hits = sparse.result()
+        with timed_stage("fusion"):
+            fused = [
+                rrf_fuse([[cid for cid, _ in hits], ids], weights, limit=limit)
+                for hits, ids in zip(sparse_hits, dense_ids)
+            ]
+        return self._materialize(fused, sparse_hits)
@@ -0,0 +1,258 @@
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from rag_metrics import count_ingest, set_ingest_running
+
+# In-process ingestion job queue for the API.
+#
+# A single worker thread runs one job at a time; the job function itself takes the
+# academic_db writer lock (ingest_manifest.ingest_lock), which `python chromadbpdf.py`
+# also holds, so API and CLI runs never interleave. Triggers are deduplicated: while
+# a job is queued, new triggers join it; while one is running, at most one follow-up
+# job is queued (it picks up everything that changed in the meantime).
+# A job covers either the whole corpus (files=None) or a set of uploaded files;
+# joining a corpus job into a file job widens it to the corpus. Courses given with
+# uploads ({file name: course}) are carried along and merged the same way.
+# Under the pre-fork server each worker has its own queue; share_state() mirrors job
+# records to a directory so a status poll answered by any worker finds the job, and
+# the parent holds back worker replacement while busy() sees a live job anywhere.
+#
+#   INGEST_JOB_HISTORY=50   finished jobs kept for the status API
+
+JOB_HISTORY = int(os.getenv("INGEST_JOB_HISTORY", "50"))
+
+
+class IngestJob:
+    def __init__(self, trigger: str, files: Optional[List[str]] = None, courses: Optional[Dict[str, str]] = None):
+        self.id = uuid.uuid4().hex[:12]
+        self.status = "queued"  # queued | running | succeeded | failed
+        self.triggers: List[str] = [trigger]
+        self.files: Optional[List[str]] = sorted(set(files)) if files is not None else None
+        self.courses: Dict[str, str] = dict(courses or {})
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.progress: Dict[str, int] = {
+            "files_total": 0, "files_done": 0, "pages_done": 0, "chunks_stored": 0, "files_removed": 0,
+        }
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+        self.on_change: Optional[Callable[["IngestJob"], None]] = None
+
+    def update(self, **fields):
+        self.progress.update(fields)
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def to_dict(self) -> Dict:
+        end = self.finished_at or time.time()
+        return {
+            "id": self.id,
+            "status": self.status,
+            "triggers": list(self.triggers),
+            "files": self.files,
+            "courses": dict(self.courses),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed_s": round(end - self.started_at, 1) if self.started_at else None,
+            "progress": dict(self.progress),
+            "result": self.result,
+            "error": self.error,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "IngestJob":
+        """Read-only copy of a job recorded by another worker."""
+        job = cls.__new__(cls)
+        job.id, job.status = data["id"], data["status"]
+        job.triggers, job.files = data.get("triggers", []), data.get("files")
+        job.courses = data.get("courses", {})
+        job.created_at, job.started_at, job.finished_at = data["created_at"], data["started_at"], data["finished_at"]
+        job.progress, job.result, job.error = data.get("progress", {}), data.get("result"), data.get("error")
+        job.done = threading.Event()
+        job.on_change = None
+        if job.status in ("succeeded", "failed"):
+            job.done.set()
+        return job
+
+
+class IngestQueue:
+    """
+    run(job) does the ingestion (reporting through job.update) and returns a summary;
+    on_success() is called afterwards, e.g. to hot-swap the live retriever.
+    """
+
+    def __init__(self, run: Callable[[IngestJob], Optional[Dict]], on_success: Callable[[], None] = None):
+        self._run = run
+        self._on_success = on_success
+        self._jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self._pending: Optional[IngestJob] = None
+        self._current: Optional[IngestJob] = None
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._state_dir: Optional[Path] = None
+        self._saved_at: Dict[str, float] = {}
+
+    def share_state(self, state_dir: str):
+        """Mirror job records to state_dir, where the queues of sibling workers can read them."""
+        self._state_dir = Path(state_dir)
+        self._state_dir.mkdir(parents=True, exist_ok=True)
+
+    def submit(self, trigger: str = "manual", files: Optional[List[str]] = None,
+               courses: Optional[Dict[str, str]] = None) -> IngestJob:
+        """Queue an ingestion run (of `files` only, if given), or join the one waiting to start."""
+        with self._cond:
+            pending = self._pending
+            if pending is not None:
+                pending.triggers.append(trigger)
+                pending.courses.update(courses or {})
+                if files is None:
+                    pending.files = None
+                elif pending.files is not None:
+                    pending.files = sorted(set(pending.files) | set(files))
+                self._save(pending)
+                return pending
+            job = IngestJob(trigger, files, courses)
+            job.on_change = lambda j: self._save(j, force=False)
+            self._pending = job
+            self._jobs[job.id] = job
+            self._save(job)
+            self._trim()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name="ingest", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            return job
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        with self._cond:
+            job = self._jobs.get(job_id)
+        return job if job is not None else self._load(job_id)
+
+    def jobs(self) -> List[IngestJob]:
+        """Most recent first."""
+        with self._cond:
+            local = list(reversed(self._jobs.values()))
+        if self._state_dir is None:
+            return local
+        known = {job.id for job in local}
+        shared = [self._load(path.stem) for path in self._state_dir.glob("*.json") if path.stem not in known]
+        merged = local + [job for job in shared if job is not None]
+        return sorted(merged, key=lambda job: job.created_at, reverse=True)[:JOB_HISTORY]
+
+    def has_pending(self) -> bool:
+        """True while a job is waiting to start."""
+        with self._cond:
+            return self._pending is not None
+
+    def active(self) -> Optional[IngestJob]:
+        with self._cond:
+            return self._current or self._pending
+
+    def busy(self) -> bool:
+        """True while a job is queued or running here or, with share_state(), in any live worker."""
+        if self.active() is not None:
+            return True
+        return any(not job.done.is_set() for job in self.jobs())
+
+    def wait_idle(self):
+        """Block until no job is queued or running in this process (e.g. before it exits)."""
+        with self._cond:
+            while self._current is not None or self._pending is not None:
+                self._cond.wait()
+
+    def _trim(self):
+        finished = [j.id for j in self._jobs.values() if j.done.is_set()]
+        for job_id in finished[: max(0, len(finished) - JOB_HISTORY)]:
+            del self._jobs[job_id]
+            self._saved_at.pop(job_id, None)
+            if self._state_dir is not None:
+                (self._state_dir / f"{job_id}.json").unlink(missing_ok=True)
+
+    def _save(self, job: IngestJob, force: bool = True):
+        """Write the job record for sibling workers (progress updates at most once a second)."""
+        if self._state_dir is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._saved_at.get(job.id, 0.0) < 1.0:
+            return
+        self._saved_at[job.id] = now
+        path = self._state_dir / f"{job.id}.json"
+        tmp = path.with_name(f".{job.id}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            tmp.write_text(json.dumps({**job.to_dict(), "pid": os.getpid()}), encoding="utf-8")
+            os.replace(tmp, path)
+        except (OSError, TypeError, ValueError) as e:
+            logging.warning(f"Could not record ingestion job {job.id}: {e}")
+
+    def _load(self, job_id: str) -> Optional[IngestJob]:
+        if self._state_dir is None or not re.fullmatch(r"[0-9a-f]{12}", job_id):
+            return None
+        try:
+            data = json.loads((self._state_dir / f"{job_id}.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        job = IngestJob.from_dict(data)
+        if not job.done.is_set() and not _alive(data.get("pid")):
+            job.status, job.error = "failed", "the worker running this job exited before it finished"
+            job.done.set()
+        return job
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                job, self._pending = self._pending, None
+                self._current = job
+            try:
+                self._execute(job)
+            finally:
+                with self._cond:
+                    self._current = None
+                    self._cond.notify_all()
+
+    def _execute(self, job: IngestJob):
+        job.status = "running"
+        job.started_at = time.time()
+        set_ingest_running(True)
+        self._save(job)
+        logging.info(f"Ingestion job {job.id} started ({', '.join(job.triggers)})")
+        try:
+            job.result = self._run(job)
+            if self._on_success is not None:
+                self._on_success()
+            job.status = "succeeded"
+            logging.info(f"Ingestion job {job.id} finished: {job.result}")
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logging.error(f"Ingestion job {job.id} failed: {e}")
+        finally:
+            job.finished_at = time.time()
+            set_ingest_running(False)
+            count_ingest(job.status, job.progress)
+            self._save(job)
+            job.done.set()
+
+
+def _alive(pid) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (OSError, ValueError):
+        pass  # exists but not ours, or unreadable: assume alive
+    return True
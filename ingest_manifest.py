@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import logging
+import contextlib
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process exclusion
+    fcntl = None
+
+# The manifest lives inside the Chroma persist directory so that wiping
+# academic_db also forgets what was ingested (no stale "already embedded" state).
+MANIFEST_NAME = "ingest_manifest.json"
+MANIFEST_VERSION = 1
+LOCK_NAME = ".ingest.lock"
+
+
+def manifest_path(persist_directory: str) -> Path:
+    return Path(persist_directory) / MANIFEST_NAME
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_manifest(persist_directory: str) -> Dict:
+    """Load the ingestion manifest, or an empty one if missing/unreadable."""
+    path = manifest_path(persist_directory)
+    if path.exists():
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                data.setdefault("files", {})
+                return data
+            logging.warning(f"Ignoring ingestion manifest with unknown version: {data.get('version')}")
+        except Exception as e:
+            logging.warning(f"Could not read ingestion manifest {path}: {e}")
+    return {"version": MANIFEST_VERSION, "files": {}}
+
+
+def save_manifest(persist_directory: str, manifest: Dict) -> None:
+    """Atomically write the manifest (write temp file, then rename)."""
+    path = manifest_path(persist_directory)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def file_entry(full_path: str, document_id: str, chunk_ids: List[str], sha256: str = None,
+               course: str = None) -> Dict:
+    st = os.stat(full_path)
+    entry = {
+        "sha256": sha256 or file_sha256(full_path),
+        "mtime": st.st_mtime,
+        "size": st.st_size,
+        "document_id": document_id,
+        "chunk_ids": list(chunk_ids),
+    }
+    if course:
+        entry["course"] = course  # kept when a changed file is re-ingested without one
+    return entry
+
+
+def plan_ingestion(pdf_dir: str, persist_directory: str, only: List[str] = None) -> Tuple[List[str], List[str], Dict]:
+    """
+    Compare the PDFs on disk against the manifest.
+    Returns (to_process, to_remove, manifest):
+    - to_process: new or changed PDF file names (relative to pdf_dir)
+    - to_remove: manifest entries whose file was deleted
+    Unchanged size+mtime skips hashing; a touched-but-identical file only refreshes its mtime.
+    With `only`, just those files are considered and nothing is removed.
+    """
+    manifest = load_manifest(persist_directory)
+    known = manifest["files"]
+
+    if not os.path.isdir(pdf_dir):
+        return [], sorted(known), manifest
+
+    on_disk = sorted(f for f in os.listdir(pdf_dir) if f.lower().endswith(".pdf"))
+    to_process = []
+    for pdf_file in on_disk:
+        if only is not None and pdf_file not in only:
+            continue
+        entry = known.get(pdf_file)
+        if entry is None:
+            to_process.append(pdf_file)
+            continue
+        full_path = os.path.join(pdf_dir, pdf_file)
+        st = os.stat(full_path)
+        if st.st_size == entry.get("size") and st.st_mtime == entry.get("mtime"):
+            continue
+        if file_sha256(full_path) == entry.get("sha256"):
+            entry["mtime"] = st.st_mtime
+            continue
+        to_process.append(pdf_file)
+
+    to_remove = sorted(set(known) - set(on_disk)) if only is None else []
+    return to_process, to_remove, manifest
+
+
+def has_pending_changes(pdf_dir: str, persist_directory: str) -> bool:
+    """
+    Whether an ingestion run has work to do. Files found touched-but-identical get their
+    new mtime saved (unless a writer holds the lock and will rewrite the manifest anyway),
+    so the next check does not hash them again.
+    """
+    to_process, to_remove, manifest = plan_ingestion(pdf_dir, persist_directory)
+    if to_process or to_remove:
+        return True
+    try:
+        with ingest_lock(persist_directory, blocking=False):
+            current = load_manifest(persist_directory)
+            refreshed = False
+            for name, entry in manifest["files"].items():
+                known = current["files"].get(name)
+                if known is not None and known.get("sha256") == entry.get("sha256") \
+                        and known.get("mtime") != entry.get("mtime"):
+                    known["mtime"] = entry["mtime"]
+                    refreshed = True
+            if refreshed:
+                save_manifest(persist_directory, current)
+    except BlockingIOError:
+        pass
+    return False
+
+
+def collection_version(persist_directory: str):
+    """Cheap token that changes whenever an ingestion run rewrites the manifest."""
+    try:
+        st = manifest_path(persist_directory).stat()
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+
+@contextlib.contextmanager
+def ingest_lock(persist_directory: str, blocking: bool = True):
+    """
+    Single-writer lock for academic_db. Held for a whole ingestion run by both the
+    API job queue and `python chromadbpdf.py`, so two writers never interleave.
+    blocking=False raises BlockingIOError instead of waiting for another holder.
+    """
+    path = Path(persist_directory) / LOCK_NAME
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as lock:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if not blocking:
+                    raise
+                logging.info("Another ingestion run holds the lock; waiting for it to finish...")
+                fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,132 @@
+import os
+import time
+import logging
+import threading
+import concurrent.futures
+from pathlib import Path
+from typing import Callable, Dict
+
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from sentence_transformers import CrossEncoder, SentenceTransformer
+
+# ---------- Model warm start ----------
+# Models are pinned to a local directory once and always loaded from there.
+#   EMBEDDING_MODEL=sentence-transformers/all-MiniLM-L6-v2
+#   RERANK_MODEL=cross-encoder/ms-marco-MiniLM-L-6-v2
+#   MODEL_DIR=./models          pinned model directory
+#   MODEL_OFFLINE=1|0           never download; fail if a model is not pinned yet
+#   MODEL_BACKEND=torch|onnx|onnx-int8
+#   ONNX_QUANT_CONFIG=avx512_vnni|avx2|arm64 (target for onnx-int8)
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+MODEL_DIR = os.getenv("MODEL_DIR", "./models")
+MODEL_OFFLINE = bool(int(os.getenv("MODEL_OFFLINE", "0")))
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "torch").strip().lower()
+ONNX_QUANT_CONFIG = os.getenv("ONNX_QUANT_CONFIG", "avx512_vnni")
+
+load_report: Dict[str, Dict] = {}  # model name -> {seconds, backend, path}
+_pin_lock = threading.Lock()
+
+
+def rss_mb() -> float:
+    """Current resident set size of this process in MB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def local_model_path(repo_id: str) -> str:
+    """Path of the pinned copy of a Hub model, downloading it on first use."""
+    path = Path(MODEL_DIR) / repo_id.replace("/", "--")
+    with _pin_lock:
+        if (path / "config.json").exists():
+            return str(path)
+        if MODEL_OFFLINE:
+            raise RuntimeError(f"Model {repo_id} is not pinned in {MODEL_DIR} and MODEL_OFFLINE=1")
+        logging.info(f"Pinning {repo_id} to {path} ...")
+        from huggingface_hub import snapshot_download
+        snapshot_download(repo_id=repo_id, local_dir=str(path))
+    return str(path)
+
+
+def _backend_kwargs(model_cls, path: str) -> Dict:
+    """sentence-transformers kwargs for MODEL_BACKEND, exporting ONNX files next to the model once."""
+    if MODEL_BACKEND not in ("onnx", "onnx-int8"):
+        return {}
+    onnx_dir = Path(path) / "onnx"
+    try:
+        if not (onnx_dir / "model.onnx").exists():
+            logging.info(f"Exporting {path} to ONNX ...")
+            model_cls(path, backend="onnx").save_pretrained(path)
+        if MODEL_BACKEND == "onnx":
+            return {"backend": "onnx"}
+        quant_file = f"model_qint8_{ONNX_QUANT_CONFIG}.onnx"
+        if not (onnx_dir / quant_file).exists():
+            from sentence_transformers import export_dynamic_quantized_onnx_model
+            logging.info(f"Quantizing {path} to int8 ({ONNX_QUANT_CONFIG}) ...")
+            export_dynamic_quantized_onnx_model(model_cls(path, backend="onnx"), ONNX_QUANT_CONFIG, path)
+        return {"backend": "onnx", "model_kwargs": {"file_name": f"onnx/{quant_file}"}}
+    except Exception as e:
+        logging.warning(f"ONNX backend unavailable for {path} ({e}); falling back to torch")
+        return {}
+
+
+def _timed(name: str, backend_kwargs: Dict, path: str, load: Callable):
+    start = time.perf_counter()
+    model = load()
+    load_report[name] = {
+        "seconds": round(time.perf_counter() - start, 3),
+        "backend": backend_kwargs.get("backend", "torch"),
+        "path": path,
+    }
+    logging.info(f"Loaded {name} in {load_report[name]['seconds']}s ({load_report[name]['backend']})")
+    return model
+
+
+def load_embeddings(device: str = None, batch_size: int = None) -> HuggingFaceEmbeddings:
+    path = local_model_path(EMBEDDING_MODEL)
+    model_kwargs = _backend_kwargs(SentenceTransformer, path)
+    if device:
+        model_kwargs["device"] = device
+    encode_kwargs = {"normalize_embeddings": True}
+    if batch_size:
+        encode_kwargs["batch_size"] = batch_size
+    return _timed("embeddings", model_kwargs, path, lambda: HuggingFaceEmbeddings(
+        model_name=path, model_kwargs=model_kwargs, encode_kwargs=encode_kwargs,
+    ))
+
+
+def load_cross_encoder(max_length: int = 256) -> CrossEncoder:
+    path = local_model_path(RERANK_MODEL)
+    kwargs = _backend_kwargs(CrossEncoder, path)
+    return _timed("cross_encoder", kwargs, path, lambda: CrossEncoder(path, max_length=max_length, **kwargs))
+
+
+def preload(loaders: Dict[str, Callable]) -> Dict:
+    """Run model loaders concurrently; returns the cold-start report (times, RSS)."""
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(loaders))) as pool:
+        futures = {name: pool.submit(fn) for name, fn in loaders.items()}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Failed to load {name}: {e}")
+    report = {
+        "models": dict(load_report),
+        "wall_seconds": round(time.perf_counter() - start, 3),
+        "rss_mb_before": round(rss_before, 1),
+        "rss_mb_after": round(rss_mb(), 1),
+    }
+    logging.info(
+        f"Model warm start: {report['wall_seconds']}s wall, "
+        f"RSS {report['rss_mb_before']} -> {report['rss_mb_after']} MB"
+    )
+    return report
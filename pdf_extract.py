@@ -0,0 +1,227 @@
+import os
+import io
+import re
+import sys
+import json
+import logging
+import concurrent.futures
+from collections import OrderedDict, deque
+from typing import Iterator, List, Tuple, Optional
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+# Page text extraction and local OCR, kept apart from chromadbpdf.py (torch, Chroma,
+# embedding models) so the processes that extract pages import nothing else.
+#
+# Run as a script, this is the page pool of an ingestion run: it reads
+# {"paths": [...], "workers": n, "fd": f} from stdin and writes one JSON line per page,
+# [pdf_path, page_number, text, ocr_used], to the inherited file descriptor f (stdout is
+# left to whatever the OCR engines print). chromadbpdf.iter_extracted_pages
+# starts it as a separate process, so pool processes are forked from this small
+# interpreter instead of from the API (or spawned, re-running its __main__).
+
+# ---------------- Local OCR config ----------------
+# Choose OCR engine via env:
+#   OCR_BACKEND=tesseract|paddle (default: tesseract)
+#   OCR_DPI=220 (render DPI for scanned pages)
+#   OCR_LANG=eng (Tesseract languages, e.g., "eng+deu")
+#   PADDLE_LANG=en (PaddleOCR language code)
+#   PADDLE_USE_ANGLE=1|0 (angle classification)
+#   OCR_TIMEOUT=60 (seconds allowed for OCR of one page)
+OCR_BACKEND = os.getenv("OCR_BACKEND", "tesseract").strip().lower()
+OCR_DPI = int(os.getenv("OCR_DPI", "220"))
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+PADDLE_LANG = os.getenv("PADDLE_LANG", "en")
+PADDLE_USE_ANGLE = bool(int(os.getenv("PADDLE_USE_ANGLE", "1")))
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "60"))
+
+# Try import OCR backends
+_has_pytesseract = False
+_has_paddle = False
+try:
+    import pytesseract
+    _has_pytesseract = True
+except Exception:
+    logging.info("pytesseract not available — install it for Tesseract OCR.")
+
+try:
+    from paddleocr import PaddleOCR
+    _has_paddle = True
+except Exception:
+    if OCR_BACKEND == "paddle":
+        logging.info("PaddleOCR not available — `pip install paddleocr paddlepaddle` for Paddle OCR.")
+
+# ---------------- Helpers ----------------
+def normalize_ws(text: str) -> str:
+    text = re.sub(r"[ \t\u00A0]+", " ", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+def render_page_png(page: fitz.Page, dpi: int = OCR_DPI) -> bytes:
+    zoom = dpi / 72.0
+    mat = fitz.Matrix(zoom, zoom)
+    pix = page.get_pixmap(matrix=mat, alpha=False)
+    return pix.tobytes("png")
+
+# ---------------- OCR backends ----------------
+_paddle_ocr: Optional["PaddleOCR"] = None
+
+def _ensure_paddle():
+    global _paddle_ocr
+    if _paddle_ocr is None and _has_paddle:
+        logging.info(f"Initializing PaddleOCR(lang={PADDLE_LANG}, angle_cls={PADDLE_USE_ANGLE})")
+        _paddle_ocr = PaddleOCR(use_angle_cls=PADDLE_USE_ANGLE, lang=PADDLE_LANG, show_log=False)
+    return _paddle_ocr
+
+def ocr_with_tesseract(img_bytes: bytes) -> str:
+    if not _has_pytesseract:
+        return ""
+    try:
+        img = Image.open(io.BytesIO(img_bytes))
+        txt = pytesseract.image_to_string(img, lang=OCR_LANG, timeout=OCR_TIMEOUT)
+        return normalize_ws(txt or "")
+    except Exception as e:
+        logging.warning(f"Tesseract OCR failed: {e}")
+        return ""
+
+def ocr_with_paddle(img_bytes: bytes) -> str:
+    if not _has_paddle:
+        return ""
+    try:
+        import numpy as np
+        ocr_engine = _ensure_paddle()
+        if ocr_engine is None:
+            return ""
+        img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
+        arr = np.array(img)
+        result = ocr_engine.ocr(arr, cls=PADDLE_USE_ANGLE)
+        lines = []
+        if result:
+            for page in result:
+                if not page:
+                    continue
+                for line in page:
+                    if len(line) >= 2 and line[1]:
+                        lines.append(line[1][0])
+        return normalize_ws("\n".join(lines))
+    except Exception as e:
+        logging.warning(f"PaddleOCR failed: {e}")
+        return ""
+
+def ocr_png_locally(img_bytes: bytes) -> str:
+    """Try requested backend first, then fall back to the other if available."""
+    if OCR_BACKEND == "paddle":
+        text = ocr_with_paddle(img_bytes)
+        if text:
+            return text
+        return ocr_with_tesseract(img_bytes)
+    else:
+        text = ocr_with_tesseract(img_bytes)
+        if text:
+            return text
+        return ocr_with_paddle(img_bytes)
+
+# ---------------- Extraction ----------------
+_worker_docs = OrderedDict()  # per process: recently opened PDFs, so page units don't reopen files
+
+def _open_pdf(pdf_path: str) -> fitz.Document:
+    # Keyed on the file's identity too: a PDF replaced at the same path (re-upload)
+    # must not be read through the handle of its previous version
+    st = os.stat(pdf_path)
+    version = (st.st_mtime_ns, st.st_size, st.st_ino)
+    cached = _worker_docs.get(pdf_path)
+    if cached is not None and cached[0] != version:
+        _worker_docs.pop(pdf_path)[1].close()
+        cached = None
+    if cached is None:
+        cached = (version, fitz.open(pdf_path))
+        _worker_docs[pdf_path] = cached
+        while len(_worker_docs) > 4:
+            _worker_docs.popitem(last=False)[1][1].close()
+    else:
+        _worker_docs.move_to_end(pdf_path)
+    return cached[1]
+
+def page_count(pdf_path: str) -> int:
+    try:
+        with fitz.open(pdf_path) as doc:
+            return doc.page_count
+    except Exception as e:
+        logging.error(f"Error opening {pdf_path}: {e}")
+        return 0
+
+def extract_page(pdf_path: str, page_index: int) -> Tuple[str, bool]:
+    """
+    Extract one page (0-based index). Returns (text, ocr_used).
+    - Uses PyMuPDF text first.
+    - Falls back to LOCAL OCR if the page text is empty/very short (scanned).
+    """
+    page = _open_pdf(pdf_path)[page_index]
+    text = (page.get_text("text") or "").strip()
+    ocr_used = False
+
+    # If likely scanned / low text, try OCR
+    if len(text) < 25:
+        try:
+            img_bytes = render_page_png(page, dpi=OCR_DPI)
+            ocr_text = ocr_png_locally(img_bytes)
+            ocr_used = True
+            if len(ocr_text) > len(text):
+                text = ocr_text
+        except Exception as e:
+            logging.warning(f"OCR fallback failed for page {page_index + 1} in {pdf_path}: {e}")
+    return text.strip(), ocr_used
+
+
+def iter_pages(pdf_paths: List[str], workers: int = 1) -> Iterator[Tuple[str, int, str, bool]]:
+    """
+    Extract pages of many PDFs, one work unit per page (so a single large scanned deck
+    fans out across `workers` processes; 1 = in this process). Yields
+    (pdf_path, page_number, text, ocr_used) in document/page order; in-flight work
+    is bounded to a few units per worker. A page that exceeds the timeout yields "".
+    """
+    units = ((path, i) for path in pdf_paths for i in range(page_count(path)))
+
+    if workers <= 1:
+        for path, i in units:
+            try:
+                text, ocr_used = extract_page(path, i)
+            except Exception as e:
+                logging.warning(f"Extraction failed for page {i + 1} in {path}: {e}")
+                text, ocr_used = "", False
+            yield path, i + 1, text, ocr_used
+        return
+
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    window = deque()
+
+    def _collect():
+        (path, i), future = window.popleft()
+        try:
+            text, ocr_used = future.result(timeout=OCR_TIMEOUT * 2)
+        except concurrent.futures.TimeoutError:
+            logging.warning(f"Timed out extracting page {i + 1} in {path}; skipping it")
+            text, ocr_used = "", False
+        except Exception as e:
+            logging.warning(f"Extraction failed for page {i + 1} in {path}: {e}")
+            text, ocr_used = "", False
+        return path, i + 1, text, ocr_used
+
+    try:
+        for unit in units:
+            window.append((unit, pool.submit(extract_page, *unit)))
+            if len(window) >= workers * 4:
+                yield _collect()
+        while window:
+            yield _collect()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    request = json.load(sys.stdin)
+    out = os.fdopen(int(request["fd"]), "w", encoding="utf-8")
+    for page in iter_pages(request["paths"], workers=int(request.get("workers", 1))):
+        out.write(json.dumps(page) + "\n")
+        out.flush()
@@ -0,0 +1,286 @@
+import gc
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import tempfile
+from typing import Callable, Dict, Optional
+
+# Pre-fork launcher: load models and indexes once, then fork workers that share them.
+#
+# The parent imports the app (embedding model, cross-encoder, memory-mapped BM25 index
+# and embedding cache), freezes the GC so collections in the workers don't touch (and
+# un-share) the inherited heap, binds the listening socket and forks the workers, which
+# all accept on it. The parent serves nothing: it restarts crashed workers, and on
+# SIGHUP runs `reload` and replaces the workers one by one so they fork from the
+# refreshed heap. SIGUSR1 logs per-process memory.
+#
+# Background work (ingestion jobs) is not cut short by a reload: the parent waits while
+# busy() is true before reloading, and a retired worker (SIGUSR2, then SIGTERM) stops
+# serving, then runs drain() to finish what it started before it exits.
+#
+# Memory comes from /proc/<pid>/smaps_rollup: uss is the pages only that process maps
+# (what one more worker really costs), pss adds its share of the pages it shares.
+#
+#   WORKER_THREADS=<n>       torch intra-op threads per worker (default cpu_count // workers)
+#   PREFORK_REPORT_DELAY=15  seconds after (re)starting workers before memory is logged
+#   PREFORK_REPLACE_DELAY=2  seconds a replacement worker gets before the old one is stopped
+#
+# Metrics: prepare_metrics_dir() points prometheus_client at a shared multiprocess
+# directory (PROMETHEUS_MULTIPROC_DIR) before it is imported, so /metrics answered by
+# any worker aggregates all of them; on_exit(pid) lets the app drop an exited
+# worker's live gauges.
+
+WORKER_ID_ENV = "RAG_WORKER_ID"
+MASTER_PID_ENV = "RAG_PREFORK_MASTER"
+METRICS_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+REPORT_DELAY = float(os.getenv("PREFORK_REPORT_DELAY", "15"))
+REPLACE_DELAY = float(os.getenv("PREFORK_REPLACE_DELAY", "2"))
+
+
+def worker_id() -> Optional[int]:
+    """Index of this pre-forked worker, or None when not running under serve()."""
+    value = os.getenv(WORKER_ID_ENV)
+    return int(value) if value is not None else None
+
+
+def is_primary() -> bool:
+    """True in a single-process server and in worker 0 (which owns startup tasks)."""
+    return worker_id() in (None, 0)
+
+
+def request_reload() -> bool:
+    """Ask the pre-fork parent to reload and replace its workers (SIGHUP). False if there is none."""
+    master = os.getenv(MASTER_PID_ENV)
+    if not master or worker_id() is None:
+        return False
+    try:
+        os.kill(int(master), signal.SIGHUP)
+        return True
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not signal the pre-fork parent {master}: {e}")
+        return False
+
+
+def prepare_metrics_dir() -> Optional[str]:
+    """
+    Set PROMETHEUS_MULTIPROC_DIR for the workers; call before prometheus_client is imported.
+    A directory already configured is emptied (old samples would be added in); otherwise a
+    temporary one is created and returned for the caller to remove on exit.
+    """
+    if "prometheus_client" in sys.modules:
+        logging.warning("prometheus_client was imported before the metrics directory was set; "
+                        "/metrics will only show the worker that answers")
+    directory = os.getenv(METRICS_DIR_ENV)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".db"):
+                os.unlink(os.path.join(directory, name))
+        return None
+    directory = tempfile.mkdtemp(prefix="rag-metrics-")
+    os.environ[METRICS_DIR_ENV] = directory
+    return directory
+
+
+def memory_usage(pid="self") -> Dict[str, float]:
+    """{rss_mb, pss_mb, uss_mb} of a process; empty where smaps_rollup is unavailable."""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1])
+    except OSError:
+        return {}
+    return {
+        "rss_mb": round(fields.get("Rss", 0) / 1024.0, 1),
+        "pss_mb": round(fields.get("Pss", 0) / 1024.0, 1),
+        "uss_mb": round((fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)) / 1024.0, 1),
+    }
+
+
+def log_memory(workers: Dict[int, int]):
+    """Log parent and per-worker memory; workers maps pid -> worker id."""
+    parent = memory_usage()
+    logging.info(f"Pre-fork parent {os.getpid()}: {parent}")
+    total_uss = 0.0
+    for pid, wid in sorted(workers.items(), key=lambda item: item[1]):
+        usage = memory_usage(pid)
+        total_uss += usage.get("uss_mb", 0.0)
+        logging.info(f"Worker {wid} (pid {pid}): {usage}")
+    if workers and parent:
+        logging.info(
+            f"{len(workers)} workers: {total_uss:.1f} MB unique in total, "
+            f"{parent['rss_mb']:.1f} MB loaded once in the parent"
+        )
+
+
+def _limit_threads(threads: int):
+    torch = sys.modules.get("torch")  # only if the models already pulled it in
+    if torch is not None and threads > 0:
+        torch.set_num_threads(threads)
+
+
+def _freeze_heap():
+    gc.collect()
+    gc.freeze()
+
+
+def serve(
+    app,
+    host: str = "0.0.0.0",
+    port: int = 8000,
+    workers: int = 2,
+    post_fork: Callable[[], None] = None,
+    reload: Callable[[], None] = None,
+    log_level: str = "info",
+    on_exit: Callable[[int], None] = None,
+    busy: Callable[[], bool] = None,
+    drain: Callable[[], None] = None,
+):
+    """
+    Run `app` in `workers` forked uvicorn processes sharing one listening socket.
+    post_fork() runs in each worker before it serves (reopen per-process handles);
+    reload() runs in the parent on SIGHUP before the workers are replaced, once busy()
+    (checked in the parent) is false; drain() runs in a retired worker after it stopped
+    serving; on_exit(pid) runs in the parent for every worker that exited (crashed or retired).
+    """
+    import uvicorn
+
+    if not hasattr(os, "fork"):
+        logging.warning("fork() is not available here; serving from a single process")
+        uvicorn.run(app, host=host, port=port, log_level=log_level)
+        return
+
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    os.environ[MASTER_PID_ENV] = str(os.getpid())
+    threads = int(os.getenv("WORKER_THREADS", "0")) or max(1, (os.cpu_count() or 1) // workers)
+    flags = {"stop": False, "reload": False, "report": False, "waiting": False}
+
+    def spawn(wid: int) -> int:
+        pid = os.fork()
+        if pid:
+            return pid
+        # Worker: default signal handling (uvicorn installs its own), then serve
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGUSR1):
+            signal.signal(sig, signal.SIG_DFL)
+        retired = {"flag": False}
+        signal.signal(signal.SIGUSR2, lambda signum, frame: retired.update(flag=True))
+        os.environ[WORKER_ID_ENV] = str(wid)
+        code = 0
+        try:
+            _limit_threads(threads)
+            if post_fork is not None:
+                post_fork()
+            config = uvicorn.Config(app, host=host, port=port, log_level=log_level)
+            # uvicorn re-raises the signal it shut down on; don't let SIGTERM kill us before drain()
+            signal.signal(signal.SIGTERM, lambda signum, frame: None)
+            uvicorn.Server(config).run(sockets=[sock])
+            if retired["flag"] and drain is not None:
+                drain()
+        except BaseException as e:
+            logging.error(f"Worker {wid} failed: {e}")
+            code = 1
+        finally:
+            os._exit(code)
+
+    def on_signal(signum, frame):
+        if signum in (signal.SIGTERM, signal.SIGINT):
+            flags["stop"] = True
+        elif signum == signal.SIGHUP:
+            flags["reload"] = True
+        elif signum == signal.SIGUSR1:
+            flags["report"] = True
+
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+        signal.signal(sig, on_signal)
+
+    _freeze_heap()
+    running: Dict[int, int] = {}
+    started: Dict[int, float] = {}
+    retiring = set()
+    for wid in range(workers):
+        pid = spawn(wid)
+        running[pid], started[pid] = wid, time.monotonic()
+    logging.info(f"Serving on {host}:{port} with {workers} pre-forked workers ({threads} threads each)")
+    report_at = time.monotonic() + REPORT_DELAY
+
+    try:
+        while not flags["stop"]:
+            time.sleep(0.5)
+            # Reap exited workers; restart the ones that were not retired on purpose
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    pid = 0
+                if not pid:
+                    break
+                if on_exit is not None:
+                    on_exit(pid)
+                if pid in retiring:
+                    retiring.discard(pid)
+                    continue
+                wid = running.pop(pid, None)
+                if wid is None or flags["stop"]:
+                    continue
+                lifetime = time.monotonic() - started.pop(pid, 0.0)
+                logging.warning(f"Worker {wid} (pid {pid}) exited with status {status}; restarting")
+                if lifetime < 1.0:
+                    time.sleep(1.0)  # crash loop: don't spin
+                new = spawn(wid)
+                running[new], started[new] = wid, time.monotonic()
+
+            if flags["reload"]:
+                if busy is not None and busy():
+                    if not flags["waiting"]:
+                        logging.info("Reload requested; waiting for background work to finish")
+                    flags["waiting"] = True
+                    continue
+                flags["reload"] = flags["waiting"] = False
+                logging.info("Reloading and replacing workers")
+                gc.unfreeze()
+                try:
+                    if reload is not None:
+                        reload()
+                except Exception as e:
+                    logging.error(f"Reload failed, keeping the current workers: {e}")
+                    _freeze_heap()
+                    continue
+                _freeze_heap()
+                for pid, wid in list(running.items()):
+                    new = spawn(wid)
+                    running[new], started[new] = wid, time.monotonic()
+                    time.sleep(REPLACE_DELAY)  # let it start accepting before the old one stops
+                    del running[pid]
+                    started.pop(pid, None)
+                    retiring.add(pid)
+                    os.kill(pid, signal.SIGUSR2)  # retired: finish background work after serving
+                    os.kill(pid, signal.SIGTERM)  # uvicorn finishes in-flight requests first
+                report_at = time.monotonic() + REPORT_DELAY
+
+            if flags["report"] or (report_at and time.monotonic() >= report_at):
+                flags["report"], report_at = False, 0.0
+                log_memory(running)
+    finally:
+        logging.info("Stopping workers")
+        for pid in list(running) + list(retiring):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(running) + list(retiring):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        sock.close()
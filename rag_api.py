@@ -1,13 +1,42 @@
 # Academic Study Assistant API
 
-from fastapi import FastAPI, HTTPException, Body
+import os
+import prefork
+
+if __name__ == "__main__":
+    # python rag_api.py [--host 0.0.0.0] [--port 8000] [--workers N]
+    # With N > 1 the models and indexes are loaded once, then N workers are forked
+    # from this process and share them (see prefork.py); per-worker memory is logged.
+    # Parsed before the imports below: the shared metrics directory must be set before
+    # prometheus_client is first imported (via rag_pipeline / rag_metrics).
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Academic Study Assistant API")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("API_WORKERS", "1")),
+                        help="pre-forked worker processes sharing the loaded models")
+    args = parser.parse_args()
+    metrics_dir = prefork.prepare_metrics_dir() if args.workers > 1 else None
+
+from fastapi import FastAPI, HTTPException, Body, Request, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from rag_pipeline import rag_pipeline
-from fastapi.responses import PlainTextResponse
+from rag_pipeline import arag_answer, astream_rag_pipeline, saturated, RAGBusyError, areadiness, adeep_check, reload_engine
+from rag_pipeline import abatch_answers, BATCH_MAX_IN_FLIGHT, BATCH_MAX_QUESTIONS, after_fork
+from rag_metrics import SERVER_TIMING, mark_worker_dead, observe_stage, render_metrics, server_timing
+from ingest_manifest import has_pending_changes, ingest_lock
+from bm25_index import needs_upgrade
+from ingest_jobs import IngestQueue
+from hybrid_retriever import FILTER_FIELDS, PAGE_FILTERS
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+import asyncio
+import json
+import threading
 import logging
-import os
-import subprocess
+import re
+import time
 from pathlib import Path
 
 app = FastAPI(
@@ -20,11 +49,17 @@ app = FastAPI(
 async def startup_event():
     """Process new documents on startup"""
     logging.info("🚀 Starting Academic Study Assistant...")
+    if not prefork.is_primary():
+        logging.info(f"Worker {prefork.worker_id()} ready (document checks run in worker 0)")
+        return
     logging.info("📚 Checking for new documents...")
 
-    # Check and process new documents
-    if check_and_process_new_documents():
-        logging.info("✅ Document processing completed")
+    # Queue ingestion of new documents in the background; the server answers from
+    # the current index meanwhile and hot-swaps the retriever when the job finishes.
+    # The check itself may hash changed files, so it runs off the event loop
+    job = await asyncio.to_thread(check_and_process_new_documents)
+    if job:
+        logging.info(f"📥 Document processing queued as job {job.id}")
     else:
         logging.info("ℹ️ No new documents to process or processing skipped")
 
@@ -46,60 +81,226 @@ class ChatRequest(BaseModel):
 class ChatResponse(BaseModel):
     response: str
     sources: list = []
+    timings: dict = {}  # per-stage milliseconds (retrieval, bm25, dense, fusion, rerank, prompt, ttft, generation)
     success: bool = True
 
 def check_and_process_new_documents():
-    """Check for new documents and process them if found"""
+    """Check for new documents and queue an ingestion job if found. Returns the job or None."""
     try:
         # Check if university_documents directory exists
         docs_dir = Path("university_documents")
         if not docs_dir.exists():
             logging.info("No university_documents directory found")
-            return False
+            return None
 
         # Get list of PDF files in the directory
         pdf_files = list(docs_dir.glob("*.pdf"))
         if not pdf_files:
             logging.info("No PDF files found in university_documents")
-            return False
+            return None
 
         # Check if academic_db exists (indicates previous processing)
         academic_db = Path("academic_db")
         if not academic_db.exists():
             logging.info("No existing academic_db found, processing all documents...")
-            return process_documents()
+            return process_documents(trigger="startup")
+
+        # Compare against the ingestion manifest (content hash + mtime per file); an index
+        # that needs an upgrade is also rewritten by an ingestion run, never by the readers
+        if not has_pending_changes(str(docs_dir), str(academic_db)) and not needs_upgrade(str(academic_db)):
+            logging.info(f"All {len(pdf_files)} PDF files are already ingested")
+            return None
 
-        # Check modification times to see if any PDFs are newer than the last processing
-        # For simplicity, we'll always process if there are PDFs and academic_db exists
-        # In a more sophisticated version, you could track timestamps
-        logging.info(f"Found {len(pdf_files)} PDF files, processing documents...")
-        return process_documents()
+        logging.info("New, changed or deleted PDFs (or an index upgrade) detected, processing documents...")
+        return process_documents(trigger="startup")
 
     except Exception as e:
         logging.error(f"Error checking for new documents: {e}")
-        return False
+        return None
+
+def _run_ingestion(job):
+    # Imported here so the API does not load the ingestion stack until the first job
+    from chromadbpdf import API_INGEST_WORKERS, process_all_pdfs
+    from ask_pdf import get_embeddings
+
+    with ingest_lock("./academic_db"):
+        return process_all_pdfs(progress=job.update, embedding_model=get_embeddings(), only=job.files,
+                                courses=job.courses, workers=API_INGEST_WORKERS)
+
+def _after_ingestion():
+    reload_engine()
+    # Pre-fork server: have the parent reload too and re-fork every worker from it, so
+    # they all see the new chunks and share the new index again; it waits until no
+    # worker has a job queued or running (see ingest_jobs.IngestQueue.busy)
+    if not ingest_queue.has_pending():
+        prefork.request_reload()
+
+# One writer: jobs run one at a time in a background thread, then the retriever is hot-swapped
+ingest_queue = IngestQueue(run=_run_ingestion, on_success=_after_ingestion)
+
+def process_documents(trigger: str = "manual", files: list = None, courses: dict = None):
+    """Queue a document processing run, of `files` only if given (deduplicated with any run not yet started).
+    courses: {file name: course} recorded on the chunks of those files."""
+    logging.info(f"Document processing requested ({trigger})")
+    return ingest_queue.submit(trigger, files=files, courses=courses)
+
+# -------- Uploads --------
+# UPLOAD_MAX_MB=50   largest PDF accepted by /api/upload
+# An optional `course` form field is stored on the file's chunks (the `course` filter of /api/ask)
+UPLOAD_DIR = Path("university_documents")
+UPLOAD_MAX_BYTES = int(float(os.getenv("UPLOAD_MAX_MB", "50")) * 1024 * 1024)
 
-def process_documents():
-    """Run the document processing script"""
+def _safe_pdf_name(filename: str) -> str:
+    name = re.sub(r"[^A-Za-z0-9._ -]+", "_", Path(filename or "").name).strip(" .")
+    if not name.lower().endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="Only PDF files can be uploaded")
+    return name
+
+def _course_name(course) -> str:
+    course = re.sub(r"\s+", " ", course or "").strip()
+    if len(course) > 100:
+        raise HTTPException(status_code=400, detail="course must be at most 100 characters")
+    return course
+
+def _save_upload(src, name: str) -> int:
+    """Copy an upload to university_documents in 1 MB blocks (temp file + rename). Returns its size."""
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = UPLOAD_DIR / f".{name}.{os.getpid()}.part"
+    size = 0
     try:
-        logging.info("Starting document processing...")
-        result = subprocess.run(
-            ["python", "chromadbpdf.py"],
-            capture_output=True,
-            text=True,
-            cwd=os.getcwd()
-        )
+        with open(tmp, "wb") as dst:
+            head = src.read(5)
+            if head != b"%PDF-":
+                raise HTTPException(status_code=400, detail="File is not a PDF")
+            dst.write(head)
+            size = len(head)
+            for block in iter(lambda: src.read(1 << 20), b""):
+                size += len(block)
+                if size > UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail=f"PDF exceeds {UPLOAD_MAX_BYTES // (1024 * 1024)} MB")
+                dst.write(block)
+        os.replace(tmp, UPLOAD_DIR / name)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return size
 
-        if result.returncode == 0:
-            logging.info("Document processing completed successfully")
-            return True
-        else:
-            logging.error(f"Document processing failed: {result.stderr}")
-            return False
+# Per-request retrieval settings accepted in the ask payloads
+MAX_TOP_K = int(os.getenv("MAX_TOP_K", "50"))
 
-    except Exception as e:
-        logging.error(f"Error running document processing: {e}")
-        return False
+def _retrieval_options(payload: dict) -> dict:
+    """{top_k?, weights?, filters?} from a request payload; absent fields fall back to the server defaults.
+    top_k: chunks retrieved (1..MAX_TOP_K); weights: [bm25, dense] fusion weights (>= 0);
+    filters: {course?, document?, content_type?, page_from?, page_to?} (see hybrid_retriever)."""
+    options = {}
+    top_k = payload.get("top_k")
+    if top_k is not None:
+        try:
+            top_k = int(top_k)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="top_k must be an integer")
+        if not 1 <= top_k <= MAX_TOP_K:
+            raise HTTPException(status_code=400, detail=f"top_k must be between 1 and {MAX_TOP_K}")
+        options["top_k"] = top_k
+    weights = payload.get("weights")
+    if weights is not None:
+        try:
+            weights = tuple(float(w) for w in weights)
+        except (TypeError, ValueError):
+            weights = ()
+        if len(weights) != 2 or min(weights) < 0 or not sum(weights):
+            raise HTTPException(status_code=400, detail="weights must be two non-negative numbers [bm25, dense]")
+        options["weights"] = weights
+    filters = _retrieval_filters(payload.get("filters"))
+    if filters:
+        options["filters"] = filters
+    return options
+
+def _retrieval_filters(raw) -> dict:
+    """Validated metadata filters in a canonical form (fixed key order, sorted values), so
+    equal filters share answer-cache entries."""
+    if raw is None:
+        return {}
+    if not isinstance(raw, dict):
+        raise HTTPException(status_code=400, detail="filters must be an object")
+    unknown = set(raw) - set(FILTER_FIELDS) - set(PAGE_FILTERS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown filter(s): {', '.join(sorted(unknown))}")
+    filters = {}
+    for name in FILTER_FIELDS:
+        values = raw.get(name)
+        if values is None:
+            continue
+        values = [values] if isinstance(values, str) else values
+        if not isinstance(values, list) or not all(isinstance(v, str) and v.strip() for v in values) or not values:
+            raise HTTPException(status_code=400, detail=f"filters.{name} must be a non-empty string or list of strings")
+        filters[name] = sorted({v.strip() for v in values})
+    for name in PAGE_FILTERS:
+        value = raw.get(name)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            raise HTTPException(status_code=400, detail=f"filters.{name} must be a positive integer")
+        filters[name] = value
+    if filters.get("page_from", 1) > filters.get("page_to", float("inf")):
+        raise HTTPException(status_code=400, detail="filters.page_from must not exceed filters.page_to")
+    return filters
+
+async def answer_question(question: str, mode: str = "general", options: dict = None) -> dict:
+    """Run the RAG pipeline off the event loop; a saturated model maps to 503 + Retry-After.
+    Returns {answer, sources, timings}."""
+    try:
+        return await arag_answer(question, mode=mode, options=options)
+    except RAGBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def answer_response(content, timings: dict, mode: str = "general") -> JSONResponse:
+    """Serialize an answer, timing the serialization, with an optional Server-Timing header."""
+    start = time.perf_counter()
+    response = JSONResponse(content=jsonable_encoder(content))
+    elapsed_ms = round((time.perf_counter() - start) * 1000.0, 2)
+    observe_stage(mode, "serialization", elapsed_ms)
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = server_timing({**(timings or {}), "serialization": elapsed_ms})
+    return response
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_answer(request: Request, question: str, mode: str = "general", options: dict = None) -> StreamingResponse:
+    """SSE response: `sources` once, `token` per LLM chunk, then `done` (or `error`).
+    Generation is cancelled as soon as the client disconnects."""
+    if saturated(mode):
+        raise HTTPException(status_code=503, detail=f"The {mode} assistant is busy, please retry shortly.",
+                            headers={"Retry-After": "5"})
+
+    async def events():
+        cancel = threading.Event()
+        stream = astream_rag_pipeline(question, mode=mode, cancel_event=cancel, options=options)
+        try:
+            async for event, data in stream:
+                if await request.is_disconnected():
+                    logging.info("Client disconnected, stopping generation")
+                    break
+                if event == "token":
+                    data = {"text": data}
+                elif event == "error":
+                    data = {"detail": data}
+                yield _sse(event, data)
+            else:
+                yield _sse("done", {})
+        except Exception as e:
+            logging.error(f"Error while streaming answer: {e}")
+            yield _sse("error", {"detail": f"Error processing your question: {str(e)}"})
+        finally:
+            cancel.set()
+            await stream.aclose()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.get("/")
 async def root():
@@ -109,115 +310,239 @@ async def root():
         "endpoints": {
             "/chat": "POST - Ask questions about your documents",
             "/health": "GET - Check if the system is ready",
-            "/process-documents": "POST - Manually process new documents",
+            "/livez": "GET - Liveness probe",
+            "/metrics": "GET - Prometheus metrics",
+            "/readyz": "GET - Readiness probe (?deep=true runs a rate-limited end-to-end query)",
+            "/process-documents": "POST - Queue processing of new documents (returns a job)",
+            "/ingest/jobs/{id}": "GET - Status and progress of an ingestion job",
             "/api/ask": "POST - Alias for frontend (returns {answer, sources})",
+            "/api/ask/stream": "POST - Streamed answer as Server-Sent Events (sources, then tokens)",
+            "/api/ask/batch": "POST - Answer a list of questions, streamed back as NDJSON",
+            "/api/math/stream": "POST - Streamed math answer as Server-Sent Events",
             "/api/health": "GET - Alias for frontend",
-            "/api/upload": "POST - Upload a file and trigger processing"
+            "/api/upload": "POST - Upload a PDF (multipart field `file`, optional `course`) and index just that file"
         }
     }
 
+@app.get("/livez")
+async def livez():
+    """Liveness: the process and event loop respond. Touches no component."""
+    return {"status": "alive"}
+
+@app.get("/readyz")
+async def readyz(deep: bool = False):
+    """Readiness from cached component state (vector store, BM25, models, LLM ping).
+    ?deep=true adds an end-to-end RAG query, run at most once per HEALTH_DEEP_INTERVAL."""
+    report = await areadiness()
+    if deep:
+        report["deep"] = await adeep_check()
+        report["ready"] = report["ready"] and report["deep"]["ok"]
+    return JSONResponse(status_code=200 if report["ready"] else 503, content=report)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: per-mode stage histograms, request outcomes, cache hits, queues, ingestion."""
+    body, content_type = render_metrics()
+    if body is None:
+        raise HTTPException(status_code=501, detail="prometheus-client is not installed")
+    return Response(content=body, media_type=content_type)
+
 @app.get("/health")
 async def health_check():
-    try:
-        # Test if RAG system is working
-        test_response = rag_pipeline("test")
-        return {
-            "status": "healthy",
-            "message": "Academic Study Assistant is ready!",
-            "rag_system": "operational"
-        }
-    except Exception as e:
-        raise HTTPException(status_code=503, detail=f"System not ready: {str(e)}")
+    # Same cheap checks as /readyz; no RAG query is run
+    report = await areadiness()
+    if not report["ready"]:
+        failing = [name for name, check in report["checks"].items() if not check["ok"] and check.get("required", True)]
+        raise HTTPException(status_code=503, detail=f"System not ready: {', '.join(failing)}")
+    return {
+        "status": "healthy",
+        "message": "Academic Study Assistant is ready!",
+        "rag_system": "operational",
+        "checks": report["checks"],
+        "process": {"pid": os.getpid(), "worker": prefork.worker_id(), **prefork.memory_usage()},
+    }
 
 @app.get("/api/health")
 async def api_health():
     # Alias for frontend expecting /api/health
     return await health_check()
 
-@app.post("/process-documents")
+@app.post("/process-documents", status_code=202)
 async def process_documents_endpoint():
-    """Manually trigger document processing"""
+    """Queue document processing; poll /ingest/jobs/{id} for progress."""
     try:
-        logging.info("Manual document processing requested...")
-        if process_documents():
-            return {
-                "status": "success",
-                "message": "Documents processed successfully!",
-                "processed": True
-            }
-        else:
-            return {
-                "status": "error",
-                "message": "Document processing failed",
-                "processed": False
-            }
+        job = process_documents()
+        return {
+            "status": job.status,
+            "message": "Document processing queued",
+            "job": job.to_dict(),
+        }
     except Exception as e:
         logging.error(f"Error in manual document processing: {e}")
         raise HTTPException(status_code=500, detail=f"Error processing documents: {str(e)}")
 
+@app.get("/ingest/jobs")
+async def list_ingest_jobs():
+    return {"jobs": [job.to_dict() for job in ingest_queue.jobs()]}
+
+@app.get("/ingest/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    job = ingest_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown ingestion job: {job_id}")
+    return job.to_dict()
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     try:
         if not request.message.strip():
             raise HTTPException(status_code=400, detail="Please provide a question")
 
-        # Add student context to the question
-        personalized_question = f"Hi! I'm {request.student_name}. {request.message}"
-
-        response = rag_pipeline(personalized_question)
+        # The student name is not part of the query: it would defeat the answer
+        # cache and add noise to BM25/dense retrieval
+        result = await answer_question(request.message.strip())
 
-        return ChatResponse(
-            response=response,
-            sources=[],  # Could be enhanced to return source documents
+        return answer_response(ChatResponse(
+            response=result["answer"],
+            sources=result["sources"],
+            timings=result["timings"],
             success=True
-        )
+        ), result["timings"])
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error processing chat request: {e}")
         raise HTTPException(status_code=500, detail=f"Error processing your question: {str(e)}")
 
 @app.post("/api/ask")
 async def api_ask(payload: dict = Body(...)):
-    """Alias endpoint to match the Vite frontend. Accepts {question, history?, top_k?, temperature?, student_name?}."""
+    """Alias endpoint to match the Vite frontend. Accepts {question, history?, top_k?, weights?, filters?, temperature?, student_name?}."""
     try:
         question = (payload.get("question") or payload.get("message") or "").strip()
         if not question:
             raise HTTPException(status_code=400, detail="Please provide a question")
-        student_name = payload.get("student_name", "Student")
-        personalized_question = f"Hi! I'm {student_name}. {question}"
-        response = rag_pipeline(personalized_question)
-        return {"answer": response, "sources": []}
+        result = await answer_question(question, options=_retrieval_options(payload))
+        return answer_response(
+            {"answer": result["answer"], "sources": result["sources"], "timings": result["timings"]}, result["timings"]
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error in /api/ask: {e}")
         raise HTTPException(status_code=500, detail=f"Error processing your question: {str(e)}")
 
 
+@app.post("/api/ask/stream")
+async def api_ask_stream(request: Request, payload: dict = Body(...)):
+    """Streaming /api/ask. Same payload, answer delivered as Server-Sent Events."""
+    question = (payload.get("question") or payload.get("message") or "").strip()
+    if not question:
+        raise HTTPException(status_code=400, detail="Please provide a question")
+    return stream_answer(request, question, options=_retrieval_options(payload))
+
+@app.post("/api/ask/batch")
+async def api_ask_batch(request: Request, payload: dict = Body(...)):
+    """Answer many questions at once. Accepts {questions: [str | {id, question}], mode?, max_in_flight?, top_k?, weights?, filters?}.
+    Streams one JSON object per line (NDJSON) as answers complete, each tagged with its id."""
+    questions = payload.get("questions") or []
+    if not isinstance(questions, list) or not questions:
+        raise HTTPException(status_code=400, detail="Please provide a non-empty list of questions")
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_QUESTIONS} questions per batch")
+    items = []
+    for i, q in enumerate(questions):
+        qid, question = (q.get("id", i), q.get("question")) if isinstance(q, dict) else (i, q)
+        if not isinstance(question, str) or not question.strip():
+            raise HTTPException(status_code=400, detail=f"questions[{i}] must be a non-empty string or {{id, question}}")
+        items.append((qid, question.strip()))
+    mode = "math" if payload.get("mode") == "math" else "general"
+    max_in_flight = payload.get("max_in_flight")
+    if max_in_flight is None:
+        max_in_flight = BATCH_MAX_IN_FLIGHT
+    else:
+        try:
+            max_in_flight = int(max_in_flight)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="max_in_flight must be an integer")
+        if not 1 <= max_in_flight <= BATCH_MAX_IN_FLIGHT:
+            raise HTTPException(status_code=400, detail=f"max_in_flight must be between 1 and {BATCH_MAX_IN_FLIGHT}")
+    options = _retrieval_options(payload)
+
+    async def lines():
+        results = abatch_answers(items, mode=mode, max_in_flight=max_in_flight, options=options)
+        try:
+            async for result in results:
+                if await request.is_disconnected():
+                    logging.info("Client disconnected, stopping batch")
+                    break
+                yield json.dumps(result) + "\n"
+        finally:
+            await results.aclose()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
-@app.post("/api/upload")
-async def api_upload():
-    """Trigger processing without requiring multipart dependencies.
-    This keeps compatibility with the frontend route but ignores any uploaded content.
-    """
+@app.post("/api/math/stream")
+async def api_math_stream(request: Request, payload: dict = Body(...)):
+    """Streaming /api/math. Same payload, answer delivered as Server-Sent Events."""
+    question = (payload.get("question") or "").strip()
+    if not question:
+        raise HTTPException(status_code=400, detail="Please provide a math problem")
+    return stream_answer(request, question, mode="math", options=_retrieval_options(payload))
+
+@app.post("/api/upload", status_code=202)
+async def api_upload(file: UploadFile = File(...), course: str = Form(None)):
+    """Save an uploaded PDF and queue ingestion of just that file, tagged with `course` if given.
+    Poll /ingest/jobs/{job_id}; its chunks are searchable when the job succeeds."""
     try:
-        ok = process_documents()
-        if not ok:
-            return {"ok": False, "detail": "Processing failed"}
-        return {"ok": True, "detail": "Documents processed"}
+        name = _safe_pdf_name(file.filename)
+        course = _course_name(course)
+        # The multipart parser spools to a temp file; copy it off the event loop
+        loop = asyncio.get_running_loop()
+        size = await loop.run_in_executor(None, _save_upload, file.file, name)
+        job = process_documents(trigger=f"upload:{name}", files=[name], courses={name: course} if course else None)
+        logging.info(f"Uploaded {name} ({size} bytes), ingestion job {job.id}")
+        return {"ok": True, "detail": "Upload saved, indexing queued", "job_id": job.id, "filename": name}
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error in /api/upload: {e}")
-        raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
+    finally:
+        await file.close()
+
 @app.post("/api/math")
 async def api_math(payload: dict = Body(...)):
     try:
         question = (payload.get("question") or "").strip()
         if not question:
             raise HTTPException(status_code=400, detail="Please provide a math problem")
-        student_name = payload.get("student_name", "Student")
-        personalized_q = f"Hi! I'm {student_name}. {question}"
-        response = rag_pipeline(personalized_q, mode="math")
-        return {"answer": response, "sources": []}
+        result = await answer_question(question, mode="math", options=_retrieval_options(payload))
+        return answer_response(
+            {"answer": result["answer"], "sources": result["sources"], "timings": result["timings"]},
+            result["timings"], mode="math",
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error in /api/math: {e}")
         raise HTTPException(status_code=500, detail=f"Error processing math question: {str(e)}")
+
 if __name__ == "__main__":
+    import shutil
+    import tempfile
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
+
+    if args.workers > 1:
+        job_dir = os.getenv("INGEST_JOB_DIR") or tempfile.mkdtemp(prefix="rag-ingest-jobs-")
+        ingest_queue.share_state(job_dir)
+        try:
+            prefork.serve(app, host=args.host, port=args.port, workers=args.workers,
+                          post_fork=after_fork, reload=reload_engine, on_exit=mark_worker_dead,
+                          busy=ingest_queue.busy, drain=ingest_queue.wait_idle)
+        finally:
+            if not os.getenv("INGEST_JOB_DIR"):
+                shutil.rmtree(job_dir, ignore_errors=True)
+            if metrics_dir:
+                shutil.rmtree(metrics_dir, ignore_errors=True)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port) 
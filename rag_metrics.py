@@ -0,0 +1,138 @@
+import os
+import time
+import contextlib
+import contextvars
+from typing import Dict, Optional
+
+# Per-request stage timings (milliseconds). A request opens a collector with
+# collect_timings(); pipeline stages record into it with timed_stage(name).
+# The dict is mutated rather than re-set, so it is shared with the copied
+# contexts LangChain runs child runnables in.
+_stage_timings: contextvars.ContextVar = contextvars.ContextVar("stage_timings", default=None)
+
+
+@contextlib.contextmanager
+def collect_timings():
+    timings: Dict[str, float] = {}
+    token = _stage_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _stage_timings.reset(token)
+
+
+@contextlib.contextmanager
+def timed_stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, (time.perf_counter() - start) * 1000.0)
+
+
+def record_stage(name: str, elapsed_ms: float) -> None:
+    timings: Optional[Dict[str, float]] = _stage_timings.get()
+    if timings is not None:
+        timings[name] = round(timings.get(name, 0.0) + elapsed_ms, 2)
+
+
+# -------- Prometheus export (optional: pip install prometheus-client) --------
+# Stage timings above are also observed into per-mode histograms, next to request,
+# cache, queue and ingestion metrics. Without prometheus_client these are no-ops.
+#   SERVER_TIMING=1|0   add a Server-Timing header (per-stage ms) to answer responses
+# Under the pre-fork server (python rag_api.py --workers N) the launcher sets
+# PROMETHEUS_MULTIPROC_DIR before this module is imported: every worker writes its
+# samples there, and /metrics (answered by any worker) aggregates all of them.
+SERVER_TIMING = bool(int(os.getenv("SERVER_TIMING", "1")))
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+    from prometheus_client import multiprocess
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+
+if PROMETHEUS_AVAILABLE:
+    _STAGE_SECONDS = Histogram(
+        "rag_stage_seconds", "Latency of one request-path stage", ["mode", "stage"],
+        buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+    )
+    _REQUESTS = Counter("rag_requests_total", "Answered requests", ["mode", "outcome"])
+    _CACHE_EVENTS = Counter("rag_cache_events_total", "Cache lookups", ["cache", "result"])
+    # Gauges: summed over live workers (queues), or the max of them (ingestion runs in one)
+    _QUEUE_RUNNING = Gauge("rag_queue_running", "Requests holding a model slot", ["mode"],
+                           multiprocess_mode="livesum")
+    _QUEUE_WAITING = Gauge("rag_queue_waiting", "Requests waiting for a model slot", ["mode"],
+                           multiprocess_mode="livesum")
+    _INGEST_JOBS = Counter("rag_ingest_jobs_total", "Finished ingestion jobs", ["outcome"])
+    _INGEST_ITEMS = Counter("rag_ingest_items_total", "Items ingested", ["kind"])
+    _INGEST_RUNNING = Gauge("rag_ingest_running", "1 while an ingestion job runs", multiprocess_mode="livemax")
+
+
+def observe_request(mode: str, timings: Dict[str, float], outcome: str = "ok") -> None:
+    """Record a finished request: its stage timings (ms) and outcome (ok, cached, error, busy)."""
+    if not PROMETHEUS_AVAILABLE:
+        return
+    mode = "math" if mode == "math" else "general"
+    _REQUESTS.labels(mode, outcome).inc()
+    for stage, ms in (timings or {}).items():
+        _STAGE_SECONDS.labels(mode, stage).observe(ms / 1000.0)
+
+
+def observe_stage(mode: str, stage: str, elapsed_ms: float) -> None:
+    if PROMETHEUS_AVAILABLE:
+        _STAGE_SECONDS.labels("math" if mode == "math" else "general", stage).observe(elapsed_ms / 1000.0)
+
+
+def count_cache(cache: str, hits: int = 0, misses: int = 0) -> None:
+    """cache: answer | embedding | rerank."""
+    if not PROMETHEUS_AVAILABLE:
+        return
+    if hits:
+        _CACHE_EVENTS.labels(cache, "hit").inc(hits)
+    if misses:
+        _CACHE_EVENTS.labels(cache, "miss").inc(misses)
+
+
+def set_queue(mode: str, running: int, waiting: int) -> None:
+    """Current model-slot usage of one mode in this process (updated on every change)."""
+    if PROMETHEUS_AVAILABLE:
+        _QUEUE_RUNNING.labels(mode).set(running)
+        _QUEUE_WAITING.labels(mode).set(waiting)
+
+
+def set_ingest_running(running: bool) -> None:
+    if PROMETHEUS_AVAILABLE:
+        _INGEST_RUNNING.set(1 if running else 0)
+
+
+def count_ingest(outcome: str, progress: Dict[str, int]) -> None:
+    if not PROMETHEUS_AVAILABLE:
+        return
+    _INGEST_JOBS.labels(outcome).inc()
+    for kind, key in (("files", "files_done"), ("pages", "pages_done"), ("chunks", "chunks_stored")):
+        if progress.get(key):
+            _INGEST_ITEMS.labels(kind).inc(progress[key])
+
+
+def render_metrics():
+    """(body, content_type) for /metrics: this process, or every worker in multiprocess mode."""
+    if not PROMETHEUS_AVAILABLE:
+        return None, None
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def mark_worker_dead(pid: int) -> None:
+    """Drop the live gauges of an exited worker (called by the pre-fork parent)."""
+    if PROMETHEUS_AVAILABLE and MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """Server-Timing header value, e.g. 'retrieval;dur=12.5, generation;dur=830.1'."""
+    return ", ".join(f"{stage};dur={ms}" for stage, ms in timings.items())
@@ -1,23 +1,617 @@
-from ask_pdf import initialize_rag_system, _make_llm
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+import itertools
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-qa_chain_general = initialize_rag_system()  # default llama-based pipeline
+from langchain_core.prompts import format_document
 
-# Math pipeline: reuses same retriever but with Qwen model
-qa_chain_math = None
-try:
-    llm_math = _make_llm(model_type="math")
-    qa_chain_math = initialize_rag_system()
-    qa_chain_math.combine_documents_chain.llm_chain.llm = llm_math
-except Exception as e:
-    print(f"Math model not available: {e}")
+from ask_pdf import build_retrieval_engine, build_qa_chain, chunk_key, warm_start, ping_llm, RERANK_ENABLED
+from answer_cache import AnswerCache
+from ingest_manifest import collection_version
+from model_loader import load_report
+from hybrid_retriever import retrieval_options
+from rag_metrics import collect_timings, timed_stage, record_stage, observe_request, observe_stage, count_cache, set_queue
 
-def rag_pipeline(query, mode="general"):
+# Load the embedding model and cross-encoder concurrently before anything else needs them
+model_report = warm_start()
+
+# One retrieval engine (Chroma, BM25, cross-encoder) shared by every mode
+engine = build_retrieval_engine()
+
+# Per-mode chains are bound lazily, so a deployment that never uses math never loads it
+_chains = {}
+_chains_lock = threading.Lock()
+
+def _chain_for(mode):
+    mode = "math" if mode == "math" else "general"
+    if engine is None:
+        return None
+    with _chains_lock:
+        if mode not in _chains:
+            try:
+                _chains[mode] = build_qa_chain(engine, model_type=mode)
+            except Exception as e:
+                if mode == "general":
+                    logging.error(f"Could not initialize the general RAG chain: {e}")
+                    return None
+                # Math pipeline: fall back to the general model if unavailable
+                logging.warning(f"Math model not available: {e}")
+                _chains[mode] = None
+        chain = _chains[mode]
+    return chain if chain is not None else _chain_for("general")
+
+
+def reload_engine():
+    """
+    Rebuild the retrieval engine from academic_db and swap it in (after ingestion).
+    Requests already running keep the chain they started with.
+    """
+    global engine
+    new_engine = build_retrieval_engine()
+    if new_engine is None:
+        logging.warning("Retrieval engine not reloaded: nothing to search yet")
+        return False
+    with _chains_lock:
+        engine = new_engine
+        _chains.clear()
+    if answer_cache is not None:
+        answer_cache.embed_fn = _embed_query
+    logging.info("Retrieval engine reloaded")
+    return True
+
+
+def after_fork():
+    """
+    Run in each pre-forked worker before it serves: reopen Chroma, whose SQLite
+    connections must not be shared with the parent. The models loaded in the parent
+    are reused as is (copy-on-write), so this only costs the Chroma/mmap opens.
+    """
+    try:
+        from chromadb.api.client import SharedSystemClient
+        SharedSystemClient.clear_system_cache()
+    except (ImportError, AttributeError):
+        pass
+    reload_engine()
+
+
+# -------- Answer cache (keyed on the question, not the personalized prompt) --------
+# ANSWER_CACHE_ENABLED=1|0, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL (seconds)
+# SEMANTIC_CACHE_SIZE (recent questions compared by embedding), SEMANTIC_CACHE_THRESHOLD (cosine)
+def _embed_query(text):
+    return engine.embeddings.embed_query(text)
+
+answer_cache = None
+if bool(int(os.getenv("ANSWER_CACHE_ENABLED", "1"))):
+    answer_cache = AnswerCache(
+        max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "1024")),
+        ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+        semantic_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", "512")),
+        threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+        embed_fn=_embed_query if engine else None,
+        version_fn=lambda: collection_version("./academic_db"),
+    )
+
+def cache_scope(mode, options=None):
+    """Answer-cache namespace: answers retrieved with per-request settings are kept apart."""
+    if not options:
+        return mode
+    return mode + "|" + ",".join(f"{key}={options[key]}" for key in sorted(options))
+
+def _cache_get(query, mode):
+    if not answer_cache:
+        return None
+    cached = answer_cache.get(query, mode)
+    count_cache("answer", hits=int(cached is not None), misses=int(cached is None))
+    return cached
+
+def _cache_put(query, result, mode):
+    if answer_cache and result.get("answer"):
+        answer_cache.put(query, {"answer": result["answer"], "sources": result["sources"]}, mode)
+
+def source_info(doc):
+    """JSON-safe summary of a retrieved chunk (metadata, scores, preview) for API responses."""
+    meta = doc.metadata or {}
+    source = meta.get("source", "Unknown")
+    page = meta.get("page_number")
+    fused, reranked = meta.get("fused_score"), meta.get("rerank_score")
+    return {
+        "title": f"{source} (p. {page})" if page is not None else source,
+        "source": source,
+        "page_number": page,
+        "document_id": meta.get("document_id"),
+        "chunk_id": chunk_key(doc),
+        "content_type": meta.get("content_type"),
+        "fused_score": fused,
+        "rerank_score": reranked,
+        "score": reranked if reranked is not None else fused,
+        "chunk": doc.page_content[:300],
+    }
+
+def generate_tokens(chain, query, docs):
+    """
+    Prompt assembly and LLM generation over already packed docs, yielding text chunks.
+    Same prompt the "stuff" chain would build; always streamed from the LLM so that
+    time-to-first-token is measured ("ttft") next to "generation". Closing the
+    generator closes the LLM stream, which frees the model.
+    """
+    stuff = chain.combine_documents_chain
+    with timed_stage("prompt"):
+        context = stuff.document_separator.join(format_document(d, stuff.document_prompt) for d in docs)
+        prompt = stuff.llm_chain.prompt.format_prompt(context=context, question=query)
+    start = time.perf_counter()
+    first = True
+    stream = stuff.llm_chain.llm.stream(prompt)
+    try:
+        for chunk in stream:
+            text = getattr(chunk, "content", chunk)
+            if text:
+                if first:
+                    record_stage("ttft", (time.perf_counter() - start) * 1000.0)
+                    first = False
+                yield text
+    finally:
+        stream.close()
+        record_stage("generation", (time.perf_counter() - start) * 1000.0)
+
+
+def rag_answer(query, mode="general", use_cache=True, options=None):
+    """
+    Invoke RAG with chosen model and return {answer, sources, timings}.
+    Sources are the packed chunks the answer was generated from.
+    options: per-request retrieval settings (top_k, k, weights), see hybrid_retriever.
+    """
+    scope = cache_scope(mode, options)
+    chain = _chain_for(mode)
+    if not chain:
+        return {"answer": "RAG system is not initialized properly.", "sources": [], "timings": {}}
+    with collect_timings() as timings:
+        if use_cache:
+            with timed_stage("cache_lookup"):
+                cached = _cache_get(query, scope)
+            if cached is not None:
+                observe_request(mode, timings, "cached")
+                return {**cached, "timings": dict(timings), "cached": True}
+        try:
+            with timed_stage("total"):
+                with retrieval_options(**(options or {})):
+                    docs = chain.pack(chain.retriever.invoke(query))
+                answer = {
+                    "answer": "".join(generate_tokens(chain, query, docs)),
+                    "sources": [source_info(d) for d in docs],
+                }
+            _cache_put(query, answer, scope)
+            observe_request(mode, timings)
+            return {**answer, "timings": dict(timings)}
+        except Exception as e:
+            observe_request(mode, timings, "error")
+            return {"answer": f"Error: {e}", "sources": [], "timings": dict(timings)}
+
+def rag_pipeline(query, mode="general", use_cache=True):
     """Invoke RAG with chosen model"""
-    chain = qa_chain_math if mode == "math" and qa_chain_math else qa_chain_general
+    return rag_answer(query, mode, use_cache)["answer"]
+
+def stream_rag_pipeline(query, mode="general", cancel_event: threading.Event = None, options=None):
+    """
+    Streaming variant of rag_pipeline. Yields (event, data) tuples:
+    ("sources", [...]) once after retrieval, then ("token", text) per LLM chunk.
+    Setting cancel_event stops generation; closing the LLM stream frees the model.
+    """
+    chain = _chain_for(mode)
     if not chain:
-        return "RAG system is not initialized properly."
+        yield ("error", "RAG system is not initialized properly.")
+        return
+
+    scope = cache_scope(mode, options)
+    with collect_timings() as timings:
+        with timed_stage("cache_lookup"):
+            cached = _cache_get(query, scope)
+        if cached is not None:
+            observe_request(mode, timings, "cached")
+            yield ("sources", cached["sources"])
+            yield ("token", cached["answer"])
+            return
+
+        outcome = "error"
+        start = time.perf_counter()
+        try:
+            with retrieval_options(**(options or {})):
+                docs = chain.pack(chain.retriever.invoke(query))
+            sources = [source_info(d) for d in docs]
+            yield ("sources", sources)
+
+            parts = []
+            tokens = generate_tokens(chain, query, docs)
+            try:
+                for text in tokens:
+                    if cancel_event is not None and cancel_event.is_set():
+                        outcome = "cancelled"
+                        break
+                    parts.append(text)
+                    yield ("token", text)
+                else:
+                    outcome = "ok"
+                    _cache_put(query, {"answer": "".join(parts), "sources": sources}, scope)
+            finally:
+                tokens.close()
+        except GeneratorExit:  # consumer went away (client disconnect)
+            outcome = "cancelled"
+            raise
+        finally:
+            record_stage("total", (time.perf_counter() - start) * 1000.0)
+            observe_request(mode, timings, outcome)
+
+
+# -------- Concurrency limits (async path for the API) --------
+# RAG_MAX_CONCURRENCY_GENERAL / RAG_MAX_CONCURRENCY_MATH: requests running at once per model
+# RAG_MAX_QUEUE: requests allowed to wait per model before rejecting (backpressure)
+# RAG_QUEUE_TIMEOUT: seconds a request may wait for a slot before being rejected
+MAX_CONCURRENCY = {
+    "general": int(os.getenv("RAG_MAX_CONCURRENCY_GENERAL", "4")),
+    "math": int(os.getenv("RAG_MAX_CONCURRENCY_MATH", "2")),
+}
+MAX_QUEUE = int(os.getenv("RAG_MAX_QUEUE", "32"))
+QUEUE_TIMEOUT = float(os.getenv("RAG_QUEUE_TIMEOUT", "30"))
+
+# Blocking work (embedding, BM25, Chroma, LLM HTTP) runs here, never on the event loop
+_executor = ThreadPoolExecutor(max_workers=sum(MAX_CONCURRENCY.values()), thread_name_prefix="rag")
+
+
+class RAGBusyError(RuntimeError):
+    """Raised when a model's queue is full or a request waited too long for a slot."""
+
+    def __init__(self, mode: str, retry_after: int = 5):
+        super().__init__(f"The {mode} assistant is busy, please retry shortly.")
+        self.mode = mode
+        self.retry_after = retry_after
+
+
+class _ModeLimiter:
+    def __init__(self, mode: str, limit: int):
+        self.mode = mode
+        self.limit = max(1, limit)
+        self.waiting = 0
+        self.running = 0
+        self._sem = None  # created lazily inside the running event loop
+
+    async def __aenter__(self):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.limit)
+        if self.waiting >= MAX_QUEUE:
+            observe_request(self.mode, {}, "busy")
+            raise RAGBusyError(self.mode)
+        self.waiting += 1
+        self._report()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._sem.acquire(), timeout=QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            observe_request(self.mode, {}, "busy")
+            raise RAGBusyError(self.mode)
+        finally:
+            self.waiting -= 1
+            self._report()
+        observe_stage(self.mode, "queue_wait", (time.perf_counter() - start) * 1000.0)
+        self.running += 1
+        self._report()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.running -= 1
+        self._report()
+        self._sem.release()
+
+    def _report(self):
+        set_queue(self.mode, self.running, self.waiting)
+
+
+_limiters = {}
+
+def _limiter(mode: str) -> _ModeLimiter:
+    mode = "math" if mode == "math" else "general"
+    if mode not in _limiters:
+        _limiters[mode] = _ModeLimiter(mode, MAX_CONCURRENCY[mode])
+    return _limiters[mode]
+
+
+def queue_stats():
+    """Per-mode {running, waiting, limit} snapshot."""
+    return {
+        mode: {"running": l.running, "waiting": l.waiting, "limit": l.limit}
+        for mode, l in _limiters.items()
+    }
+
+
+async def run_limited(mode, fn, *args):
+    """Run a blocking callable in the RAG pool under the per-mode concurrency limit."""
+    async with _limiter(mode):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, fn, *args)
+
+
+async def arag_answer(query, mode="general", options=None):
+    """Async variant of rag_answer for the API: bounded, off the event loop.
+    Cache hits are answered without taking a model slot."""
+    loop = asyncio.get_running_loop()
+    with collect_timings() as timings:
+        with timed_stage("cache_lookup"):
+            cached = await loop.run_in_executor(None, _cache_get, query, cache_scope(mode, options))
+    if cached is not None:
+        observe_request(mode, timings, "cached")
+        return {**cached, "timings": timings, "cached": True}
+    return await run_limited(mode, rag_answer, query, mode, False, options)
+
+
+async def arag_pipeline(query, mode="general"):
+    """Async variant of rag_pipeline (answer text only)."""
+    return (await arag_answer(query, mode))["answer"]
+
+
+async def astream_rag_pipeline(query, mode="general", cancel_event: threading.Event = None, options=None):
+    """
+    Async iterator over stream_rag_pipeline events, holding a model slot for the whole stream.
+    Callers should check saturated(mode) first; a slot timeout is reported as an "error" event.
+    """
+    cancel_event = cancel_event or threading.Event()
+    loop = asyncio.get_running_loop()
+    try:
+        async with _limiter(mode):
+            gen = stream_rag_pipeline(query, mode, cancel_event, options)
+            # Every step may land on another pool thread: run them all in one context so
+            # the generator's context variables (stage timings) stay its own across yields
+            ctx = contextvars.copy_context()
+            pending = None
+            try:
+                while True:
+                    pending = loop.run_in_executor(_executor, ctx.run, next, gen, None)
+                    item = await pending
+                    if item is None:
+                        break
+                    yield item
+            finally:
+                cancel_event.set()
+                if pending is not None and not pending.done():
+                    try:
+                        await asyncio.shield(pending)
+                    except Exception:
+                        pass
+                ctx.run(gen.close)
+    except RAGBusyError as e:
+        yield ("error", str(e))
+
+
+def saturated(mode) -> bool:
+    """True when a model's wait queue is full (new requests would be rejected)."""
+    return _limiter(mode).waiting >= MAX_QUEUE
+
+
+# -------- Batch answering (FAQ lists, question banks) --------
+# BATCH_MAX_IN_FLIGHT=4     LLM calls running at once for one batch
+# BATCH_RETRIEVAL_SIZE=32   questions embedded and retrieved together
+# BATCH_MAX_QUESTIONS=256   largest batch accepted by the API
+BATCH_MAX_IN_FLIGHT = int(os.getenv("BATCH_MAX_IN_FLIGHT", "4"))
+BATCH_RETRIEVAL_SIZE = int(os.getenv("BATCH_RETRIEVAL_SIZE", "32"))
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "256"))
+
+
+def _batch_error(item_id, query, error):
+    return {"id": item_id, "question": query, "answer": f"Error: {error}", "sources": [], "timings": {}}
+
+
+def _split_cached(group, scope):
+    """(todo, answered): questions still to run, and cache hits as finished results."""
+    todo, answered = [], []
+    for item_id, query in group:
+        cached = _cache_get(query, scope)
+        if cached is None:
+            todo.append((item_id, query))
+        else:
+            answered.append({"id": item_id, "question": query, **cached, "timings": {}, "cached": True})
+    return todo, answered
+
+
+def _retrieve_group(chain, queries, options=None):
+    """Batched retrieval + packing for a group of questions; returns (packed docs per question, timings)."""
+    with collect_timings() as timings:
+        with timed_stage("retrieval"), retrieval_options(**(options or {})):
+            doc_lists = engine.retrieve_many(queries)
+        packed = [chain.pack(docs) for docs in doc_lists]
+    return packed, dict(timings)
+
+
+def _answer_one(chain, item_id, query, docs, mode, batch_timings, scope=None):
+    """One LLM call over already retrieved and packed docs."""
+    with collect_timings() as timings:
+        try:
+            result = {"answer": "".join(generate_tokens(chain, query, docs)), "sources": [source_info(d) for d in docs]}
+        except Exception as e:
+            observe_request(mode, timings, "error")
+            return _batch_error(item_id, query, e)
+    _cache_put(query, result, scope or mode)
+    observe_request(mode, timings)
+    # Retrieval ran once for the whole group; its stages are reported with a batch_ prefix
+    timings.update({f"batch_{stage}": ms for stage, ms in batch_timings.items()})
+    return {"id": item_id, "question": query, **result, "timings": dict(timings)}
+
+
+def _groups(items, size):
+    items = iter(items)
+    while True:
+        group = list(itertools.islice(items, size))
+        if not group:
+            return
+        yield group
+
+
+def iter_batch_answers(items, mode="general", max_in_flight=BATCH_MAX_IN_FLIGHT, options=None):
+    """
+    Answer (id, question) pairs, yielding result dicts in completion order.
+    Each group of BATCH_RETRIEVAL_SIZE questions is embedded and retrieved in one
+    pass; at most max_in_flight LLM calls run at once, and retrieval never runs
+    more than one group ahead of generation.
+    """
+    chain = _chain_for(mode)
+    scope = cache_scope(mode, options)
+    pool = ThreadPoolExecutor(max_workers=max(1, max_in_flight), thread_name_prefix="batch")
+    pending = set()
+    try:
+        for group in _groups(items, BATCH_RETRIEVAL_SIZE):
+            if not chain:
+                for item_id, query in group:
+                    yield _batch_error(item_id, query, "RAG system is not initialized properly.")
+                continue
+            todo, answered = _split_cached(group, scope)
+            yield from answered
+            if not todo:
+                continue
+            try:
+                packed, batch_timings = _retrieve_group(chain, [q for _, q in todo], options)
+            except Exception as e:
+                for item_id, query in todo:
+                    yield _batch_error(item_id, query, e)
+                continue
+            for (item_id, query), docs in zip(todo, packed):
+                pending.add(pool.submit(_answer_one, chain, item_id, query, docs, mode, batch_timings, scope))
+            while len(pending) > max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
+async def abatch_answers(items, mode="general", max_in_flight=BATCH_MAX_IN_FLIGHT, options=None):
+    """
+    Async iter_batch_answers for the API. Retrieval and every LLM call go through
+    run_limited, so a batch shares the per-mode limits with interactive requests.
+    """
+    loop = asyncio.get_running_loop()
+    chain = await loop.run_in_executor(None, _chain_for, mode)
+    scope = cache_scope(mode, options)
+    pending = set()
+
+    async def answer(item_id, query, docs, batch_timings):
+        try:
+            return await run_limited(mode, _answer_one, chain, item_id, query, docs, mode, batch_timings, scope)
+        except RAGBusyError as e:
+            return _batch_error(item_id, query, e)
+
+    try:
+        for group in _groups(items, BATCH_RETRIEVAL_SIZE):
+            if not chain:
+                for item_id, query in group:
+                    yield _batch_error(item_id, query, "RAG system is not initialized properly.")
+                continue
+            todo, answered = await loop.run_in_executor(None, _split_cached, group, scope)
+            for result in answered:
+                yield result
+            if not todo:
+                continue
+            try:
+                packed, batch_timings = await run_limited(mode, _retrieve_group, chain, [q for _, q in todo], options)
+            except Exception as e:
+                for item_id, query in todo:
+                    yield _batch_error(item_id, query, e)
+                continue
+            for (item_id, query), docs in zip(todo, packed):
+                while len(pending) >= max_in_flight:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+                pending.add(asyncio.ensure_future(answer(item_id, query, docs, batch_timings)))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+# -------- Health (component state only; no retrieval or generation) --------
+# HEALTH_LLM_TTL=30         seconds an LLM ping result is reused across probes
+# HEALTH_DEEP_INTERVAL=600  minimum seconds between deep checks (one real RAG query)
+HEALTH_LLM_TTL = float(os.getenv("HEALTH_LLM_TTL", "30"))
+HEALTH_DEEP_INTERVAL = float(os.getenv("HEALTH_DEEP_INTERVAL", "600"))
+
+_llm_pings = {}  # mode -> (checked_at, ok, detail)
+_llm_ping_lock = threading.Lock()
+_deep_result = None
+_deep_lock = None  # asyncio.Lock, created inside the running event loop
+
+
+def llm_status(mode="general"):
+    """Cached LLM ping; concurrent probes share one in-flight ping."""
+    with _llm_ping_lock:
+        checked_at, ok, detail = _llm_pings.get(mode, (0.0, False, "not checked"))
+        if time.monotonic() - checked_at > HEALTH_LLM_TTL:
+            ok, detail = ping_llm(mode)
+            checked_at = time.monotonic()
+            _llm_pings[mode] = (checked_at, ok, detail)
+    return {"ok": ok, "detail": detail, "age_s": round(time.monotonic() - checked_at, 1)}
+
+
+def readiness():
+    """{ready, checks}: vector store open, BM25 loaded, models loaded, LLM reachable (cached)."""
+    expected_models = ["embeddings"] + (["cross_encoder"] if RERANK_ENABLED else [])
+    checks = {
+        "vector_store": {"ok": engine is not None and engine.vector_db is not None},
+        "bm25": {"ok": engine is not None and len(engine.index) > 0,
+                 "chunks": len(engine.index) if engine is not None else 0},
+        "models": {"ok": all(name in load_report for name in expected_models),
+                   "loaded": sorted(load_report)},
+        "llm": llm_status("general"),
+    }
+    if _chains.get("math") is not None:
+        # Informational: math falls back to the general model, so it never gates readiness
+        checks["llm_math"] = {**llm_status("math"), "required": False}
+    ready = all(c["ok"] for c in checks.values() if c.get("required", True))
+    return {"ready": ready, "checks": checks, "queues": queue_stats()}
+
+
+async def areadiness():
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, readiness)
+
+
+async def adeep_check():
+    """
+    End-to-end check (retrieval + generation, answer cache bypassed), run at most once
+    per HEALTH_DEEP_INTERVAL; in between, the last result is returned.
+    """
+    global _deep_lock
+    if _deep_lock is None:
+        _deep_lock = asyncio.Lock()
+    async with _deep_lock:
+        if _deep_result is None or time.monotonic() - _deep_result["checked_at"] >= HEALTH_DEEP_INTERVAL:
+            await _run_deep_check()
+    checked_at = _deep_result["checked_at"]
+    report = {k: v for k, v in _deep_result.items() if k != "checked_at"}
+    return {**report, "age_s": round(time.monotonic() - checked_at, 1)}
+
+
+async def _run_deep_check():
+    global _deep_result
+    start = time.perf_counter()
     try:
-        result = chain.invoke({"query": query})
-        return result["result"]
-    except Exception as e:
-        return f"Error: {e}"
\ No newline at end of file
+        result = await run_limited("general", rag_answer, "test", "general", False)
+        answer = result["answer"]
+        ok = bool(answer) and not answer.startswith("Error:") and engine is not None
+        detail = "ok" if ok else answer
+    except RAGBusyError as e:
+        ok, detail = False, str(e)
+    _deep_result = {
+        "ok": ok,
+        "detail": detail,
+        "seconds": round(time.perf_counter() - start, 2),
+        "checked_at": time.monotonic(),
+    }
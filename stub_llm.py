@@ -0,0 +1,59 @@
+import os
+import re
+import time
+import hashlib
+from typing import Any, Iterator, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import SimpleChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk
+
+# Deterministic local stand-in for the LLM (LLM_PROVIDER=stub), for benchmarks and
+# offline runs. The answer is built from the prompt (same prompt -> same answer) and
+# latency follows a fixed model: time-to-first-token plus a per-token delay.
+#   STUB_LLM_TTFT_MS=50      delay before the first token
+#   STUB_LLM_TOKEN_MS=5      delay per generated token
+#   STUB_LLM_TOKENS=64       tokens per answer
+
+
+class StubChatModel(SimpleChatModel):
+    ttft_ms: float = float(os.getenv("STUB_LLM_TTFT_MS", "50"))
+    token_ms: float = float(os.getenv("STUB_LLM_TOKEN_MS", "5"))
+    max_tokens: int = int(os.getenv("STUB_LLM_TOKENS", "64"))
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        prompt = "\n".join(str(m.content) for m in messages)
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+        words = re.findall(r"\w+", prompt)[-self.max_tokens:]
+        return [f"[stub {digest}]"] + [f" {w}" for w in words[: self.max_tokens - 1]]
+
+    def _call(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        tokens = self._tokens(messages)
+        time.sleep((self.ttft_ms + self.token_ms * len(tokens)) / 1000.0)
+        return "".join(tokens)
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.ttft_ms / 1000.0)
+        for token in self._tokens(messages):
+            time.sleep(self.token_ms / 1000.0)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
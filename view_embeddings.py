@@ -3,6 +3,48 @@ import numpy as np
 from langchain_community.vectorstores import Chroma
 from langchain_community.embeddings import HuggingFaceEmbeddings
 
+from chunk_store import DEFAULT_RESCORE, VECTOR_QUANT, quantize, quantized_scores
+
+
+def report_quantization(embeddings_array, k=10, samples=100, seed=7):
+    """
+    Size of the int8 and binary vector copies against float32, and their recall@k
+    against exact cosine search: sampled chunks are the queries (each excluding
+    itself), scanned alone and with the rescoring the dense retriever applies.
+    """
+    matrix = np.asarray(embeddings_array, dtype=np.float32)
+    matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    k = min(k, len(matrix) - 1)
+    if k < 1:
+        print("   Not enough chunks to measure recall")
+        return
+    picks = np.random.default_rng(seed).choice(len(matrix), size=min(samples, len(matrix)), replace=False)
+    queries = matrix[picks]
+
+    def top(scores, n):  # scores: (queries, chunks)
+        scores[np.arange(len(picks)), picks] = -np.inf
+        return np.argsort(-scores, axis=1, kind="stable")[:, :n]
+
+    def recall(found):
+        return np.mean([len(set(f) & set(e)) / k for f, e in zip(found, exact)])
+
+    exact = top(queries @ matrix.T, k)
+    float_mb = matrix.nbytes / (1024 * 1024)
+    print(f"   float32: {float_mb:.2f} MB (configured DENSE_QUANT={VECTOR_QUANT})")
+    for mode in ("int8", "binary"):
+        parts = quantize(matrix, mode)
+        size_mb = sum(part.nbytes for part in parts) / (1024 * 1024)
+        coarse = quantized_scores(parts, mode, queries).T
+        factor = DEFAULT_RESCORE[mode]
+        candidates = top(coarse.copy(), k * factor)
+        rescored = []
+        for qi, cand in enumerate(candidates):
+            exact_scores = matrix[cand] @ queries[qi]
+            exact_scores[cand == picks[qi]] = -np.inf
+            rescored.append(cand[np.argsort(-exact_scores, kind="stable")[:k]])
+        print(f"   {mode}: {size_mb:.2f} MB ({float_mb / size_mb:.1f}x smaller), "
+              f"recall@{k} {recall(top(coarse, k)):.3f} scan only, {recall(rescored):.3f} rescoring top {k * factor}")
+
 def view_all_embeddings():
  
     
@@ -79,6 +121,10 @@ def view_all_embeddings():
         print(f"   Std magnitude: {np.std(magnitudes):.4f}")
         print(f"   Min value: {np.min(embeddings_array):.4f}")
         print(f"   Max value: {np.max(embeddings_array):.4f}")
+
+        # Quantized copies (DENSE_QUANT): compression and recall impact
+        print("\n🗜️ Quantized storage:")
+        report_quantization(embeddings_array)
         
     except Exception as e:
         print(f"Error: {e}")
@@ -1,6 +1,6 @@
 import React, { useMemo, useRef, useState } from 'react'
 import type { Message, AskResponse } from '@/types'
-import { ask, upload } from '@/lib/api'
+import { askStream, upload } from '@/lib/api'
 import MessageBubble from '@/components/MessageBubble'
 import SourceList from '@/components/SourceList'
 import Header from './components/Header'
@@ -25,9 +25,12 @@ export default function Chatbot(){
     setMessages(prev => [...prev, { id: crypto.randomUUID(), role:'user', content:q }])
     setLoading(true)
     try {
-      const res = await ask({ question: q, history: messages.slice(-10), top_k: 5, temperature: 0.1 })
-      setMessages(prev => [...prev, { id: crypto.randomUUID(), role:'assistant', content: res.answer }])
-      setSources(res.sources || [])
+      const id = crypto.randomUUID()
+      setMessages(prev => [...prev, { id, role:'assistant', content: '' }])
+      await askStream({ question: q, history: messages.slice(-10), top_k: 5, temperature: 0.1 }, {
+        onSources: setSources,
+        onToken: t => setMessages(prev => prev.map(m => m.id === id ? { ...m, content: m.content + t } : m))
+      })
     } catch (e:any) {
       setMessages(prev => [...prev, { id: crypto.randomUUID(), role:'assistant', content: `⚠️ ${e.message}` }])
     } finally {
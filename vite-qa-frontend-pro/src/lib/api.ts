@@ -1,5 +1,5 @@
 
-import type { AskRequest, AskResponse } from '@/types'
+import type { AskRequest, AskResponse, IngestJob, Source, StreamHandlers } from '@/types'
 const BASE = import.meta.env.VITE_API_BASE_URL || 'http://localhost:8000'
 async function http<T>(path: string, opts: RequestInit = {}): Promise<T> {
   const res = await fetch(`${BASE}${path}`, {
@@ -18,11 +18,58 @@ export async function ask(body: AskRequest): Promise<AskResponse> {
 export async function askMath(body: AskRequest): Promise<AskResponse> {
   return http('/api/math', { method: 'POST', body: JSON.stringify(body) })
 }
-export async function upload(file: File): Promise<{ ok: boolean; detail?: string }> {
-  const BASE = import.meta.env.VITE_API_BASE_URL || 'http://localhost:8000'
+async function stream(path: string, body: AskRequest, handlers: StreamHandlers, signal?: AbortSignal): Promise<AskResponse> {
+  const res = await fetch(`${BASE}${path}`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', Accept: 'text/event-stream' },
+    body: JSON.stringify(body),
+    signal
+  })
+  if (!res.ok || !res.body) throw new Error(`${res.status} ${res.statusText}: ${await res.text()}`)
+  const reader = res.body.getReader()
+  const decoder = new TextDecoder()
+  let buffer = ''
+  let answer = ''
+  let sources: Source[] = []
+  for (;;) {
+    const { value, done } = await reader.read()
+    if (done) break
+    buffer += decoder.decode(value, { stream: true })
+    let sep: number
+    while ((sep = buffer.indexOf('\n\n')) >= 0) {
+      const frame = buffer.slice(0, sep)
+      buffer = buffer.slice(sep + 2)
+      const event = /^event: (.*)$/m.exec(frame)?.[1] ?? 'message'
+      const data = JSON.parse(/^data: (.*)$/m.exec(frame)?.[1] ?? '{}')
+      if (event === 'sources') { sources = data; handlers.onSources?.(data) }
+      else if (event === 'token') { answer += data.text; handlers.onToken?.(data.text) }
+      else if (event === 'error') throw new Error(data.detail)
+    }
+  }
+  return { answer, sources }
+}
+// Server-Sent Events variants: sources arrive first, then answer tokens
+export async function askStream(body: AskRequest, handlers: StreamHandlers, signal?: AbortSignal): Promise<AskResponse> {
+  return stream('/api/ask/stream', body, handlers, signal)
+}
+export async function askMathStream(body: AskRequest, handlers: StreamHandlers, signal?: AbortSignal): Promise<AskResponse> {
+  return stream('/api/math/stream', body, handlers, signal)
+}
+export async function ingestJob(id: string): Promise<IngestJob> {
+  return http(`/ingest/jobs/${id}`)
+}
+// Uploads the PDF, then waits for its ingestion job so "indexed" means searchable
+export async function upload(file: File, course?: string): Promise<{ ok: boolean; detail?: string }> {
   const form = new FormData()
   form.append('file', file)
+  if (course) form.append('course', course)
   const res = await fetch(`${BASE}/api/upload`, { method: 'POST', body: form as any })
   if (!res.ok) throw new Error(`${res.status} ${res.statusText}: ${await res.text()}`)
-  return res.json()
-}
\ No newline at end of file
+  const { job_id } = await res.json()
+  for (;;) {
+    const job = await ingestJob(job_id)
+    if (job.status === 'succeeded') return { ok: true, detail: `${job.progress.chunks_stored} chunks indexed` }
+    if (job.status === 'failed') return { ok: false, detail: job.error ?? 'Indexing failed' }
+    await new Promise(r => setTimeout(r, 1000))
+  }
+}
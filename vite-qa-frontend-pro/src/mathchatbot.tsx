@@ -1,6 +1,6 @@
 import React, { useMemo, useRef, useState } from 'react'
 import type { Message, AskResponse } from '@/types'
-import { askMath, upload } from '@/lib/api'   // ⬅️ use askMath here
+import { askMathStream, upload } from '@/lib/api'
 import MessageBubble from '@/components/MessageBubble'
 import SourceList from '@/components/SourceList'
 import Header from './components/Header'
@@ -26,9 +26,12 @@ export default function MathChatbot() {
     setLoading(true)
     try {
       // ⬇️ call the math endpoint
-      const res = await askMath({ question: q, history: messages.slice(-10), top_k: 5, temperature: 0.1 })
-      setMessages(prev => [...prev, { id: crypto.randomUUID(), role: 'assistant', content: res.answer }])
-      setSources(res.sources || [])
+      const id = crypto.randomUUID()
+      setMessages(prev => [...prev, { id, role: 'assistant', content: '' }])
+      await askMathStream({ question: q, history: messages.slice(-10), top_k: 5, temperature: 0.1 }, {
+        onSources: setSources,
+        onToken: t => setMessages(prev => prev.map(m => (m.id === id ? { ...m, content: m.content + t } : m)))
+      })
     } catch (e: any) {
       setMessages(prev => [...prev, { id: crypto.randomUUID(), role: 'assistant', content: `⚠️ ${e.message}` }])
     } finally {
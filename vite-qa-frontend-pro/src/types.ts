@@ -1,6 +1,10 @@
 
 export type Role = 'user' | 'assistant'
 export interface Message { id: string; role: Role; content: string }
-export interface Source { title?: string; url?: string; chunk?: string; score?: number }
-export interface AskRequest { question: string; history?: Message[]; top_k?: number; temperature?: number }
-export interface AskResponse { answer: string; sources?: Source[] }
+export interface Source { title?: string; url?: string; chunk?: string; score?: number; source?: string; page_number?: number; document_id?: string; chunk_id?: string; content_type?: string; fused_score?: number; rerank_score?: number }
+export interface AskFilters { course?: string | string[]; document?: string | string[]; content_type?: string | string[]; page_from?: number; page_to?: number }
+export interface AskRequest { question: string; history?: Message[]; top_k?: number; temperature?: number; filters?: AskFilters }
+export interface AskResponse { answer: string; sources?: Source[]; timings?: Record<string, number> }
+
+export interface StreamHandlers { onSources?: (sources: Source[]) => void; onToken?: (text: string) => void }
+export interface IngestJob { id: string; status: 'queued' | 'running' | 'succeeded' | 'failed'; files?: string[] | null; progress: { files_total: number; files_done: number; pages_done: number; chunks_stored: number; files_removed: number }; error?: string | null }